@@ -1,5 +1,7 @@
 import pymsb.__main__
 from pymsb.language.interpreter import Interpreter
+from pymsb.language.compiledprogram import CompiledProgram
+from pymsb.language.parsersession import ParserSession
 import pymsb.language.errors as errors
 
 __author__ = 'Simon Tang'
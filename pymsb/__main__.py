@@ -1,28 +1,120 @@
+import argparse
 import os
 import sys
+import threading
 
+from pymsb import batch
+import pymsb.language.errors as errors
+from pymsb.language.eventdispatcher import EventDispatcher
 from pymsb.language.interpreter import Interpreter
 
 
+def create_argument_parser():
+    parser = argparse.ArgumentParser(
+        prog="pymsb",
+        description="Executes the Microsoft Small Basic code in the given file path, with the given arguments.")
+    parser.add_argument("--backend", choices=Interpreter.BACKENDS, default="interpreter",
+                        help="execute statement by statement (interpreter, the default), or translate the program "
+                             "into Python code first (python)")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without any windows; the TextWindow reads from stdin and writes to stdout, and "
+                             "programs that need a display are rejected")
+    parser.add_argument("--no-optimize", dest="optimize", action="store_false",
+                        help="execute the program exactly as parsed, without constant folding or removing branches "
+                             "that can never be taken")
+    parser.add_argument("--no-inline", dest="inline_subroutines", action="store_false",
+                        help="don't replace calls to small subroutines inside loops with the body of the subroutine")
+    parser.add_argument("--dump-optimized", action="store_true",
+                        help="print the optimized program to stderr before executing it")
+    parser.add_argument("--event-policy", choices=EventDispatcher.POLICIES, default="coalesce",
+                        help="what to do with an event (e.g. Timer.Tick) that happens while its subroutine is still "
+                             "running: run it once more afterwards however many times it happened (coalesce, the "
+                             "default), ignore it (drop), or run it once for every time it happened (queue)")
+    parser.add_argument("--scheduler", choices=Interpreter.SCHEDULERS, default="threads",
+                        help="run the main program and every event subroutine in threads of their own (threads, the "
+                             "default), or take turns running them in a single thread (cooperative; interpreter "
+                             "backend only)")
+    parser.add_argument("--cache", action="store_true",
+                        help="cache the compiled program in a __pymsbcache__ directory next to the source file, so "
+                             "that running it again skips parsing it")
+    parser.add_argument("--cache-dir", metavar="DIRECTORY",
+                        help="cache compiled programs in DIRECTORY instead (implies --cache)")
+    parser.add_argument("--profile", metavar="JSONFILE",
+                        help="count how often each line and built-in function runs and time it, then write the results "
+                             "to JSONFILE and print the source code annotated with them to stderr (interpreter backend "
+                             "only)")
+    parser.add_argument("--max-instructions", type=int, metavar="COUNT",
+                        help="stop the program after it has executed about this many instructions")
+    parser.add_argument("--max-seconds", type=float, metavar="SECONDS",
+                        help="stop the program after it has run for this many seconds")
+    parser.add_argument("--max-memory", type=int, metavar="BYTES",
+                        help="stop the program once its variables, stacks and arrays take up more than about this many "
+                             "bytes")
+    parser.add_argument("--checkpoint", metavar="SNAPSHOT",
+                        help="save a snapshot of the running program to SNAPSHOT every few seconds (cooperative "
+                             "scheduler only)")
+    parser.add_argument("--checkpoint-interval", type=float, default=5.0, metavar="SECONDS",
+                        help="how often to save a snapshot with --checkpoint (default: every 5 seconds)")
+    parser.add_argument("--resume", metavar="SNAPSHOT",
+                        help="continue the program saved in SNAPSHOT instead of running a file (cooperative scheduler "
+                             "only)")
+    parser.add_argument("file_path", nargs="?", metavar="FILEPATH")
+    parser.add_argument("prog_args", nargs=argparse.REMAINDER, metavar="ARGUMENT")
+    return parser
+
+
 def main():
     """Entry point for PyMSB interpreter"""
 
     args = sys.argv[1:]
+    if args[:1] == ["batch"]:
+        sys.exit(batch.main(args[1:]))
+    parser = create_argument_parser()
+    options = parser.parse_args(args)
+    if (options.checkpoint or options.resume) and options.scheduler != "cooperative":
+        parser.error("--checkpoint and --resume need --scheduler cooperative")
     # TODO: don't run /home/simon/PycharmProjecgts/pymsb/test_code.sb when no args given
-    if not args:
-        print('''Usage: pymsb [FILEPATH] [ARGUMENT]...
-Executes the Microsoft Small Basic code in the given file path, with the given arguments.''')
+    if options.file_path is None and options.resume is None:
+        parser.print_usage()
+        print(parser.description)
         source_arg = "/home/simon/PycharmProjects/pymsb/test_code.sb"
-        prog_args = args[:]
     else:
-        source_arg = args[0]
-        prog_args = args[1:]
+        source_arg = options.file_path
+    prog_args = options.prog_args
+
+    interpreter = Interpreter(backend=options.backend, headless=options.headless, optimize=options.optimize,
+                              dump_optimized=options.dump_optimized, inline_subroutines=options.inline_subroutines,
+                              event_policy=options.event_policy, scheduler=options.scheduler,
+                              profile=options.profile is not None, max_instructions=options.max_instructions,
+                              max_seconds=options.max_seconds, max_memory=options.max_memory, cache=options.cache,
+                              cache_dir=options.cache_dir)
+    finished = threading.Event()
+    if options.checkpoint is not None:
+        threading.Thread(target=save_checkpoints, args=(interpreter, options.checkpoint, options.checkpoint_interval,
+                                                        finished), daemon=True).start()
+    try:
+        if options.resume is not None:
+            interpreter.resume(options.resume)
+        else:
+            interpreter.execute_file(os.path.abspath(source_arg), prog_args)
+    except errors.PyMsbResourceLimitError as e:
+        sys.exit(str(e))
+    except errors.PyMsbSyntaxError:
+        sys.exit(1)  # the parser has already printed the errors
+    finally:
+        finished.set()
+    if options.profile is not None:
+        with open(options.profile, "w") as profile_file:
+            interpreter.profiler.write_json(profile_file)
+        sys.stderr.write(interpreter.profiler.annotate())
 
-    print("pymsb.__main__.main executed.  Args:", args)
 
-    path = os.path.abspath(source_arg)
-    interpreter = Interpreter()
-    interpreter.execute_file(path, prog_args)
+def save_checkpoints(interpreter, path, interval, finished):
+    while not finished.wait(interval):
+        try:
+            interpreter.save_snapshot(path)
+        except ValueError:
+            pass  # the program hasn't started yet
 
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+import argparse
+import collections
+import io
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import threading
+import time
+
+import pymsb.language.errors as errors
+from pymsb.language.interpreter import Interpreter
+
+try:
+    import resource  # only available on Unix, so peak memory is only reported there
+except ImportError:
+    resource = None
+
+
+class BatchJob:
+    """
+    A Microsoft Small Basic program to run as part of a batch.
+
+    :param path: The path of the source code file.
+    :param args: A list of arguments to the program.
+    :param input_lines: The lines of text that the program's TextWindow reads.
+    """
+
+    def __init__(self, path, args=None, input_lines=None):
+        self.path = path
+        self.args = list(args or [])
+        self.input_lines = list(input_lines or [])
+
+    def __repr__(self):
+        return "BatchJob<{0}>".format(self.path)
+
+
+def load_jobs(path):
+    """
+    Returns the BatchJobs described by path, which is either:
+
+     - a directory, in which case every .sb file in it is run; if there is a file with the same name ending in .input
+       instead, its lines are the program's input, or
+     - a manifest with one JSON object per line, with the "path" of a program (relative to the manifest), and
+       optionally its "args" (a list) and "input" (a list of lines, or a string).
+    """
+    if os.path.isdir(path):
+        jobs = []
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.lower().endswith(".sb"):
+                continue
+            input_path = os.path.join(path, file_name[:-3] + ".input")
+            input_lines = []
+            if os.path.isfile(input_path):
+                with open(input_path) as input_file:
+                    input_lines = input_file.read().splitlines()
+            jobs.append(BatchJob(os.path.join(path, file_name), input_lines=input_lines))
+        return jobs
+
+    jobs = []
+    with open(path) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            input_lines = entry.get("input", [])
+            if isinstance(input_lines, str):
+                input_lines = input_lines.splitlines()
+            jobs.append(BatchJob(os.path.join(os.path.dirname(path), entry["path"]), entry.get("args"), input_lines))
+    return jobs
+
+
+def run_batch(jobs, processes=None, timeout=None, on_result=None, max_instructions=None, max_memory=None):
+    """
+    Runs each BatchJob headless, in a process of its own, with at most the given number of processes at once.
+
+    Each result is a dict with the "path" of the program, its "status" ("ok", "error", "limit", "timeout" or "crashed"),
+    the "output" its TextWindow wrote, the "error" that stopped it (or None), its run "time" in seconds and its peak
+    memory usage, "max_rss_kb" (None where that can't be measured).
+
+    :param processes: The number of programs to run at once; by default, the number of CPUs.
+    :param timeout: The number of seconds after which a program is killed, or None to let every program finish.
+    :param on_result: A callable that is passed every result as soon as it is available.
+    :param max_instructions: If not None, stop programs after they have executed about this many instructions.
+    :param max_memory: If not None, stop programs once their variables, stacks and arrays take up more than about this
+                       many bytes.
+    :return: The list of results, in the same order as jobs.
+    """
+    processes = processes or os.cpu_count() or 1
+    # Forking is much faster than starting a new interpreter for every program, where it is available
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+
+    results = [None] * len(jobs)
+    pending = collections.deque(enumerate(jobs))
+    running = {}  # maps the processes that are running to (index, job, start time, connection)
+
+    while pending or running:
+        while pending and len(running) < processes:
+            index, job = pending.popleft()
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_job, args=(job, sender, max_instructions, max_memory), daemon=True)
+            process.start()
+            sender.close()  # the child has its own copy now; this lets receiver notice if the child dies
+            running[process] = (index, job, time.perf_counter(), receiver)
+
+        deadlines = [start + timeout for _, _, start, _ in running.values()] if timeout is not None else []
+        wait_time = max(0.0, min(deadlines) - time.perf_counter()) if deadlines else None
+        multiprocessing.connection.wait([receiver for _, _, _, receiver in running.values()], wait_time)
+
+        for process, (index, job, start, receiver) in list(running.items()):
+            result = None
+            if receiver.poll():
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    process.join()
+                    result = _result(job, "crashed", None, "The process exited with code {0}.".format(
+                        process.exitcode), time.perf_counter() - start)
+            elif timeout is not None and time.perf_counter() - start >= timeout:
+                process.terminate()
+                result = _result(job, "timeout", None, "Killed after {0} seconds.".format(timeout), timeout)
+            if result is None:
+                continue
+
+            process.join()
+            receiver.close()
+            del running[process]
+            results[index] = result
+            if on_result is not None:
+                on_result(result)
+
+    return results
+
+
+def write_report(results, file):
+    """Writes results, as returned by run_batch, to the given file-like object as JSON lines."""
+    for result in results:
+        file.write(json.dumps(result) + "\n")
+
+
+def _result(job, status, output, error, run_time, max_rss_kb=None):
+    return {"path": job.path, "args": job.args, "status": status, "output": output, "error": error, "time": run_time,
+            "max_rss_kb": max_rss_kb}
+
+
+def _run_job(job, connection, max_instructions, max_memory):
+    # Runs in the child process.  Anything printed outside the TextWindow (e.g. debugging output) goes to stderr, so
+    # that it can't end up in the middle of a report written to stdout.
+    sys.stdout = sys.stderr
+    # Uncaught exceptions in the program's threads also mean that the program failed
+    thread_errors = []
+    threading.excepthook = lambda hook_args: thread_errors.append(
+        "{0}: {1}".format(hook_args.exc_type.__name__, hook_args.exc_value))
+
+    output = io.StringIO()
+    status = "ok"
+    error = None
+    start = time.perf_counter()
+    try:
+        with open(job.path) as code_file:
+            code = code_file.read()
+        interpreter = Interpreter(headless=True, max_instructions=max_instructions, max_memory=max_memory)
+        interpreter.execute_code(code, job.args, job.path, input_lines=job.input_lines, output=output)
+    except errors.PyMsbResourceLimitError as e:
+        status, error = "limit", str(e)
+    except Exception as e:
+        status, error = "error", "{0}: {1}".format(type(e).__name__, e)
+    run_time = time.perf_counter() - start
+
+    if error is None and thread_errors:
+        status, error = "error", thread_errors[0]
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    if sys.platform == "darwin" and max_rss_kb is not None:
+        max_rss_kb //= 1024  # reported in bytes there
+    connection.send(_result(job, status, output.getvalue(), error, run_time, max_rss_kb))
+    connection.close()
+
+
+def create_argument_parser():
+    parser = argparse.ArgumentParser(
+        prog="pymsb batch",
+        description="Runs many Microsoft Small Basic programs headless and in parallel, and reports their output, "
+                    "status, run time and peak memory as JSON lines.")
+    parser.add_argument("path", metavar="DIRECTORY|MANIFEST",
+                        help="a directory of .sb files (with optional .input files), or a manifest with one JSON "
+                             "object per line, with the \"path\" of a program and optionally its \"args\" and "
+                             "\"input\"")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="the number of programs to run at once (default: the number of CPUs)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="kill programs that run for longer than this many seconds")
+    parser.add_argument("--max-instructions", type=int, metavar="COUNT",
+                        help="stop programs after they have executed about this many instructions")
+    parser.add_argument("--max-memory", type=int, metavar="BYTES",
+                        help="stop programs once their variables, stacks and arrays take up more than about this many "
+                             "bytes")
+    parser.add_argument("-o", "--output", metavar="REPORT",
+                        help="write the report to this file instead of stdout")
+    return parser
+
+
+def main(args):
+    """Entry point for pymsb batch"""
+    options = create_argument_parser().parse_args(args)
+    jobs = load_jobs(options.path)
+    report = sys.stdout if options.output is None else open(options.output, "w")
+    try:
+        # Report results as they come in, so that long batches can be followed
+        results = run_batch(jobs, options.processes, options.timeout,
+                            on_result=lambda result: (write_report([result], report), report.flush()),
+                            max_instructions=options.max_instructions, max_memory=options.max_memory)
+    finally:
+        if report is not sys.stdout:
+            report.close()
+    return 0 if all(result["status"] == "ok" for result in results) else 1
@@ -0,0 +1,20 @@
+class CompiledProgram:
+    """
+    A Microsoft Small Basic program that has been parsed and optimized once, so that Interpreter.run can execute it any
+    number of times, e.g. with different arguments or input, without doing that work again.  Create one with
+    Interpreter.compile; nothing about a CompiledProgram changes once it has been created.
+
+    :param source: The Microsoft Small Basic code.
+    :param statements: The statement ASTs, as returned by Parser.parse and possibly optimized.
+    :param variable_names: The distinct lowercase names of the variables that the statements use.
+    :param object_lines: A dict mapping each built-in object that the statements use to the line where it is first used.
+    """
+
+    def __init__(self, source, statements, variable_names, object_lines):
+        self.source = source
+        self.statements = tuple(statements)
+        self.variable_names = tuple(variable_names)
+        self.object_lines = dict(object_lines)
+
+    def __repr__(self):
+        return "CompiledProgram<{0} statements>".format(len(self.statements))
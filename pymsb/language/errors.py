@@ -42,6 +42,11 @@ class PyMsbRuntimeError(RuntimeError):
     pass
 
 
+class PyMsbTranspilerError(PyMsbRuntimeError):
+    """Raised when a program uses a construct that the Python backend cannot translate."""
+    pass
+
+
 class PyMsbMalformedArrayError(PyMsbRuntimeError):
     def __init__(self, array_name, array_value):
         super().__init__()
@@ -52,3 +57,24 @@ class PyMsbMalformedArrayError(PyMsbRuntimeError):
 class PyMsbMissingObjectError(PyMsbSyntaxError):
     def __init__(self, line_number, line_index, obj_name):
         super().__init__(line_number, line_index, "Cannot find object '{}'.".format(obj_name))
+
+
+class PyMsbHeadlessError(PyMsbSyntaxError):
+    """Raised before a program runs in headless mode if it uses a built-in object that needs a display."""
+    def __init__(self, line_number, obj_name):
+        super().__init__(line_number, 0, "Object '{}' needs a display and cannot be used in headless mode.".format(
+            obj_name))
+        self.obj_name = obj_name
+
+
+class PyMsbResourceLimitError(PyMsbRuntimeError):
+    """Raised by Interpreter.run when a program is stopped because it exceeded one of its resource limits."""
+    def __init__(self, limit, maximum, usage):
+        super().__init__("The program exceeded its {0} limit of {1} (reached {2}).".format(limit, maximum, usage))
+        self.limit = limit  # "instructions", "seconds" or "memory"
+        self.maximum = maximum
+        self.usage = usage
+
+
+class PyMsbProgramEnded(Exception):
+    """Raised by Program.End to stop the thread that called it right away; the interpreter catches it."""
@@ -0,0 +1,189 @@
+import collections
+import queue
+import threading
+import time
+import traceback
+
+
+class EventDispatcher:
+    """
+    Runs the subroutines assigned to events (e.g. Timer.Tick) on a small, fixed pool of worker threads, instead of
+    starting a new thread for every event.
+
+    The handler for a given event runs on one worker at a time.  When an event is triggered while its handler is still
+    running, the policy decides what happens to it:
+
+     - "coalesce": at most one more call is kept pending; any further triggers are merged into it.
+     - "drop": the event is dropped.
+     - "queue": the event is queued, up to max_queue_size pending calls, after which it is dropped.
+
+    The number of events dispatched, coalesced and dropped is counted per event; see stats().
+
+    :param run_subroutine: A callable that takes the name of a subroutine and runs it to completion.
+    :param policy: One of EventDispatcher.POLICIES.
+    :param max_workers: The number of worker threads, i.e. how many different event handlers can run at once.
+    :param max_queue_size: The number of pending calls per event that the "queue" policy keeps.
+    :param on_idle: A callable taking no arguments, called whenever the last running event handler finishes.
+    """
+
+    POLICIES = ("coalesce", "drop", "queue")
+
+    def __init__(self, run_subroutine, policy="coalesce", max_workers=4, max_queue_size=64, on_idle=None):
+        if policy not in EventDispatcher.POLICIES:
+            raise ValueError("Unknown event policy '{0}'; expected one of {1}.".format(
+                policy, ", ".join(EventDispatcher.POLICIES)))
+        self.run_subroutine = run_subroutine
+        self.policy = policy
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.on_idle = on_idle
+        self.stopped = False
+
+        self.__lock = threading.Lock()
+        self.__ready = queue.Queue()  # events whose handlers should be run by the next free worker
+        self.__pending = collections.defaultdict(collections.deque)  # maps events to the subroutine names to call
+        self.__active = set()  # events that are waiting for a worker or being handled by one
+        self.__counters = collections.defaultdict(collections.Counter)  # maps event names to their counters
+        self.__workers = []
+
+    def dispatch(self, event_name, sub_name):
+        """
+        Arranges for the named subroutine to be called on behalf of the given event, according to the policy.
+
+        :param event_name: A name identifying the event, e.g. "Timer.Tick".
+        :param sub_name: The name of the subroutine assigned to the event.
+        """
+        with self.__lock:
+            if self.stopped:
+                return
+            counters = self.__counters[event_name]
+            pending = self.__pending[event_name]
+
+            schedule = event_name not in self.__active
+            if schedule:
+                self.__active.add(event_name)
+                pending.append(sub_name)
+            elif self.policy == "coalesce":
+                if pending:
+                    counters["coalesced"] += 1
+                else:
+                    pending.append(sub_name)
+            elif self.policy == "queue" and len(pending) < self.max_queue_size:
+                pending.append(sub_name)
+            else:
+                counters["dropped"] += 1
+
+        # Called without holding the lock, since scheduling may have to wait for another thread
+        if schedule:
+            self._schedule(event_name)
+
+    def stop(self):
+        """
+        Stops dispatching events; events that are triggered from now on are ignored.  Each worker exits once it has
+        finished what it was handling; see join().
+        """
+        with self.__lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            # One sentinel per worker, queued behind any events that are already waiting for one
+            for _ in self.__workers:
+                self.__ready.put(None)
+
+    def join(self, timeout=None):
+        """
+        Waits for the workers to exit after stop().  A worker that is the calling thread (e.g. an event handler that
+        called Program.End) isn't waited for.
+
+        :param timeout: The maximum number of seconds to wait for all of the workers, or None to wait for as long as it
+                        takes.
+        :return: True if every other worker has exited, or False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__lock:
+            workers = [worker for worker in self.__workers if worker is not threading.current_thread()]
+        for worker in workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(worker.is_alive() for worker in workers)
+
+    def is_idle(self):
+        """Returns whether no event handlers are running or pending."""
+        with self.__lock:
+            return not self.__active
+
+    def stats(self):
+        """
+        Returns a dict with the total number of events that were "dispatched", "coalesced" and "dropped", and, under
+        "events", a dict mapping each event name to a dict of the same counters for that event.
+        """
+        with self.__lock:
+            events = {event_name: {name: counters[name] for name in ("dispatched", "coalesced", "dropped")}
+                      for event_name, counters in self.__counters.items()}
+        totals = {name: sum(counters[name] for counters in events.values())
+                  for name in ("dispatched", "coalesced", "dropped")}
+        totals["events"] = events
+        return totals
+
+    def _schedule(self, event_name):
+        """
+        Arranges for the handler of an event that just became active to be run.  The handler should repeatedly call
+        _next_call(event_name) and run the subroutine it returns, until it returns None.
+        """
+        with self.__lock:
+            if self.stopped:
+                # stop() was called after dispatch() checked, so there may be no worker left to run the handler
+                self.__pending.pop(event_name, None)
+                self.__active.discard(event_name)
+                idle = not self.__active
+            else:
+                self.__start_workers()
+                self.__ready.put(event_name)  # while holding the lock, so that it can't end up behind the sentinels
+                return
+
+        if idle and self.on_idle is not None:
+            self.on_idle()
+
+    def _activate(self, event_name):
+        """Marks an event as active, for a handler that is already running (e.g. one restored from a snapshot)."""
+        with self.__lock:
+            self.__active.add(event_name)
+
+    def _next_call(self, event_name):
+        """
+        Returns the name of the next subroutine to call for the given event, or None if nothing is pending for it, in
+        which case the event is no longer active.
+        """
+        with self.__lock:
+            pending = self.__pending[event_name]
+            if pending:
+                self.__counters[event_name]["dispatched"] += 1
+                return pending.popleft()
+            self.__active.discard(event_name)
+            idle = not self.__active
+
+        # Called without holding the lock, since on_idle may well check is_idle
+        if idle and self.on_idle is not None:
+            self.on_idle()
+        return None
+
+    def __start_workers(self):
+        # Workers are only started once the first event is triggered, so programs without events don't need them
+        while len(self.__workers) < self.max_workers:
+            worker = threading.Thread(target=self.__work, daemon=True)
+            self.__workers.append(worker)
+            worker.start()
+
+    def __work(self):
+        while True:
+            event_name = self.__ready.get()
+            if event_name is None:
+                return  # stopped
+            # Keep handling this event until nothing is pending for it
+            sub_name = self._next_call(event_name)
+            while sub_name is not None:
+                # noinspection PyBroadException
+                try:
+                    self.run_subroutine(sub_name)
+                except Exception:
+                    traceback.print_exc()  # like an uncaught exception in a thread, this shouldn't stop the worker
+                sub_name = self._next_call(event_name)
@@ -0,0 +1,415 @@
+import functools
+import operator
+
+import pymsb.language.abstractsyntaxtrees as ast
+import pymsb.language.errors as errors
+import pymsb.language.values as values
+from pymsb.language.modules import utilities
+
+
+class ExpressionCompiler:
+    """
+    The ExpressionCompiler turns expression and assignment ASTs into specialized Python callables, once, when a program
+    is loaded.  Each callable takes no arguments; evaluating the expression is a matter of calling it, with no further
+    dispatching on AST types or operator strings.
+
+    :param trace_hooks: A tracing.TraceHooks whose builtin_call and builtin_return hooks are called around the built-in
+                        members accessed by the code compiled from now on, or None.  Accesses are attributed to
+                        self.line_number, which should be set before compiling each statement.
+    """
+
+    # The operators other than "+", which always force both operands to be numeric.
+    arithmetic_operators = {
+        "-": operator.sub,
+        "*": operator.mul,
+        "/": operator.truediv,
+    }
+
+    # The comparators that force both operands to be numeric.  Anything that is non-numerical is treated like 0.
+    numeric_comparators = {
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+
+    def __init__(self, interpreter, trace_hooks=None):
+        self.interpreter = interpreter
+        self.trace_hooks = trace_hooks
+        self.trace_builtins = trace_hooks is not None and trace_hooks.traces("builtin_call", "builtin_return")
+        self.line_number = None
+
+    def compile_statement(self, statement):
+        """
+        Compiles an Assignment or a MsbObjectFunctionCall statement into a callable that executes it.
+
+        :param statement: An abstractsyntaxtrees.Assignment or abstractsyntaxtrees.MsbObjectFunctionCall instance.
+        :return: A callable taking no arguments.
+        """
+        if isinstance(statement, ast.Assignment):
+            return self.compile_assignment(statement.var, statement.val)
+        return self.compile_expression(statement)
+
+    def compile_assignment(self, destination_ast, value_ast):
+        """
+        Compiles the assignment of value_ast to destination_ast, which is either a UserVariable (optionally with array
+        indices) or a MsbObjectField.
+
+        :return: A callable taking no arguments that performs the assignment.
+        """
+        environment = self.interpreter.environment
+
+        if isinstance(destination_ast, ast.UserVariable):
+            variables = environment.variables
+            slot = environment.slot(destination_ast.variable_name)
+
+            # Assigning to variable as an array using one or more indices
+            if destination_ast.array_indices:
+                set_value = self.interpreter.array_parser.set_value
+                to_text = values.to_text
+                evaluate_indices = [self.compile_text(index_ast) for index_ast in destination_ast.array_indices]
+                evaluate_value = self.compile_text(value_ast)
+
+                # TODO: raise error when trying to assign to a subroutine name or subroutine call.
+
+                def assign_array_value():
+                    array_string = to_text(variables[slot])
+                    index_values = [evaluate_index() for evaluate_index in evaluate_indices]
+                    variables[slot] = set_value(array_string, index_values, evaluate_value())
+                return assign_array_value
+
+            # Just overwriting variable
+            evaluate_value = self.compile_expression(value_ast)
+
+            def assign():
+                variables[slot] = evaluate_value()
+            return assign
+
+        if isinstance(destination_ast, ast.MsbObjectField):
+            msb_objects = self.interpreter.msb_objects
+            object_name = utilities.capitalize(destination_ast.msb_object)
+            member_name = utilities.capitalize(destination_ast.msb_object_field_name)
+
+            # Determine if this is a function or an event
+            info = utilities.get_msb_builtin_info(destination_ast.msb_object, member_name)
+            if info is not None and info.type == "event":
+                sub_name = value_ast.variable_name
+                return lambda: msb_objects[object_name].set_event_sub(member_name, sub_name)
+
+            evaluate_value = self.compile_text(value_ast)
+            field = self.__class_member(object_name, member_name)
+            if isinstance(field, property) and field.fset is not None:
+                msb_object, set_field = msb_objects[object_name], field.fset
+                return lambda: set_field(msb_object, evaluate_value())
+            return lambda: setattr(msb_objects[object_name], member_name, evaluate_value())
+
+        raise NotImplementedError(destination_ast)
+
+    def compile_for_init(self, for_statement):
+        """
+        Compiles the start of a For loop: the loop variable is assigned the lower expression.  Lower bounds that are
+        numeric literals are stored as native numbers, so that the loop variable doesn't need to be converted on every
+        step.
+
+        :return: A callable taking no arguments that initializes the loop variable and returns whether it is already
+                 greater than the upper expression.
+        """
+        lower_expr = for_statement.lower_expr
+        if isinstance(lower_expr, ast.LiteralValue):
+            lower_expr = ast.LiteralValue(values.to_native(lower_expr.value))
+        initialize = self.compile_assignment(for_statement.var_ast, lower_expr)
+        past_upper_bound = self.compile_comparison(">", for_statement.var_ast, for_statement.upper_expr)
+
+        def init():
+            initialize()
+            return past_upper_bound()
+        return init
+
+    def compile_for_step(self, for_statement):
+        """
+        Compiles the end of an iteration of a For loop: the loop variable is incremented by 1 (if not defined, it
+        becomes 1) and compared with the upper expression, which is re-evaluated every time unless it is a literal.
+        While the loop variable holds a number, neither step converts it to or from text.
+
+        :return: A callable taking no arguments that steps the loop variable and returns whether it is now greater than
+                 the upper expression.
+        """
+        var_ast = for_statement.var_ast
+        if not isinstance(var_ast, ast.UserVariable) or var_ast.array_indices:
+            raise errors.PyMsbRuntimeError(
+                "Internal error - tried to increment non-UserVariable in ExpressionCompiler.compile_for_step")
+
+        environment = self.interpreter.environment
+        variables = environment.variables
+        slot = environment.slot(var_ast.variable_name)
+        increment = values.increment
+        to_number = values.to_number
+
+        upper_expr = for_statement.upper_expr
+        if isinstance(upper_expr, ast.LiteralValue):
+            upper = values.to_number(upper_expr.value)
+
+            def step_to_literal():
+                value = variables[slot]
+                if type(value) is int or type(value) is float:
+                    value += 1
+                    variables[slot] = value
+                    return value > upper
+                value = variables[slot] = increment(value)
+                return to_number(value) > upper
+            return step_to_literal
+
+        evaluate_upper = self.compile_number(upper_expr)
+
+        def step():
+            value = variables[slot]
+            if type(value) is int or type(value) is float:
+                value += 1
+                variables[slot] = value
+                return value > evaluate_upper()
+            value = variables[slot] = increment(value)
+            return to_number(value) > evaluate_upper()
+        return step
+
+    def compile_truth(self, val_ast):
+        """
+        Compiles a condition, such as the one in an If or While statement, into a callable that returns a Python bool.
+        """
+        if isinstance(val_ast, ast.Comparison):
+            return self.compile_comparison(val_ast.comparator, val_ast.left, val_ast.right)
+        evaluate = self.compile_expression(val_ast)
+        is_true = values.is_true
+        return lambda: is_true(evaluate())
+
+    def compile_condition(self, val_ast):
+        """
+        Compiles an expression that may be a comparison.  The resulting callable returns True or False if this is
+        actually a comparison.  Otherwise, it evaluates as an expression and returns the result (e.g. 10 or "concatstr"
+        or even "true").
+        """
+        if isinstance(val_ast, ast.Comparison):
+            return self.compile_comparison(val_ast.comparator, val_ast.left, val_ast.right)
+        return self.compile_expression(val_ast)
+
+    def compile_comparison(self, comp, left, right):
+        """
+        Compiles a comparison, where comp is one of "<=", ">=", "<", ">", "<>", "=", "and" or "or", and left and right
+        are ASTs.  The resulting callable returns a bool.
+        """
+        if comp in self.numeric_comparators:
+            compare = self.numeric_comparators[comp]
+            evaluate_left = self.compile_number(left)
+            evaluate_right = self.compile_number(right)
+            return lambda: compare(evaluate_left(), evaluate_right())
+
+        evaluate_left = self.compile_condition(left)
+        evaluate_right = self.compile_condition(right)
+        equals = values.equals
+
+        if comp == "=":
+            return lambda: equals(evaluate_left(), evaluate_right())
+        if comp == "<>":
+            return lambda: not equals(evaluate_left(), evaluate_right())
+
+        # Both sides are always evaluated, since either may call a built-in function.
+        is_true = values.is_true
+        if comp.lower() == "and":
+            def evaluate_and():
+                left_value = is_true(evaluate_left())
+                right_value = is_true(evaluate_right())
+                return left_value and right_value
+            return evaluate_and
+        if comp.lower() == "or":
+            def evaluate_or():
+                left_value = is_true(evaluate_left())
+                right_value = is_true(evaluate_right())
+                return left_value or right_value
+            return evaluate_or
+
+        raise NotImplementedError(comp)
+
+    def compile_expression(self, val_ast):
+        """
+        Compiles an expression AST into a callable taking no arguments that returns the value of the expression.
+        """
+        if isinstance(val_ast, ast.LiteralValue):
+            value = val_ast.value  # the text of the literal
+            return lambda: value
+
+        if isinstance(val_ast, ast.UserVariable):
+            return self.compile_user_variable(val_ast)
+
+        if isinstance(val_ast, ast.MsbObjectField):
+            return self.compile_object_field(val_ast.msb_object, val_ast.msb_object_field_name)
+
+        if isinstance(val_ast, ast.Operation):
+            return self.compile_operation(val_ast.operator, val_ast.left, val_ast.right)
+
+        if isinstance(val_ast, ast.MsbObjectFunctionCall):
+            return self.compile_function_call(val_ast.msb_object,
+                                              val_ast.msb_object_function,
+                                              val_ast.parameter_asts)
+
+        # Not a valid expression (e.g. a comparison used as an operand); fail only if it is actually evaluated.
+        def evaluate_invalid():
+            raise NotImplementedError(val_ast)
+        return evaluate_invalid
+
+    def compile_text(self, val_ast):
+        """
+        Compiles an expression into a callable that returns the Microsoft Small Basic string form of its value.
+        """
+        if isinstance(val_ast, ast.LiteralValue):
+            text = values.to_text(val_ast.value)
+            return lambda: text
+        evaluate = self.compile_expression(val_ast)
+        to_text = values.to_text
+        return lambda: to_text(evaluate())
+
+    def compile_number(self, val_ast):
+        """
+        Compiles an expression into a callable that returns its value as a number, where anything that is
+        non-numerical is treated like 0.  Literals are converted once, here, rather than every time they are evaluated.
+        """
+        if isinstance(val_ast, ast.LiteralValue):
+            number = values.to_number(val_ast.value)
+            return lambda: number
+        if isinstance(val_ast, ast.Operation) and val_ast.operator != "+":
+            return self.compile_expression(val_ast)  # always results in a number already
+        evaluate = self.compile_expression(val_ast)
+        to_number = values.to_number
+        return lambda: to_number(evaluate())
+
+    def compile_addend(self, val_ast):
+        """
+        Compiles an operand of "+" into a callable that returns its value as a number if it is numerical, or as text
+        otherwise.
+        """
+        if isinstance(val_ast, ast.LiteralValue):
+            addend = values.to_number_or_text(val_ast.value)
+            return lambda: addend
+        if isinstance(val_ast, ast.Operation) and val_ast.operator != "+":
+            return self.compile_expression(val_ast)  # always results in a number already
+        evaluate = self.compile_expression(val_ast)
+        to_number_or_text = values.to_number_or_text
+        return lambda: to_number_or_text(evaluate())
+
+    def compile_user_variable(self, val_ast):
+        environment = self.interpreter.environment
+        variables = environment.variables
+        slot = environment.slot(val_ast.variable_name)
+
+        # If accessing variable as an array
+        if val_ast.array_indices:
+            get_value = self.interpreter.array_parser.get_value
+            to_text = values.to_text
+            evaluate_indices = [self.compile_text(index_ast) for index_ast in val_ast.array_indices]
+            return lambda: get_value(to_text(variables[slot]),
+                                     [evaluate_index() for evaluate_index in evaluate_indices])
+
+        # Just accessing variable
+        return lambda: variables[slot]
+
+    def compile_object_field(self, obj_name, field_name):
+        msb_objects = self.interpreter.msb_objects
+        obj_name = utilities.capitalize(obj_name)
+        field_name = utilities.capitalize(field_name)
+        field = self.__class_member(obj_name, field_name)
+        if isinstance(field, property) and field.fget is not None:
+            # Bind the property's getter to the object now, rather than looking both up on every read
+            read_field = functools.partial(field.fget, msb_objects[obj_name])
+        else:
+            # Fields that are plain attributes may be replaced while the program runs
+            read_field = lambda: getattr(msb_objects[obj_name], field_name)
+        if self.trace_builtins:
+            return self.trace_hooks.wrap_builtin(self.line_number, obj_name + "." + field_name, read_field)
+        return read_field
+
+    def compile_function_call(self, obj_name, fn_name, arg_asts):
+        msb_objects = self.interpreter.msb_objects
+        obj_name = utilities.capitalize(obj_name)
+        fn_name = utilities.capitalize(fn_name)
+        method = self.__class_member(obj_name, fn_name)
+        if callable(method):
+            # Bind the method to the object now, rather than looking both up on every call
+            function = getattr(msb_objects[obj_name], fn_name)
+        else:
+            # e.g. a member that doesn't exist; fail when the call is executed
+            function = lambda *args: getattr(msb_objects[obj_name], fn_name)(*args)
+        if getattr(method, "native_args", False):
+            evaluate_args = [self.compile_expression(arg_ast) for arg_ast in arg_asts]
+        else:
+            evaluate_args = [self.compile_text(arg_ast) for arg_ast in arg_asts]
+        if self.trace_builtins:
+            # Trace only the call itself, not the evaluation of its arguments
+            call = self.trace_hooks.wrap_builtin(self.line_number, obj_name + "." + fn_name, function)
+            return lambda: call(*[evaluate_arg() for evaluate_arg in evaluate_args])
+        if not evaluate_args:
+            return function
+        if len(evaluate_args) == 1:
+            evaluate_arg, = evaluate_args
+            return lambda: function(evaluate_arg())
+        return lambda: function(*[evaluate_arg() for evaluate_arg in evaluate_args])
+
+    def __class_member(self, obj_name, member_name):
+        """
+        Returns the attribute of the class of the built-in object obj_name that implements member_name, e.g. a method
+        or a property, or None if there is no such object or the member is not defined by the class.
+        """
+        msb_object = self.interpreter.msb_objects.get(obj_name)
+        if msb_object is None or member_name is None:
+            return None
+        return getattr(type(msb_object), member_name, None)
+
+    # FIXME: fix this so ("x is " + "00") returns "x is 00" and not "x is 0"
+    def compile_operation(self, op, left, right):
+        # op is "+", "-", "*" or "/"
+        # left, right are expression asts
+        if isinstance(left, ast.Operation):
+            return self.compile_chain(op, left, right)
+
+        if op == "+":
+            evaluate_left = self.compile_addend(left)
+            evaluate_right = self.compile_addend(right)
+            add = values.add
+            return lambda: add(evaluate_left(), evaluate_right())
+
+        apply_operator = self.arithmetic_operators[op]
+        evaluate_left = self.compile_number(left)
+        evaluate_right = self.compile_number(right)
+        return lambda: apply_operator(evaluate_left(), evaluate_right())
+
+    def compile_chain(self, op, left, right):
+        """
+        Compiles an operation whose left operand is itself an operation, e.g. a + b - c * d + e, which the parser nests
+        down the left, one Operation per operator.  The whole chain becomes a single loop over its operands, rather than
+        one callable per operator, so that neither compiling nor evaluating a formula with hundreds of terms recurses
+        hundreds of levels deep.
+        """
+        steps = [(op, right)]
+        while isinstance(left, ast.Operation):
+            steps.append((left.operator, left.right))
+            left = left.left
+        steps.reverse()
+
+        evaluate_first = self.compile_addend(left) if steps[0][0] == "+" else self.compile_number(left)
+        rest = []
+        previous_op = None
+        for step_op, operand in steps:
+            # Like compile_addend and compile_number, the result so far only needs converting if it came from "+"
+            if step_op == "+":
+                convert = values.to_number_or_text if previous_op == "+" else None
+                rest.append((convert, values.add, self.compile_addend(operand)))
+            else:
+                convert = values.to_number if previous_op == "+" else None
+                rest.append((convert, self.arithmetic_operators[step_op], self.compile_number(operand)))
+            previous_op = step_op
+
+        def evaluate_chain():
+            value = evaluate_first()
+            for convert, apply_operator, evaluate_operand in rest:
+                if convert is not None:
+                    value = convert(value)
+                value = apply_operator(value, evaluate_operand())
+            return value
+        return evaluate_chain
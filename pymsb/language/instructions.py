@@ -0,0 +1,228 @@
+# These are the instructions that InterpreterThread actually executes.  The Linker translates the list of statement
+# ASTs produced by the Parser into a flat list of instructions, where every jump target is an index into that list.
+# When a program is loaded, the Interpreter compiles the expressions in every instruction into Python callables, and
+# the Linker groups the instructions into BasicBlocks, so that a straight-line run of statements is dispatched once.
+# Instructions that fall through to the next one store its index as next_index, so that executing them (or pushing a
+# subroutine's return location) doesn't create a new int object every time.
+
+
+class Instruction:
+    """ An instruction in the flat instruction stream produced by the Linker.
+
+    Calling compile(compiler) prepares the instruction for execution, and calling execute(thread) carries out the
+    instruction and returns the index of the next instruction to execute.  size is the number of instructions that
+    execute carries out.
+    """
+    size = 1
+
+    def __init__(self, statement):
+        self.statement = statement
+
+    @property
+    def line_number(self):
+        return self.statement.line_number
+
+    def compile(self, compiler):
+        """
+        Compiles the expressions used by this instruction.
+        :param compiler: An expressioncompiler.ExpressionCompiler instance.
+        """
+        pass
+
+    def execute(self, thread):
+        raise NotImplementedError(repr(self))
+
+
+class ExecuteStatement(Instruction):
+    """ Executes an Assignment or a MsbObjectFunctionCall statement and advances to the next instruction. """
+    def __init__(self, statement, index):
+        super().__init__(statement)
+        self.index = index
+        self.next_index = index + 1
+        self.action = None
+
+    def compile(self, compiler):
+        self.action = compiler.compile_statement(self.statement)
+
+    def execute(self, thread):
+        self.action()
+        return self.next_index
+
+    def __repr__(self):
+        return "ExecuteStatement<{0}>".format(self.statement)
+
+
+class Jump(Instruction):
+    """ Unconditionally jumps to the target index. """
+    def __init__(self, statement, target=None):
+        super().__init__(statement)
+        self.target = target
+
+    def execute(self, thread):
+        return self.target
+
+    def __repr__(self):
+        return "Jump<{0}>".format(self.target)
+
+
+class JumpIfFalse(Instruction):
+    """ Jumps to the target index unless the condition is true; otherwise advances. """
+    def __init__(self, statement, index, condition_expr, target=None):
+        super().__init__(statement)
+        self.index = index
+        self.next_index = index + 1
+        self.condition_expr = condition_expr
+        self.target = target
+        self.condition = None
+
+    def compile(self, compiler):
+        self.condition = compiler.compile_truth(self.condition_expr)
+
+    def execute(self, thread):
+        if self.condition():
+            return self.next_index
+        return self.target
+
+    def __repr__(self):
+        return "JumpIfFalse<{0}, {1}>".format(self.condition_expr, self.target)
+
+
+class CallSubroutine(Instruction):
+    """ Saves the index of the next instruction on the thread's return stack and jumps to a subroutine body. """
+    def __init__(self, statement, index, target=None):
+        super().__init__(statement)
+        self.index = index
+        self.next_index = index + 1
+        self.target = target
+
+    def execute(self, thread):
+        thread.sub_return_locations.append(self.next_index)
+        return self.target
+
+    def __repr__(self):
+        return "CallSubroutine<{0}>".format(self.target)
+
+
+class ReturnFromSubroutine(Instruction):
+    """ Returns to the index saved by the matching CallSubroutine.
+
+    The first value in a thread's return stack is past the end of the program, so if a subroutine is run as, say, part
+    of Timer.Tick, the subroutine ending will terminate that particular thread.
+    """
+    def execute(self, thread):
+        return thread.sub_return_locations.pop()
+
+    def __repr__(self):
+        return "ReturnFromSubroutine<>"
+
+
+class ForInit(Instruction):
+    """ Sets the loop variable to the lower expression, then skips the loop if it is already past the upper expression.
+    The matching ForStep handles the rest of the loop logic.
+    """
+    def __init__(self, statement, index, target=None):
+        super().__init__(statement)
+        self.index = index
+        self.next_index = index + 1
+        self.target = target
+        self.initialize = None
+
+    def compile(self, compiler):
+        self.initialize = compiler.compile_for_init(self.statement)
+
+    def execute(self, thread):
+        if self.initialize():
+            return self.target
+        return self.next_index
+
+    def __repr__(self):
+        return "ForInit<{0}, {1}>".format(self.statement, self.target)
+
+
+class ForStep(Instruction):
+    """ Increments the loop variable and jumps back to the start of the loop body unless the loop variable is now
+    greater than the upper expression.  The upper expression is re-evaluated on every iteration.
+    """
+    def __init__(self, statement, for_statement, index, target=None):
+        super().__init__(statement)
+        self.for_statement = for_statement
+        self.index = index
+        self.next_index = index + 1
+        self.target = target
+        self.step = None
+
+    def compile(self, compiler):
+        self.step = compiler.compile_for_step(self.for_statement)
+
+    def execute(self, thread):
+        if self.step():
+            return self.next_index
+        return self.target
+
+    def __repr__(self):
+        return "ForStep<{0}, {1}>".format(self.for_statement, self.target)
+
+
+class BasicBlock(Instruction):
+    """ Executes program_instructions[start:end + 1], a straight-line run of instructions that can only be entered at
+    the first one: ExecuteStatements, and then the instruction that ends the block, which is either one that decides
+    where to go next (e.g. a jump) or the last ExecuteStatement before a jump target.  The ExecuteStatements' actions
+    are called one after the other, without going back to the InterpreterThread in between.
+
+    Where the block goes next skips over unconditional jumps, e.g. the Goto in "If x Then Goto loop EndIf", and a block
+    that jumps back to the condition of a While loop tests it right away, so that each iteration of a loop, whether
+    written with While or with Goto, is a single block.
+    """
+    def __init__(self, program_instructions, start, end):
+        super().__init__(program_instructions[start].statement)
+        self.actions = tuple(instruction.action for instruction in program_instructions[start:end])
+        self.last = program_instructions[end]
+        self.size = end - start + 1
+        self.execute = self.__compile(program_instructions)
+
+    def __compile(self, program_instructions):
+        def follow(index):
+            # Returns where execution really continues when it reaches index
+            seen = set()
+            while index not in seen and index < len(program_instructions) and \
+                    isinstance(program_instructions[index], Jump):
+                seen.add(index)
+                index = program_instructions[index].target
+            return index
+
+        actions = self.actions
+        last = self.last
+        if isinstance(last, Jump):
+            target = follow(last.target)
+            if target < len(program_instructions) and isinstance(program_instructions[target], JumpIfFalse):
+                last = program_instructions[target]
+                self.size += 1
+            else:
+                def execute(thread):
+                    for action in actions:
+                        action()
+                    return target
+                return execute
+
+        if isinstance(last, (JumpIfFalse, ForStep)):
+            condition = last.condition if isinstance(last, JumpIfFalse) else last.step
+            next_index, target = follow(last.next_index), follow(last.target)
+
+            def execute(thread):
+                for action in actions:
+                    action()
+                if condition():
+                    return next_index
+                return target
+            return execute
+
+        finish = last.execute
+
+        def execute(thread):
+            for action in actions:
+                action()
+            return finish(thread)
+        return execute
+
+    def __repr__(self):
+        return "BasicBlock<{0} instructions, {1}>".format(self.size, self.last)
@@ -1,11 +1,24 @@
 import os
+import sys
 import tkinter as tk
 import threading
 
-import pymsb.language.abstractsyntaxtrees as ast
 import pymsb.language.errors as errors
 import pymsb.language.modules as modules
+import pymsb.language.programcache as programcache
+import pymsb.language.snapshots as snapshots
+import pymsb.language.values as values
 from pymsb.language.parser import Parser
+from pymsb.language.compiledprogram import CompiledProgram
+from pymsb.language.optimizer import Optimizer
+from pymsb.language.linker import Linker
+from pymsb.language.expressioncompiler import ExpressionCompiler
+from pymsb.language.transpiler import Transpiler
+from pymsb.language.eventdispatcher import EventDispatcher
+from pymsb.language.scheduler import CooperativeScheduler
+from pymsb.language.profiler import Profiler
+from pymsb.language.tracing import TraceHooks
+from pymsb.language.limits import ResourceLimits
 from pymsb.language.arrayparser import ArrayParser
 
 # TODO: address the following differences between MS Small Basic and Py_MSB:
@@ -17,43 +30,235 @@ from pymsb.language.arrayparser import ArrayParser
 
 
 class Interpreter:
-    """This class is used to execute Microsoft Small Basic code."""
-    def __init__(self):
+    """This class is used to execute Microsoft Small Basic code.
+
+    :param backend: Either "interpreter", to execute the program statement by statement in InterpreterThreads, or
+                    "python", to translate the program into Python code first (see transpiler.Transpiler).
+    :param headless: If True, never create a Tk root.  The TextWindow reads and writes plain text streams instead (see
+                     modules.ConsoleTextWindow), and programs that use GraphicsWindow, Desktop or Mouse are rejected
+                     before they run.
+    :param optimize: If True, run the program through optimizer.Optimizer before executing it.
+    :param dump_optimized: If True, print the optimized program to stderr before executing it.
+    :param inline_subroutines: If True (and optimize is True), inline calls to small leaf subroutines inside loops.
+    :param event_policy: What to do with an event that is triggered while its handler is still running; one of
+                         eventdispatcher.EventDispatcher.POLICIES.
+    :param event_workers: The number of threads that run event handlers.
+    :param scheduler: Either "threads", to run the main program and the event handlers in threads of their own, or
+                      "cooperative", to interleave them in a single thread (see scheduler.CooperativeScheduler).  The
+                      cooperative scheduler needs the interpreter backend.
+    :param instruction_budget: With the cooperative scheduler, the number of instructions that the main program or an
+                               event handler runs before the next one gets to run.
+    :param profile: If True, measure how often each statement and built-in function runs and how long it takes; the
+                    results are in self.profiler (see profiler.Profiler) once the program has finished.  Profiling
+                    needs the interpreter backend.
+    :param max_instructions: If not None, stop programs after they have executed about this many instructions.
+    :param max_seconds: If not None, stop programs after they have run for this many seconds.
+    :param max_memory: If not None, stop programs once their variables, stacks and arrays take up more than about this
+                       many bytes.  When a program is stopped because of one of these limits, run() raises an
+                       errors.PyMsbResourceLimitError; see limits.ResourceLimits.  Limits need the interpreter backend.
+    :param cache: If True, cache the compiled programs of source files on disk, in a __pymsbcache__ directory next to
+                  them, so that running them again skips parsing and optimizing them; see programcache.
+    :param cache_dir: If not None, cache every compiled program, even those not read from a file, in this directory
+                      instead.
+    """
+
+    BACKENDS = ("interpreter", "python")
+    SCHEDULERS = ("threads", "cooperative")
+
+    # The built-in objects that need a display, and so are unavailable in headless mode.
+    DISPLAY_OBJECTS = ("GraphicsWindow", "Desktop", "Mouse")
+
+    def __init__(self, backend="interpreter", headless=False, optimize=True, dump_optimized=False,
+                 inline_subroutines=True, event_policy="coalesce", event_workers=4, scheduler="threads",
+                 instruction_budget=1000, profile=False, max_instructions=None, max_seconds=None, max_memory=None,
+                 cache=False, cache_dir=None):
+        if backend not in Interpreter.BACKENDS:
+            raise ValueError("Unknown backend '{0}'; expected one of {1}.".format(backend,
+                                                                                 ", ".join(Interpreter.BACKENDS)))
+        if scheduler not in Interpreter.SCHEDULERS:
+            raise ValueError("Unknown scheduler '{0}'; expected one of {1}.".format(
+                scheduler, ", ".join(Interpreter.SCHEDULERS)))
+        if scheduler == "cooperative" and backend != "interpreter":
+            raise ValueError("The cooperative scheduler needs the interpreter backend.")
+        if profile and backend != "interpreter":
+            raise ValueError("Profiling needs the interpreter backend.")
+        has_limits = not (max_instructions is None and max_seconds is None and max_memory is None)
+        if has_limits and backend != "interpreter":
+            raise ValueError("Resource limits need the interpreter backend.")
+        self.backend = backend
+        self.headless = headless
+        self.optimize = optimize
+        self.dump_optimized = dump_optimized
+        self.cache = cache or cache_dir is not None
+        self.cache_dir = cache_dir
         self.parser = Parser()
+        self.optimizer = Optimizer(inline_subroutines=inline_subroutines)
+        self.event_policy = event_policy
+        self.event_workers = event_workers
+        self.scheduler = scheduler
+        self.instruction_budget = instruction_budget
+        self.profile = profile
+        self.profiler = None
+        self.tracers = []
+        self.__trace_hooks = None
+        self.limits = ResourceLimits(self, max_instructions, max_seconds, max_memory) if has_limits else None
+        self.event_dispatcher = self.__create_event_dispatcher()
+        self.linker = Linker()
+        self.transpiler = Transpiler()
         self.environment = Environment()
         self.current_statement_index = 0
         self.statements = []
+        self.instructions = []
+        self.blocks = []  # self.instructions, grouped into basic blocks
         self.sub_return_locations = []
         self.array_parser = ArrayParser()
 
         self.__program_path = None
+        self.__tk_root = None
+        self.__slice_pending = False
+        self.__exited = False
+        # Set by _exit, to stop every InterpreterThread; each run gets a new one, so that threads still running from an
+        # earlier run (e.g. after Program.End) stop too, rather than changing the variables of the next run.
+        self.program_ended = threading.Event()
+        # Notified whenever a program thread finishes, the EventDispatcher becomes idle or the program exits
+        self.__activity = threading.Condition()
+        self.__running_threads = 0
         self.prog_args = []
-        self.__subroutine_body_locations = {}
-
-    def execute_code(self, code, args=None, program_path=None):
+        self.__python_main = None
+        self.__python_subroutines = {}
+        self.__python_code = None  # the transpiled module, compiled
+        self.__python_namespace = None  # the globals of the transpiled module, for the current run
+        self.msb_objects = {}
+        self.__headless_objects = False  # whether msb_objects can be reset and reused in headless mode
+        self.__loaded = None  # (program, msb_objects) that self.instructions or the Python backend were compiled for
+        self.__program = None  # the CompiledProgram that is running
+        self.__resume_from = None  # the snapshot that the running program was restored from
+
+    def execute_code(self, code, args=None, program_path=None, input_lines=None, output=None):
         """
         Executes the given Microsoft Small Basic code, given as a string.
 
         :param code: The string containing Microsoft Small Basic code.
         :param args: A list of arguments to the Microsoft Small Basic program.
+        :param input_lines: In headless mode, the lines of text that the TextWindow reads, or None to read from stdin.
+        :param output: In headless mode, the file-like object that the TextWindow writes to, or None for stdout.
+        """
+        self.run(self.compile(code, program_path), args, program_path, input_lines, output)
+
+    def compile(self, code, program_path=None):
+        """
+        Parses and optimizes the given Microsoft Small Basic code, so that it can be executed any number of times with
+        run().  If the interpreter caches programs, a program compiled earlier from the same code (and with the same
+        settings) is loaded from the cache instead.
+
+        :param code: The string containing Microsoft Small Basic code.
+        :param program_path: The path of the file that the code was read from, if any, which determines where the
+                             compiled program is cached.
+        :return: A compiledprogram.CompiledProgram instance.
+        :raise errors.PyMsbSyntaxError: The first syntax error in the code, after the parser has printed all of them.
+        """
+        cache_key = cache_path = None
+        if self.cache:
+            cache_key = programcache.cache_key(code, (self.optimize, self.optimizer.inline_subroutines))
+            if cache_key is not None:
+                cache_path = programcache.cache_path(cache_key, program_path, self.cache_dir)
+        if cache_path is not None and not self.dump_optimized:
+            program = programcache.load(cache_path, cache_key)
+            if program is not None:
+                return program
+
+        statements = self.parser.parse(code)
+        if statements is None:
+            raise self.parser.syntax_errors[0]
+        if statements and self.optimize:
+            statements = self.optimizer.optimize(statements)
+            if self.dump_optimized:
+                sys.stderr.write(self.optimizer.dump(statements))
+        program = CompiledProgram(code, statements, self.linker.resolve_variables(statements),
+                                  self.linker.resolve_objects(statements))
+        if cache_path is not None:
+            programcache.save(program, cache_path, cache_key)
+        return program
+
+    def run(self, program, args=None, program_path=None, input_lines=None, output=None):
         """
-        self.__init_tk()
+        Executes a program returned by compile().  In headless mode, running the program that ran last again only
+        resets the variables and the built-in objects, rather than creating them and compiling the program again.
+        If the program exceeds one of the interpreter's resource limits, it is stopped and this raises an
+        errors.PyMsbResourceLimitError.
+
+        :param program: A compiledprogram.CompiledProgram instance.
+        :param args: A list of arguments to the Microsoft Small Basic program.
+        :param input_lines: In headless mode, the lines of text that the TextWindow reads, or None to read from stdin.
+        :param output: In headless mode, the file-like object that the TextWindow writes to, or None for stdout.
+        """
+        if self.headless:
+            self.__check_headless_objects(program)
+            self.__reset_headless(input_lines, output)
+        else:
+            self.__init_tk()
 
         if args is None:
             self.prog_args = []
         else:
             self.prog_args = args
 
-        self.statements = self.parser.parse(code)
+        self.program_ended = threading.Event()
+        self.profiler = Profiler(program.source) if self.profile else None
+        tracers = self.tracers + [self.profiler] if self.profiler is not None else self.tracers
+        self.__trace_hooks = TraceHooks(tracers) if tracers else None
+        self.statements = list(program.statements)
+        self.__program = program
         if self.statements:
-            self.__scan_statements()
+            self.environment.allocate(program.variable_names)
+            self.environment.reset()
             if program_path:
                 self.__program_path = os.path.join(os.path.dirname(program_path), '')  # .join to ensure trailing slash
             else:
                 self.__program_path = ""
-            self.__tk_root.after(1, self.__start_main_thread)
-            self.__tk_root.mainloop()
+            self.__load(program)
+            if self.__resume_from is not None:
+                self.__restore(self.__resume_from)
+            if self.__trace_hooks is not None and self.__trace_hooks.traces("event_dispatched"):
+                self.event_dispatcher.dispatch = self.__trace_hooks.wrap_dispatch(self.event_dispatcher.dispatch)
+            if self.limits is not None:
+                self.limits.start()
+            if self.headless:
+                # Nothing is ever visible, so the program is finished as soon as its threads are
+                self.__start_main_thread()
+                self.wait()
+            else:
+                self.__tk_root.after(1, self.__start_main_thread)
+                self.__tk_root.mainloop()
         self._exit()
+        if self.scheduler != "cooperative":
+            # Threads that were still running when the program ended (e.g. the main program, when an event handler
+            # calls Program.End) stop within a chunk of instructions, or at the next loop iteration with the Python
+            # backend; wait for them, so that they can't change the variables of the next run.  A thread stuck in a
+            # built-in, e.g. waiting for input, isn't waited for.  The cooperative scheduler's frames are simply never
+            # stepped again.
+            with self.__activity:
+                self.__activity.wait_for(self.__is_idle, 1)
+        # Each run has its own event dispatcher, whose workers exit once the program has ended; don't leave them behind
+        self.event_dispatcher.join(1)
+        if self.limits is not None:
+            self.limits.stop()
+            if self.limits.error is not None:
+                raise self.limits.error
+
+    def __load(self, program):
+        # The compiled code refers to the built-in objects, so it can be reused as long as they are; traced programs
+        # are compiled again every time, since the tracers may have changed, and aren't reused by untraced runs.
+        if self.__loaded == (program, self.msb_objects) and self.__trace_hooks is None:
+            if self.backend == "python":
+                self.__exec_python_module()
+            return
+        if self.backend == "python":
+            self.__load_python_backend()
+        else:
+            self.instructions = self.linker.link(self.statements)
+            self.__compile_instructions()
+        self.__loaded = (program, self.msb_objects) if self.__trace_hooks is None else None
 
     def execute_file(self, file_path, args=None):
         """
@@ -66,15 +271,132 @@ class Interpreter:
             code = code_file.read()
             self.execute_code(code, args, code_file.name)
 
+    def snapshot(self):
+        """
+        Returns the complete state of the running program: its variables, the state of the built-in objects (e.g. the
+        contents of Stack and Array, and the Timer), and where the main program and each running event handler are,
+        including their subroutine return stacks.  The snapshot is a dict that can be serialized as JSON (see
+        snapshots.save), and resume() continues the program from it, possibly in another process.
+
+        This can be called from any thread while the program runs, but needs the cooperative scheduler, which is the
+        only one that can stop every part of the program between two instructions.  What windows display is not part
+        of the snapshot.
+        """
+        if self.scheduler != "cooperative":
+            raise ValueError("Snapshots need the cooperative scheduler.")
+        if self.__program is None:
+            raise ValueError("No program has been run yet.")
+        with self.event_dispatcher.lock:
+            return {
+                "version": snapshots.VERSION,
+                "source": self.__program.source,
+                "optimize": self.optimize,
+                "inline_subroutines": self.optimizer.inline_subroutines,
+                "args": list(self.prog_args),
+                "variables": self.environment.variable_bindings,
+                "objects": {obj_name: msb_object._snapshot() for obj_name, msb_object in self.msb_objects.items()},
+                "frames": [{"event": event_name, "index": frame.instruction_index,
+                            "returns": list(frame.sub_return_locations)}
+                           for frame, event_name in self.event_dispatcher.frames],
+            }
+
+    def save_snapshot(self, path):
+        """Writes snapshot() to a compressed file; see snapshots.save."""
+        snapshots.save(self.snapshot(), path)
+
+    def resume(self, snapshot, input_lines=None, output=None):
+        """
+        Continues a program from a snapshot returned by snapshot(), or from the path of a file written by
+        save_snapshot().  The interpreter must use the cooperative scheduler and the same optimization settings as the
+        one that took the snapshot.
+
+        :param input_lines: In headless mode, the lines of text that the TextWindow reads, or None to read from stdin.
+        :param output: In headless mode, the file-like object that the TextWindow writes to, or None for stdout.
+        """
+        if self.scheduler != "cooperative":
+            raise ValueError("Resuming from a snapshot needs the cooperative scheduler.")
+        if isinstance(snapshot, str):
+            snapshot = snapshots.load(snapshot)
+        if (snapshot["optimize"], snapshot["inline_subroutines"]) != (self.optimize, self.optimizer.inline_subroutines):
+            raise ValueError("The snapshot was taken with different optimization settings.")
+        self.__resume_from = snapshot
+        try:
+            self.run(self.compile(snapshot["source"]), snapshot["args"], input_lines=input_lines, output=output)
+        finally:
+            self.__resume_from = None
+
+    def __restore(self, snapshot):
+        for var, val in snapshot["variables"].items():
+            self.environment.bind(var, val)
+        for obj_name, state in snapshot["objects"].items():
+            if obj_name in self.msb_objects:
+                self.msb_objects[obj_name]._restore(state)
+
+    def add_tracer(self, tracer):
+        """
+        Installs a tracing.Tracer, whose hooks are called while the programs executed from now on are running.  Only
+        the interpreter backend supports tracers.
+        """
+        if self.backend != "interpreter":
+            raise ValueError("Tracing needs the interpreter backend.")
+        self.tracers.append(tracer)
+
+    def remove_tracer(self, tracer):
+        """Uninstalls a tracer installed by add_tracer, from the next program that is executed on."""
+        self.tracers.remove(tracer)
+
     @property
     def program_path(self):
         """Returns the path of the directory containing the currently executing script, or the empty string if there is
         no currently executing script or the script is being executed from a string."""
         return self.__program_path
 
+    def __reset_headless(self, input_lines, output):
+        if not self.__headless_objects:
+            self.__init_headless(input_lines, output)
+            return
+        self.__exited = False
+        self.event_dispatcher = self.__create_event_dispatcher()
+        for msb_object in self.msb_objects.values():
+            msb_object._reset()
+        self.msb_objects["TextWindow"].set_streams(input_lines, output)
+        self.__running_threads = 0
+
+    def __init_headless(self, input_lines, output):
+        self.__exited = False
+        self.event_dispatcher = self.__create_event_dispatcher()
+        self.__headless_objects = True
+        self.msb_objects = {
+            "Clock": modules.Clock(self),
+            "Math": modules.Math(self),
+            "TextWindow": modules.ConsoleTextWindow(self, input_lines, output),
+            "Text": modules.Text(self),
+            "Stack": modules.Stack(self),
+            "Network": modules.Network(self),
+            "File": modules.FileModule(self),
+            "Array": modules.Array(self),
+            "Program": modules.Program(self),
+            "Timer": modules.Timer(self),
+        }
+
+        self.__running_threads = 0
+
+    @staticmethod
+    def __check_headless_objects(program):
+        # Fail before anything runs, rather than partway through the program
+        for obj_name, line_number in program.object_lines.items():
+            if obj_name in Interpreter.DISPLAY_OBJECTS:
+                raise errors.PyMsbHeadlessError(line_number, obj_name)
+
     def __init_tk(self):
+        self.__exited = False
+        self.__headless_objects = False
+        self.__slice_pending = False
+        self.event_dispatcher = self.__create_event_dispatcher()
         self.__tk_root = tk.Tk()
         self.__tk_root.withdraw()
+        self.__tk_root.bind("<<ProgramFinished>>", self.__on_program_finished)
+        self.__tk_root.bind("<<SchedulerWake>>", self.__run_slice)
         self.msb_objects = {
             "Clock": modules.Clock(self),
             "Math": modules.Math(self),
@@ -91,299 +413,275 @@ class Interpreter:
             "Mouse": modules.Mouse(self),
         }
 
-        self.__threads = []
-
-    def __scan_statements(self):
-        # Save the line numbers for each subroutine body
-        self.__subroutine_body_locations.clear()
-        for line_number, statement in enumerate(self.statements):
-            if isinstance(statement, ast.SubStatement):
-                self.__subroutine_body_locations[statement.sub_name.lower()] = line_number + 1
-
-    def __start_main_thread(self):
-        p = InterpreterThread(self, 0)
-        self.__threads.append(p)
-        p.start()
-        self.__tk_root.after(1, self.__check_threads_finished)
-
-    def _call_subroutine_in_new_thread(self, sub_name):
-        line_number = self.__subroutine_body_locations[sub_name.lower()]
-        p = InterpreterThread(self, line_number)
-        self.__threads.append(p)
-        p.start()
-
-    def __check_threads_finished(self):
-        for thread in self.__threads[:]:
-            if not thread.is_alive():
-                self.__threads.remove(thread)
-        if not self.__threads:
-            if not (self.msb_objects["GraphicsWindow"].is_visible() or self.msb_objects["TextWindow"].is_visible()):
-                self._exit()
+        self.__running_threads = 0
+
+    def __create_event_dispatcher(self):
+        if self.scheduler == "cooperative":
+            return CooperativeScheduler(lambda sub_name: self._create_frame(sub_name), self.event_policy,
+                                        self.instruction_budget, on_idle=self.__notify_activity,
+                                        wake=self.__wake_scheduler)
+        return EventDispatcher(self._run_subroutine, self.event_policy, self.event_workers,
+                               on_idle=self.__notify_activity)
+
+    def __compile_instructions(self):
+        # Compile every expression once, now that the module objects the expressions refer to exist
+        expression_compiler = ExpressionCompiler(self, self.__trace_hooks)
+        for instruction in self.instructions:
+            expression_compiler.line_number = instruction.line_number
+            instruction.compile(expression_compiler)
+        if self.__trace_hooks is not None:
+            # Tracers see every instruction, so traced programs run them one at a time
+            self.__trace_hooks.instrument(self.instructions, self.linker.subroutine_locations)
+            self.blocks = self.instructions
         else:
-            self.__tk_root.after(100, self.__check_threads_finished)
-
-    def _exit(self, status=None):
-        # TODO: make this able to close all running interpreter threads
-        self.__tk_root.quit()
-        self.__program_path = ""
-
-    def _assign(self, destination_ast, value_ast, line_number=None):
-
-        if isinstance(destination_ast, ast.UserVariable):
-            # Assigning to variable as an array using one or more indices
-            if destination_ast.array_indices:
-                array_string = self.environment.get_variable(destination_ast.variable_name)
-                index_values = [str(self._evaluate_expression_ast(index_ast)) for index_ast in destination_ast.array_indices]
-                value = str(self._evaluate_expression_ast(value_ast))
+            self.blocks = self.linker.build_blocks(self.instructions)
+
+    def __load_python_backend(self):
+        try:
+            source = self.transpiler.transpile(self.statements, self.environment)
+        except errors.PyMsbRuntimeError as e:
+            message = "The Python backend cannot run this program ({0}); using the interpreter backend.\n"
+            sys.stderr.write(message.format(e))
+            self.backend = "interpreter"
+            self.instructions = self.linker.link(self.statements)
+            self.__compile_instructions()
+            return
+
+        self.__python_code = compile(source, "<pymsb {0}>".format(self.__program_path or "code"), "exec")
+        self.__exec_python_module()
+
+    def __exec_python_module(self):
+        # Every run gets its own globals, so that _exit can tell the functions of this run that the program has ended
+        # without a thread still running from an earlier run (e.g. stuck in a built-in) ever seeing it start again
+        namespace = self.__python_namespace = Transpiler.create_namespace(self)
+        exec(self.__python_code, namespace)
+        self.__python_main = namespace["main"]
+        self.__python_subroutines = {name: namespace[function_name]
+                                     for name, function_name in self.transpiler.subroutine_functions.items()}
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the program that is executing has finished, i.e. the main program and any event handlers have run
+        to completion, or Program.End has been called.  Returns immediately if no program is executing.
 
-                # TODO: raise error when trying to assign to a subroutine name or subroutine call.
+        :param timeout: The maximum number of seconds to wait, or None to wait for as long as it takes.
+        :return: True if the program has finished, or False if the timeout expired first.
+        """
+        with self.__activity:
+            return self.__activity.wait_for(self.__is_finished, timeout)
 
-                new_array_string = self.array_parser.set_value(array_string, index_values, value)
-                self.environment.bind(destination_ast.variable_name, new_array_string)
+    def __is_finished(self):
+        return self.__exited or self.__is_idle()
 
-            # Just overwriting variable
-            else:
-                self.environment.bind(destination_ast.variable_name, self._evaluate_expression_ast(value_ast))
+    def __is_idle(self):
+        return self.__running_threads == 0 and self.event_dispatcher.is_idle()
 
-        if isinstance(destination_ast, ast.MsbObjectField):
-            msb_object = self.msb_objects[modules.utilities.capitalize(destination_ast.msb_object)]
-            member_name = modules.utilities.capitalize(destination_ast.msb_object_field_name)
+    def __notify_activity(self):
+        with self.__activity:
+            self.__activity.notify_all()
 
-            # Determine if this is a function or an event
-            info = modules.utilities.get_msb_builtin_info(destination_ast.msb_object, member_name)
-            if info.type == "event":
-                msb_object.set_event_sub(member_name, value_ast.variable_name)
+    def __start_main_thread(self):
+        with self.__activity:
+            self.__running_threads += 1
+        if self.scheduler == "cooperative":
+            self.__start_cooperative_main()
+            return
+        threading.Thread(target=self.__run_main, daemon=True).start()
+        if self.__tk_root is not None:
+            # Wait for the program in another thread, so that the Tk mainloop is free to handle the windows
+            threading.Thread(target=self.__watch_for_completion, daemon=True).start()
+
+    def __run_main(self):
+        try:
+            if self.backend == "python":
+                self.__python_main()
             else:
-                value = str(self._evaluate_expression_ast(value_ast))
-                setattr(msb_object,
-                        member_name,
-                        value)
-
-    def _increment_value(self, var_ast):
-        # Increments the variable that has the given name by 1.  If not defined, this defines var_name to be 1.
-        if isinstance(var_ast, ast.UserVariable):
-            val = self._evaluate_operation("+", var_ast, ast.LiteralValue(1))
-            self.environment.bind(var_ast.variable_name, val)
+                InterpreterThread(self, 0).run()
+        except errors.PyMsbProgramEnded:
+            pass
+        finally:
+            with self.__activity:
+                self.__running_threads -= 1
+                self.__activity.notify_all()
+
+    def __start_cooperative_main(self):
+        # The main program is just the first frame; it no longer counts as a running thread once the scheduler has it
+        if self.__resume_from is None:
+            self.event_dispatcher.add_frame(InterpreterThread(self, 0))
+        else:
+            for frame_state in self.__resume_from["frames"]:
+                frame = InterpreterThread(self, frame_state["index"])
+                frame.sub_return_locations = list(frame_state["returns"])
+                self.event_dispatcher.add_frame(frame, frame_state["event"])
+        with self.__activity:
+            self.__running_threads -= 1
+        if self.__tk_root is None:
+            self.event_dispatcher.run()
         else:
-            raise errors.PyMsbRuntimeError(
-                "Internal error - tried to increment non-UserVariable in Interpreter.increment_value")
-
-    def _evaluate_comparison_ast(self, val_ast):
-        # Important - returns "True" or "False" if this is actually a comparison
-        # Otherwise, evaluates as an expression and returns the string result (e.g. "10" or "concatstr" or even "true")
-        if isinstance(val_ast, ast.Comparison):
-            return self._evaluate_comparison(val_ast.comparator, val_ast.left, val_ast.right)
-        return self._evaluate_expression_ast(val_ast)
-
-    def _evaluate_expression_ast(self, val_ast):
-        if isinstance(val_ast, ast.LiteralValue):
-            return val_ast.value  # always a string
-
-        if isinstance(val_ast, ast.UserVariable):
-            value = self.environment.get_variable(val_ast.variable_name)
-
-            # If accessing variable as an array
-            if val_ast.array_indices:
-                index_values = [str(self._evaluate_expression_ast(i)) for i in val_ast.array_indices]
-                return self.array_parser.get_value(value, index_values)
-
-            # Just accessing variable
-            return value
-
-        if isinstance(val_ast, ast.MsbObjectField):
-            return self._evaluate_object_field(val_ast.msb_object, val_ast.msb_object_field_name)
-
-        if isinstance(val_ast, ast.Operation):
-            return self._evaluate_operation(val_ast.operator, val_ast.left, val_ast.right)
-
-        if isinstance(val_ast, ast.MsbObjectFunctionCall):
-            return self._execute_function_call(val_ast.msb_object,
-                                              val_ast.msb_object_function,
-                                              val_ast.parameter_asts)
-
-        raise NotImplementedError(val_ast)
-
-    def _execute_function_call(self, obj_name, fn_name, arg_asts):
-        arg_vals = [str(self._evaluate_expression_ast(arg_ast)) for arg_ast in arg_asts]
-        fn = getattr(self.msb_objects[modules.utilities.capitalize(obj_name)], modules.utilities.capitalize(fn_name))
-        return fn.__call__(*arg_vals)
-
-    def _evaluate_object_field(self, obj_name, field_name):
-        return getattr(self.msb_objects[modules.utilities.capitalize(obj_name)], modules.utilities.capitalize(field_name))
-
-    def _evaluate_comparison(self, comp, left, right):
-        # returns "True" or "False" - VERY IMPORTANT NOTE: returns the strings and not boolean values.
-        # possible comp values are strings "<=", ">=", "<", ">", "<>", "="
-        # left, right are asts
-
-        left = self._evaluate_comparison_ast(left)
-        right = self._evaluate_comparison_ast(right)
-        if comp == "=":
-            return str(left == right)
-        if comp == "<>":
-            return str(left != right)
-        if comp.lower() == "and":
-            return str(str(left).lower() == "true" and str(right).lower() == "true")
-        if comp.lower() == "or":
-            return str(str(left).lower() == "true" or str(right).lower() == "true")
-
-        # At this point, anything that is non-numerical is treated like 0
-        left = modules.utilities.numericize(left, True)
-        right = modules.utilities.numericize(right, True)
-
-        return str(((comp == "<" and left < right) or
-                    (comp == "<=" and left <= right) or
-                    (comp == ">" and left > right) or
-                    (comp == ">=" and left >= right)))
-
-    # FIXME: fix this so ("x is " + "00") returns "x is 00" and not "x is 0"
-    def _evaluate_operation(self, op, left, right):
-        # op is "+", "-", "*" or "/"
-        # left, right are expression asts
-        left = self._evaluate_expression_ast(left)
-        if isinstance(left, str):
-            left = modules.utilities.numericize(left, op != "+")
-        right = self._evaluate_expression_ast(right)
-        if isinstance(right, str):
-            right = modules.utilities.numericize(right, op != "+")
-
-        if op == "+":
+            # Tk calls must stay in the thread running the mainloop, so the frames run in slices between Tk events
+            threading.Thread(target=self.__watch_for_completion, daemon=True).start()
+            self.__run_slice()
+
+    def __wake_scheduler(self):
+        # May be called from any thread, e.g. by the Timer
+        if self.__tk_root is not None and not self.__exited:
+            self.__tk_root.event_generate("<<SchedulerWake>>", when="tail")
+
+    def __run_slice(self, event=None):
+        self.__slice_pending = False
+        if self.event_dispatcher.step() and not self.__slice_pending:
+            # Let Tk handle its own events before the next slice
+            self.__slice_pending = True
+            self.__tk_root.after(0, self.__run_slice)
+
+    def __watch_for_completion(self):
+        self.wait()
+        if not self.__exited:
+            # Tk isn't thread-safe, so let the mainloop handle this like any other event
+            self.__tk_root.event_generate("<<ProgramFinished>>", when="tail")
+
+    def _create_frame(self, sub_name):
+        # Creates a frame that runs a subroutine when scheduled; the CooperativeScheduler calls this for events.
+        frame = InterpreterThread(self, self.linker.subroutine_locations[sub_name.lower()])
+        self.__trace_subroutine_enter(frame, sub_name)
+        return frame
+
+    def _run_subroutine(self, sub_name):
+        # Runs a subroutine to completion in the calling thread; the EventDispatcher calls this from its workers.
+        if self.backend == "python":
             try:
-                return str(left + right)
-            except TypeError:
-                return str(left) + str(right)
+                self.__python_subroutines[sub_name.lower()]()
+            except errors.PyMsbProgramEnded:
+                pass
+        else:
+            thread = InterpreterThread(self, self.linker.subroutine_locations[sub_name.lower()])
+            self.__trace_subroutine_enter(thread, sub_name)
+            thread.run()
 
-        if op == "-":
-            return left - right
-        if op == "*":
-            return left * right
-        if op == "/":
-            return left / right
+    def __trace_subroutine_enter(self, thread, sub_name):
+        # Calls to subroutines are traced by their CallSubroutine instructions, but event handlers are just started
+        if self.__trace_hooks is not None and self.__trace_hooks.subroutine_enter is not None:
+            self.__trace_hooks.subroutine_enter(thread, sub_name.lower())
+
+    def __on_program_finished(self, event):
+        # The program's threads have finished; keep running while a window is open, since it is closing the window
+        # that exits the interpreter then.
+        if not (self.msb_objects["GraphicsWindow"].is_visible() or self.msb_objects["TextWindow"].is_visible()):
+            self._exit()
+
+    def _exit(self, status=None):
+        # Every InterpreterThread stops the next time it checks program_ended, and transpiled code at the next iteration
+        # of a loop; the thread that called Program.End stops right away, when End raises errors.PyMsbProgramEnded
+        self.program_ended.set()
+        if self.__python_namespace is not None:
+            self.__python_namespace["_ended"] = True
+        self.event_dispatcher.stop()
+        if "Timer" in self.msb_objects:
+            self.msb_objects["Timer"].Pause()  # otherwise it keeps re-arming itself, and triggering Tick for nothing
+        with self.__activity:
+            self.__exited = True
+            self.__activity.notify_all()
+        if self.__tk_root is not None:
+            self.__tk_root.quit()
+        self.__program_path = ""
 
 
 class Environment:
+    """
+    Stores the values of Microsoft Small Basic variables.  Each distinct (case-insensitive) variable name is resolved to
+    an integer slot once, before the program runs, and the values live in the preallocated list self.variables, so that
+    compiled code can read and write a variable by its slot without hashing or lowercasing its name.
+    """
     def __init__(self):
-        self.variable_bindings = {}
+        self.variables = []  # the value of each slot; this list is never replaced, only mutated
+        self.variable_names = []  # the lowercase name of each slot, for debugging and introspection
+        self.variable_slots = {}  # maps lowercase names to slots
+
+    def allocate(self, variable_names):
+        """Allocates a slot, initially holding the empty string, for each given variable name that has none yet."""
+        for var in variable_names:
+            self.slot(var)
+
+    def slot(self, var):
+        """Returns the slot of the given variable name, allocating it if necessary."""
+        name = var.lower()
+        slot = self.variable_slots.get(name)
+        if slot is None:
+            slot = self.variable_slots[name] = len(self.variables)
+            self.variable_names.append(name)
+            self.variables.append("")
+        return slot
+
+    @property
+    def variable_bindings(self):
+        """Returns a new dict mapping each lowercase variable name to its value, with any Rope joined into text."""
+        return {name: values.to_text(value) if type(value) is values.Rope else value
+                for name, value in zip(self.variable_names, self.variables)}
+
+    def reset(self):
+        """Sets every variable back to the empty string, keeping the slots."""
+        self.variables[:] = [""] * len(self.variables)
 
     def bind(self, var, val):
-        self.variable_bindings[var.lower()] = val
+        self.variables[self.slot(var)] = val
 
     def get_variable(self, var):
-        return self.variable_bindings.setdefault(var.lower(), "")
+        return self.variables[self.slot(var)]
 
 
-# noinspection PyProtectedMember
 class InterpreterThread(threading.Thread):
-    def __init__(self, interpreter, line_number):
+    def __init__(self, interpreter, instruction_index):
         super().__init__()
         self.interpreter = interpreter
         self.environment = interpreter.environment
-        self.statements = interpreter.statements
+        self.instructions = interpreter.instructions
+        self.blocks = interpreter.blocks
 
-        self.line_number = line_number
-        self.sub_return_locations = [len(self.statements)]  # for handling subroutine calls
+        self.instruction_index = instruction_index
+        self.sub_return_locations = [len(self.instructions)]  # for handling subroutine calls
+        self.limits = interpreter.limits
+        self.program_ended = interpreter.program_ended
 
         self.daemon = True  # auto-exit when interpreter exits and main thread ends
 
     def run(self):
-        while self.line_number is not None and 0 <= self.line_number < len(self.statements):
-            self.execute_next_instruction()
-
-    def execute_next_instruction(self):
-        statement = self.statements[self.line_number]
-        # time.sleep(0.1)  # TODO: remove this, it's just an artificial slow-down
-
-        if isinstance(statement, ast.Assignment):
-            self.interpreter._assign(statement.var, statement.val, statement.line_number)
-
-        elif isinstance(statement, ast.MsbObjectFunctionCall):
-            self.interpreter._execute_function_call(statement.msb_object,
-                                                   statement.msb_object_function,
-                                                   statement.parameter_asts)
-
-        elif isinstance(statement, ast.SubStatement):
-            while not isinstance(self.statements[self.line_number], ast.EndSubStatement):
-                self.line_number += 1
-
-        elif isinstance(statement, ast.SubroutineCall):
-            # Save the current line number, temporarily jump to the body of the called subroutine.
-            self.sub_return_locations.append(self.line_number)
-            self.line_number = self.statements.index(statement.jump_target)
-
-        elif isinstance(statement, ast.EndSubStatement):
-            # Return to where we were before calling the subroutine.
-            # The first value in sub_return_locations is past the end of the program, so
-            # if we call a subroutine as, say, part of Timer.Tick, the subroutine ending will terminate that
-            # particular thread.
-            self.line_number = self.sub_return_locations.pop()
-
-        elif isinstance(statement, ast.IfStatement):
-            # If we have just reached an If, then check each branch of this if/elseif/else block until we
-            # find a valid If/ElseIf branch or we reach Else/EndIf
-            if statement.keyword == "If":
-                while statement.keyword != "EndIf":
-                    if statement.condition_expr is not None:
-                        cond_val = self.interpreter._evaluate_comparison_ast(statement.condition_expr).lower() == "true"
-                    else:
-                        cond_val = True
-                    if cond_val:
-                        break  # let the interpreter continue on to the next line
-                    else:
-                        # Check the next branch
-                        while self.statements[self.line_number] != statement.jump_target:
-                            self.line_number += 1
-                        statement = self.statements[self.line_number]
-            else:
-                # We have just finished an If/ElseIf block and have reached an ElseIf/Else block
-                # Skip until reaching the EndIf
-                while statement.keyword != "EndIf":
-                    target = statement.jump_target
-                    if target is None:
-                        raise errors.PyMsbRuntimeError("Fatal error: " + repr(statement) + " has no jump target")
-                    while self.statements[self.line_number] != target:
-                        self.line_number += 1
-                    statement = self.statements[self.line_number]
-
-        elif isinstance(statement, ast.EndIfStatement):
+        # Run in chunks, so that resource limits (if any) are only charged, and whether the program has ended is only
+        # checked, every so many instructions
+        chunk_size = self.limits.check_interval if self.limits is not None else 1000
+        while not self.run_for(chunk_size):
             pass
 
-        elif isinstance(statement, ast.ForStatement):
-            # When we reach ForStatement, set the loop variable to the lower expression.
-            # Do a one-time check if loop variable is greater than the upper expression.
-            # Then advance; the matching EndForStatement handles the rest of the loop logic.
-            self.interpreter._assign(statement.var_ast, statement.lower_expr)
-            if self.interpreter._evaluate_comparison(">", statement.var_ast, statement.upper_expr) == "True":
-                print("var: " + repr(statement.var_ast) + " is greater than " + repr(statement.upper_expr))
-                self.line_number = self.statements.index(statement.jump_target)
-
-        elif isinstance(statement, ast.EndForStatement):
-            # When we reach EndForStatement, we always increment the variable.
-            # If loop variable is greater than upper expression, advance to next line.  We always reevaluate upper expr.
-            # Otherwise, increment loop variable and go to line immediately after the corresponding ForStatement
-            for_ast = statement.jump_target
-            self.interpreter._increment_value(for_ast.var_ast)
-            if self.interpreter._evaluate_comparison(">", for_ast.var_ast, for_ast.upper_expr) == "True":
-                pass
-            else:
-                self.line_number = self.statements.index(for_ast)  # line number gets incremented again after
-
-        elif isinstance(statement, ast.WhileStatement):
-            # If the expression evaluates to "true", continue execution, otherwise skip past EndWhile
-            if self.interpreter._evaluate_comparison_ast(statement.condition_expr).lower() == "true":
-                pass
-            else:
-                self.line_number = self.statements.index(statement.jump_target)
-
-        elif isinstance(statement, ast.EndWhileStatement):
-            # Jump back to the While
-            self.line_number = self.statements.index(statement.jump_target)-1
-
-        elif isinstance(statement, ast.LabelDefinition): pass  # all labels were parsed earlier
-
-        elif isinstance(statement, ast.GotoStatement):
-            self.line_number = self.statements.index(statement.jump_target)
+    def run_for(self, budget):
+        """
+        Executes about budget instructions, so that the CooperativeScheduler can interleave this with other frames.
+        Whole basic blocks are executed at a time, so this may overrun budget by the length of the last block.
 
-        else:
-            raise NotImplementedError(repr(statement))
+        :return: True if this has finished, or False if it has been suspended and should be resumed later.
+        """
+        if self.program_ended.is_set():
+            self.instruction_index = None  # stopped by Program.End, or by the end of the run
+            return True
+        blocks = self.blocks
+        end = len(blocks)
+        index = self.instruction_index
+        executed = 0
+        try:
+            while executed < budget:
+                if index is None or not 0 <= index < end:
+                    return True
+                block = blocks[index]
+                index = self.instruction_index = block.execute(self)
+                executed += block.size
+        except errors.PyMsbProgramEnded:
+            self.instruction_index = None
+            return True
+        if index is None or not 0 <= index < end:
+            return True
+        if self.limits is not None and not self.limits.charge(executed):
+            self.instruction_index = None  # stopped by a resource limit
+            return True
+        return False
 
-        self.line_number += 1
+    def execute_next_instruction(self):
+        # Every instruction carries its own jump targets, so executing it yields the next index directly.
+        self.instruction_index = self.instructions[self.instruction_index].execute(self)
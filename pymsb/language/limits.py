@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pymsb.language.errors as errors
+import pymsb.language.values as values
+
+
+class ResourceLimits:
+    """
+    Limits the number of instructions that a program executes, how long it runs and how much memory its variables,
+    stacks and arrays take up.  An InterpreterThread charges the limits for the instructions it executes every
+    check_interval instructions, rather than checking them before every instruction, so limits are enforced
+    approximately, and cost next to nothing.
+
+    Measuring memory means going through every value, so after each measurement, memory isn't measured again until the
+    program has executed a quarter as many instructions as there were values: that keeps the cost of measuring in
+    proportion to the instructions executed, however much data the program holds, while a program that adds a value
+    with every instruction can only overshoot the memory limit by about a quarter.
+
+    When a limit is exceeded, self.error is set to an errors.PyMsbResourceLimitError, every InterpreterThread stops the
+    next time it charges the limits, and the interpreter exits.  The time limit is also enforced while the program is
+    waiting, e.g. for input or for events.
+
+    :param max_instructions: The maximum number of instructions to execute, or None.
+    :param max_seconds: The maximum number of seconds that the program may run for, or None.
+    :param max_memory: The maximum number of bytes that the values of variables and the contents of Stack and Array may
+                       take up, counting one byte per character of text and eight per number, or None.
+    :param check_interval: How many instructions a thread executes between charging the limits.
+    """
+
+    def __init__(self, interpreter, max_instructions=None, max_seconds=None, max_memory=None, check_interval=1000):
+        self.interpreter = interpreter
+        self.max_instructions = max_instructions
+        self.max_seconds = max_seconds
+        self.max_memory = max_memory
+        self.check_interval = check_interval
+
+        self.instructions = 0
+        self.error = None
+        self.__next_memory_check = 0  # the number of instructions at which memory is measured next
+        self.__deadline = None
+        self.__timer = None
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """Resets the usage, at the start of a run."""
+        self.instructions = 0
+        self.error = None
+        self.__next_memory_check = 0
+        if self.max_seconds is not None:
+            self.__deadline = time.perf_counter() + self.max_seconds
+            self.__timer = threading.Timer(self.max_seconds, self.__check_time)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def stop(self):
+        """Stops enforcing the time limit, at the end of a run."""
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def charge(self, instructions):
+        """
+        Records that a thread has executed the given number of instructions, and checks the limits.
+
+        :return: False if the program has exceeded a limit and the thread should stop, True otherwise.
+        """
+        with self.__lock:
+            if self.error is not None:
+                return False
+            self.instructions += instructions
+            if self.max_instructions is not None and self.instructions > self.max_instructions:
+                self.error = errors.PyMsbResourceLimitError("instructions", self.max_instructions, self.instructions)
+            elif self.__deadline is not None and time.perf_counter() > self.__deadline:
+                elapsed = self.max_seconds + time.perf_counter() - self.__deadline
+                self.error = errors.PyMsbResourceLimitError("seconds", self.max_seconds, round(elapsed, 3))
+            elif self.max_memory is not None and self.instructions >= self.__next_memory_check:
+                memory, count = self.__measure_memory()
+                self.__next_memory_check = self.instructions + count // 4
+                if memory > self.max_memory:
+                    self.error = errors.PyMsbResourceLimitError("memory", self.max_memory, memory)
+            if self.error is None:
+                return True
+        self.interpreter._exit()
+        return False
+
+    def memory_usage(self):
+        """Returns the approximate number of bytes taken up by the values of variables, stacks and arrays."""
+        return self.__measure_memory()[0]
+
+    def __measure_memory(self):
+        # Returns the memory usage, and the number of values that were measured to find it
+        variables = self.interpreter.environment.variables
+        usage = sum(map(self.__size, variables))
+        count = len(variables)
+        msb_objects = self.interpreter.msb_objects
+        if "Stack" in msb_objects:
+            for stack in msb_objects["Stack"].stacks.values():
+                usage += sum(map(self.__size, stack))
+                count += len(stack)
+        if "Array" in msb_objects:
+            for array in msb_objects["Array"].internal_arrays.values():
+                usage += sum(map(self.__size, array)) + sum(map(self.__size, array.values()))
+                count += 2 * len(array)
+        return usage, count
+
+    @staticmethod
+    def __size(value):
+        return len(value) if isinstance(value, (str, values.Rope)) else 8
+
+    def __check_time(self):
+        # Ends the program even if it isn't executing anything right now, e.g. while it waits for input or events
+        with self.__lock:
+            if self.error is not None:
+                return
+            self.error = errors.PyMsbResourceLimitError("seconds", self.max_seconds, self.max_seconds)
+        self.interpreter._exit()
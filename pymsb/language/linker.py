@@ -0,0 +1,221 @@
+import pymsb.language.abstractsyntaxtrees as ast
+import pymsb.language.errors as errors
+import pymsb.language.instructions as instructions
+from pymsb.language.modules import utilities
+
+
+class Linker:
+    """
+    The Linker converts the list of statement ASTs produced by the Parser into a flat list of instructions for the
+    InterpreterThread, resolving every Goto, subroutine call and block boundary to an integer index in that list.
+    """
+
+    def __init__(self):
+        self.instructions = []
+        self.subroutine_locations = {}
+
+    def link(self, statements):
+        """
+        Consumes a list of statement ASTs, as returned by Parser.parse, and returns the list of instructions that
+        executes them.  After linking, self.subroutine_locations maps each lowercase subroutine name to the index of the
+        first instruction of its body.
+
+        :param statements: A list of abstractsyntaxtrees.Statement instances.
+        :return: A list of instructions.Instruction instances.
+        """
+        self.instructions = []
+        self.subroutine_locations = {}
+
+        # The index of the first instruction emitted for each statement, and the index after its last instruction.
+        starts = {}
+        ends = {}
+        # The index that an If/ElseIf/Else branch test starts at, when the previous branch's condition is false.
+        branch_entries = {}
+        # Pairs of (instruction, function) where function computes the instruction's target once all indices are known.
+        fixups = []
+        # Maps each SubStatement to its EndSubStatement; subroutines cannot be nested.
+        end_subs = {}
+        open_sub = None
+
+        for statement in statements:
+            starts[statement] = len(self.instructions)
+
+            if isinstance(statement, (ast.Assignment, ast.MsbObjectFunctionCall)):
+                self.__emit(instructions.ExecuteStatement(statement, len(self.instructions)))
+
+            elif isinstance(statement, ast.LabelDefinition):
+                pass  # labels are resolved to the index of the instruction that follows them
+
+            elif isinstance(statement, ast.GotoStatement):
+                instruction = self.__emit(instructions.Jump(statement))
+                fixups.append((instruction, lambda s=statement: starts[s.jump_target]))
+
+            elif isinstance(statement, ast.SubStatement):
+                # Reaching a subroutine definition in the normal flow of the program skips over its body
+                instruction = self.__emit(instructions.Jump(statement))
+                fixups.append((instruction, lambda s=statement: ends[end_subs[s]]))
+                open_sub = statement
+                self.subroutine_locations[statement.sub_name.lower()] = len(self.instructions)
+
+            elif isinstance(statement, ast.EndSubStatement):
+                self.__emit(instructions.ReturnFromSubroutine(statement))
+                end_subs[open_sub] = statement
+
+            elif isinstance(statement, ast.SubroutineCall):
+                instruction = self.__emit(instructions.CallSubroutine(statement, len(self.instructions)))
+                fixups.append((instruction, lambda s=statement: ends[s.jump_target]))
+
+            elif isinstance(statement, ast.IfStatement):
+                if statement.keyword != "If":
+                    # Reaching ElseIf/Else means the previous branch was taken and has finished, so skip to EndIf
+                    instruction = self.__emit(instructions.Jump(statement))
+                    fixups.append((instruction, lambda s=statement: starts[self.__find_end_if(s)]))
+                branch_entries[statement] = len(self.instructions)
+                if statement.condition_expr is not None:
+                    instruction = self.__emit(instructions.JumpIfFalse(statement, len(self.instructions),
+                                                                       statement.condition_expr))
+                    fixups.append((instruction, lambda s=statement: branch_entries.get(s.jump_target,
+                                                                                       starts[s.jump_target])))
+
+            elif isinstance(statement, ast.EndIfStatement):
+                pass  # jumps to EndIf are resolved to the index of the instruction that follows it
+
+            elif isinstance(statement, ast.ForStatement):
+                instruction = self.__emit(instructions.ForInit(statement, len(self.instructions)))
+                fixups.append((instruction, lambda s=statement: ends[s.jump_target]))
+
+            elif isinstance(statement, ast.EndForStatement):
+                instruction = self.__emit(instructions.ForStep(statement, statement.jump_target,
+                                                               len(self.instructions)))
+                fixups.append((instruction, lambda s=statement: ends[s.jump_target]))
+
+            elif isinstance(statement, ast.WhileStatement):
+                instruction = self.__emit(instructions.JumpIfFalse(statement, len(self.instructions),
+                                                                   statement.condition_expr))
+                fixups.append((instruction, lambda s=statement: ends[s.jump_target]))
+
+            elif isinstance(statement, ast.EndWhileStatement):
+                instruction = self.__emit(instructions.Jump(statement))
+                fixups.append((instruction, lambda s=statement: starts[s.jump_target]))
+
+            else:
+                raise NotImplementedError(repr(statement))
+
+            ends[statement] = len(self.instructions)
+
+        for instruction, find_target in fixups:
+            instruction.target = find_target()
+
+        return self.instructions
+
+    def build_blocks(self, program_instructions):
+        """
+        Groups the (compiled) instructions returned by link into instructions.BasicBlocks, which start at the first
+        instruction, at every jump target and subroutine body, and after every instruction that isn't an
+        ExecuteStatement.
+
+        :return: A list that is like program_instructions, except that the instruction that starts each block is
+                 replaced by the BasicBlock, unless the block is a single instruction that gains nothing from it.  The
+                 other instructions are kept, so that the program can still be resumed at any index, e.g. from a
+                 snapshot.
+        """
+        leaders = {0}
+        leaders.update(self.subroutine_locations.values())
+        for index, instruction in enumerate(program_instructions):
+            if not isinstance(instruction, instructions.ExecuteStatement):
+                leaders.add(index + 1)
+                if getattr(instruction, "target", None) is not None:
+                    leaders.add(instruction.target)
+
+        blocks = list(program_instructions)
+        for start in leaders:
+            if start >= len(program_instructions):
+                continue
+            end = start
+            while end < len(program_instructions) - 1 and end + 1 not in leaders and \
+                    isinstance(program_instructions[end], instructions.ExecuteStatement):
+                end += 1
+            # A block of one instruction is only worth it if it can skip jumps
+            if end > start or isinstance(program_instructions[end], (instructions.Jump, instructions.JumpIfFalse)):
+                blocks[start] = instructions.BasicBlock(program_instructions, start, end)
+        return blocks
+
+    def __emit(self, instruction):
+        self.instructions.append(instruction)
+        return instruction
+
+    @staticmethod
+    def __find_end_if(if_statement):
+        # Follow the chain of If/ElseIf/Else branches to the EndIf that closes them
+        statement = if_statement
+        while not isinstance(statement, ast.EndIfStatement):
+            statement = statement.jump_target
+            if statement is None:
+                raise errors.PyMsbRuntimeError("Fatal error: " + repr(if_statement) + " has no jump target")
+        return statement
+
+    def resolve_variables(self, statements):
+        """
+        Returns the distinct lowercase names of the variables used by the given statements, in order of first use, so
+        that they can be allocated slots before the program runs.
+
+        :param statements: A list of abstractsyntaxtrees.Statement instances.
+        :return: A list of lowercase variable names.
+        """
+        names = {}  # used as an ordered set
+        for statement in statements:
+            for expr_ast in self.__statement_expressions(statement):
+                self.__collect_variables(expr_ast, names)
+        return list(names)
+
+    def resolve_objects(self, statements):
+        """
+        Returns the built-in objects used by the given statements, so that a program that uses an object which is not
+        available (e.g. GraphicsWindow in headless mode) can be rejected before it runs.
+
+        :param statements: A list of abstractsyntaxtrees.Statement instances.
+        :return: A dict mapping each properly-capitalized object name to the line number where it is first used.
+        """
+        objects = {}
+        for statement in statements:
+            for expr_ast in self.__statement_expressions(statement):
+                self.__collect_objects(expr_ast, statement.line_number, objects)
+        return objects
+
+    def __statement_expressions(self, statement):
+        # Returns the top-level expression ASTs in a statement
+        if isinstance(statement, ast.Assignment):
+            return statement.var, statement.val
+        if isinstance(statement, ast.MsbObjectFunctionCall):
+            return statement,
+        if isinstance(statement, (ast.IfStatement, ast.WhileStatement)):
+            return statement.condition_expr,
+        if isinstance(statement, ast.ForStatement):
+            return statement.var_ast, statement.lower_expr, statement.upper_expr
+        return ()
+
+    @staticmethod
+    def __walk(expr_ast):
+        # Yields the expression and the expressions in it, in the order they are written.  This keeps a stack rather
+        # than recursing, since a formula with hundreds of terms is an Operation nested hundreds deep.
+        pending = [expr_ast]
+        while pending:
+            expr_ast = pending.pop()
+            yield expr_ast
+            if isinstance(expr_ast, ast.UserVariable):
+                pending.extend(reversed(expr_ast.array_indices))
+            elif isinstance(expr_ast, (ast.Operation, ast.Comparison)):
+                pending.append(expr_ast.right)
+                pending.append(expr_ast.left)
+            elif isinstance(expr_ast, ast.MsbObjectFunctionCall):
+                pending.extend(reversed(expr_ast.parameter_asts))
+
+    def __collect_variables(self, expr_ast, names):
+        for sub_ast in self.__walk(expr_ast):
+            if isinstance(sub_ast, ast.UserVariable):
+                names[sub_ast.variable_name.lower()] = None
+
+    def __collect_objects(self, expr_ast, line_number, objects):
+        for sub_ast in self.__walk(expr_ast):
+            if isinstance(sub_ast, (ast.MsbObjectField, ast.MsbObjectFunctionCall)):
+                objects.setdefault(utilities.capitalize(sub_ast.msb_object) or sub_ast.msb_object, line_number)
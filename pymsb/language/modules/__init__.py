@@ -2,6 +2,7 @@ from pymsb.language.modules.pymsbmodule import PyMsbModule
 from pymsb.language.modules import utilities
 from pymsb.language.modules.clock import Clock
 from pymsb.language.modules.textwindow import TextWindow
+from pymsb.language.modules.consoletextwindow import ConsoleTextWindow
 from pymsb.language.modules.graphicswindow import GraphicsWindow
 from pymsb.language.modules.math import Math
 from pymsb.language.modules.text import Text
@@ -16,6 +16,19 @@ class Array(PyMsbModule):
         # For GetValue, RemoveValue and SetValue.
         self.internal_arrays = {}
 
+    def _reset(self):
+        super()._reset()
+        self.internal_arrays.clear()
+
+    def _snapshot(self):
+        state = super()._snapshot()
+        state["arrays"] = {array_name: dict(values) for array_name, values in self.internal_arrays.items()}
+        return state
+
+    def _restore(self, state):
+        super()._restore(state)
+        self.internal_arrays.update((array_name, dict(values)) for array_name, values in state["arrays"].items())
+
     def ContainsIndex(self, array, index):
         return str(self.array_parser.contains_index(array, index))
 
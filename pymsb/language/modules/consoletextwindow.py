@@ -0,0 +1,176 @@
+import sys
+import threading
+from pymsb.language.modules import utilities as py_msb_utils
+from pymsb.language.modules.pymsbmodule import PyMsbModule
+
+
+# noinspection PyAttributeOutsideInit,PyPep8Naming
+class ConsoleTextWindow(PyMsbModule):
+    """
+    The TextWindow used in headless mode.  Output is written to a file-like object instead of a Tk window, and input
+    is read from a list of lines, or from stdin.  Nothing is ever visible, so e.g. PauseIfVisible does nothing.
+
+    :param input_lines: An iterable of the lines of text to read, or None to read from sys.stdin.  Scripted input lines
+                        are echoed to the output, the way the Tk TextWindow echoes what the user types.
+    :param output: A file-like object to write to, or None to write to sys.stdout.
+    """
+
+    def __init__(self, interpreter, input_lines=None, output=None):
+        super().__init__(interpreter)
+        self.__lock = threading.Lock()
+        colors = py_msb_utils.get_textwindow_colors()
+        self.__default_colors = colors["black"], colors["gray"]  # looked up once, since _reset is called for every run
+        self.set_streams(input_lines, output)
+        self._reset()
+
+    def set_streams(self, input_lines=None, output=None):
+        """Makes the TextWindow read from and write to other streams; see the class docstring for the parameters."""
+        self.__echo_input = input_lines is not None
+        self.__input = iter(sys.stdin if input_lines is None else input_lines)
+        self.__input_exhausted = False
+        self.__output = sys.stdout if output is None else output
+
+    def _reset(self):
+        super()._reset()
+        self.__background_color, self.__foreground_color = self.__default_colors
+        self.__title = "Microsoft Small Basic Text Window"
+        self.__cursor_left = 0
+        self.__cursor_top = 0
+
+    def _snapshot(self):
+        state = super()._snapshot()
+        state.update(title=self.__title, background_color=self.__background_color,
+                     foreground_color=self.__foreground_color, cursor=[self.__cursor_left, self.__cursor_top])
+        return state
+
+    def _restore(self, state):
+        super()._restore(state)
+        self.__title = state["title"]
+        self.__background_color = state["background_color"]
+        self.__foreground_color = state["foreground_color"]
+        self.__cursor_left, self.__cursor_top = state["cursor"]
+
+    def is_visible(self):
+        return False
+
+    def Show(self):
+        pass
+
+    def Hide(self):
+        pass
+
+    @property
+    def Title(self):
+        return self.__title
+
+    @Title.setter
+    def Title(self, title):
+        self.__title = title
+
+    @property
+    def Left(self):
+        return "0"
+
+    @Left.setter
+    def Left(self, left):
+        pass
+
+    @property
+    def Top(self):
+        return "0"
+
+    @Top.setter
+    def Top(self, top):
+        pass
+
+    @property
+    def BackgroundColor(self):
+        return self.__color_name(self.__background_color)
+
+    @BackgroundColor.setter
+    def BackgroundColor(self, background_color):
+        self.__background_color = py_msb_utils.translate_textwindow_color(background_color,
+                                                                          self.__background_color).upper()
+
+    @property
+    def ForegroundColor(self):
+        return self.__color_name(self.__foreground_color)
+
+    @ForegroundColor.setter
+    def ForegroundColor(self, foreground_color):
+        self.__foreground_color = py_msb_utils.translate_textwindow_color(foreground_color,
+                                                                          self.__foreground_color).upper()
+
+    def __color_name(self, code):
+        for key, val in py_msb_utils.get_textwindow_colors().items():
+            if code == val:
+                return py_msb_utils.capitalize_text_color(key)
+
+    # The output is a stream, so the cursor can't actually be moved; it only tracks where the next output goes.
+    @property
+    def CursorLeft(self):
+        return str(self.__cursor_left)
+
+    @CursorLeft.setter
+    def CursorLeft(self, cl):
+        pass
+
+    @property
+    def CursorTop(self):
+        return str(self.__cursor_top)
+
+    @CursorTop.setter
+    def CursorTop(self, ct):
+        pass
+
+    def Clear(self):
+        pass
+
+    def Pause(self, message="Press any key to continue..."):
+        if message is not None:
+            self.WriteLine(message)
+        self.Read()
+
+    def PauseIfVisible(self):
+        pass
+
+    def PauseWithoutMessage(self):
+        # noinspection PyTypeChecker
+        self.Pause(message=None)
+
+    def Read(self):
+        user_input = next(self.__input, None)
+        if user_input is None:
+            self.__input_exhausted = True
+            return ""
+        user_input = user_input.rstrip("\r\n")
+        if self.__echo_input:
+            self.WriteLine(user_input)
+        return user_input
+
+    def ReadKey(self):
+        return self.Read()[:1]
+
+    def ReadNumber(self):
+        while True:
+            user_input = self.Read()
+            converted = py_msb_utils.numericize(user_input, False)
+            if not isinstance(converted, str):
+                return str(converted)
+            if self.__input_exhausted:
+                return "0"  # otherwise this would wait forever
+
+    def Write(self, contents):
+        """Outputs the contents of the contents string to the output stream."""
+        with self.__lock:
+            self.__output.write(contents)
+            lines = contents.split("\n")
+            if len(lines) > 1:
+                self.__cursor_top += len(lines) - 1
+                self.__cursor_left = len(lines[-1])
+            else:
+                self.__cursor_left += len(contents)
+
+    def WriteLine(self, contents):
+        """Outputs the contents of the contents string to the output stream, with a trailing newline character."""
+        self.Write(contents + "\n")
@@ -36,6 +36,19 @@ class FileModule(PyMsbModule):
         self.array_parser = interpreter.array_parser
         self.__last_error = ""
 
+    def _reset(self):
+        super()._reset()
+        self.__last_error = ""
+
+    def _snapshot(self):
+        state = super()._snapshot()
+        state["last_error"] = self.__last_error
+        return state
+
+    def _restore(self, state):
+        super()._restore(state)
+        self.__last_error = state["last_error"]
+
     @property
     def LastError(self):
         """
@@ -1,5 +1,6 @@
 import tempfile
 import time
+import pymsb.language.errors as errors
 from pymsb.language.modules.pymsbmodule import PyMsbModule
 
 # noinspection PyPep8Naming,PyMethodMayBeStatic
@@ -32,6 +33,7 @@ class Program(PyMsbModule):
     def End(self):
         # noinspection PyProtectedMember
         self.interpreter._exit()
+        raise errors.PyMsbProgramEnded()
 
     def GetArgument(self, index):
         try:
@@ -12,6 +12,25 @@ class PyMsbModule:
 
         self.__events = {}
 
+    def _reset(self):
+        """
+        Forgets everything that a program has done to this MSB module, so that the interpreter can reuse it for the next
+        program it runs.  Subclasses that keep state of their own extend this.
+        """
+        self.__events.clear()
+
+    def _snapshot(self):
+        """
+        Returns the state that a program may have changed, as a dict of values that can be serialized as JSON, so that
+        a snapshot of the program can be restored later with _restore.  Subclasses that keep state of their own extend
+        this.
+        """
+        return {"events": dict(self.__events)}
+
+    def _restore(self, state):
+        """Restores the state returned by _snapshot, after the MSB module has been reset."""
+        self.__events.update(state["events"])
+
     def get_event_sub(self, event_name):
         """
         Returns the name of the subroutine (defined in MSB code) assigned to the given event, or None if none is
@@ -32,11 +51,11 @@ class PyMsbModule:
 
     def _trigger_event(self, event_name):
         """
-        Tells the interpreter to execute the subroutine assigned to an MSB event in this MSB module.
+        Tells the interpreter's EventDispatcher to execute the subroutine assigned to an MSB event in this MSB module.
         :param event_name: The name of the event (e.g. "Tick" in the Timer class)
         """
         # noinspection PyNoneFunctionAssignment
         sub_name = self.get_event_sub(event_name)
         if sub_name:
-            # noinspection PyProtectedMember
-            self.interpreter._call_subroutine_in_new_thread(sub_name)
+            self.interpreter.event_dispatcher.dispatch(type(self).__name__ + "." + utilities.capitalize(event_name),
+                                                       sub_name)
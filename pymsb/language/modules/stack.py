@@ -9,6 +9,19 @@ class Stack(PyMsbModule):
         super().__init__(interpreter)
         self.stacks = {}
 
+    def _reset(self):
+        super()._reset()
+        self.stacks.clear()
+
+    def _snapshot(self):
+        state = super()._snapshot()
+        state["stacks"] = {stack_name: list(values) for stack_name, values in self.stacks.items()}
+        return state
+
+    def _restore(self, state):
+        super()._restore(state)
+        self.stacks.update((stack_name, list(values)) for stack_name, values in state["stacks"].items())
+
     def GetCount(self, stack_name):
         return len(self.stacks.setdefault(stack_name, []))
 
@@ -1,10 +1,14 @@
+import pymsb.language.values as values
 from pymsb.language.modules.pymsbmodule import PyMsbModule
+from pymsb.language.modules.utilities import native_args
 
 
 # noinspection PyPep8Naming,PyMethodMayBeStatic
 class Text(PyMsbModule):
+    @native_args
     def Append(self, t1, t2):
-        return t1 + t2
+        # Unlike "+", never adds numbers, and appends to a Rope without joining it
+        return values.concatenate(t1, t2)
 
     def ConvertToLowerCase(self, t):
         return t.lower()
@@ -32,8 +36,9 @@ class Text(PyMsbModule):
             return "0"
         return str(ind)
 
+    @native_args
     def GetLength(self, t):
-        return str(len(t))
+        return str(len(t) if type(t) is values.Rope else len(values.to_text(t)))
 
     def GetSubText(self, t, start, length):
         try:
@@ -1,5 +1,6 @@
 from queue import Queue
 import tkinter as tk
+import threading
 import time
 from pymsb.language.modules import utilities as py_msb_utils
 from pymsb.language.modules.interface import PyMsbWindow
@@ -187,8 +188,11 @@ class TextWindow(PyMsbWindow):
 
         self.current_input_mode = TextWindow.ALL
 
-        # Wait for user input
+        # Wait for user input; when the program runs in the Tk thread (cooperative scheduler), keep the window responsive
+        in_tk_thread = threading.current_thread() is threading.main_thread()
         while not self.has_user_input():
+            if in_tk_thread:
+                self.root.update()
             time.sleep(0.1)
         self.current_input_mode = None
 
@@ -9,6 +9,23 @@ class Timer(PyMsbModule):
         self.__interval = 100000000
         self.__timer = None
 
+    def _reset(self):
+        super()._reset()
+        self.Pause()
+        self.__interval = 100000000
+
+    def _snapshot(self):
+        state = super()._snapshot()
+        state["interval"] = self.__interval
+        state["running"] = self.__timer is not None
+        return state
+
+    def _restore(self, state):
+        super()._restore(state)
+        self.__interval = state["interval"]
+        if state["running"]:
+            self.Resume()
+
     @property
     def Interval(self):
         return str(self.__interval)
@@ -19,7 +36,6 @@ class Timer(PyMsbModule):
             self.__interval = max(10, min(100000000, int(interval)))
         except:
             self.__interval = 10
-        print("interval:", self.__interval)
 
     def Pause(self):
         if self.__timer:
@@ -35,4 +51,5 @@ class Timer(PyMsbModule):
 
     def __on_tick(self):
         self._trigger_event("Tick")
-        self.Resume()
+        if not self.interpreter.event_dispatcher.stopped:  # i.e. the program hasn't ended in the meantime
+            self.Resume()
@@ -12,7 +12,7 @@ def __load_msb_builtins_information():
 
     # Map properly-capitalized MSB object names to a dict that maps properly-capitalized member names to NamedTuples.
     __obj_infos = dict()
-    # Store the proper capitalization for every built-in object, function, event and field name
+    # Map the lowercase version of every built-in object, function, event and field name to its proper capitalization
     __msb_capitalizations = dict()
 
     MsbFunction = namedtuple('MsbFunction', ['name', 'type', 'num_args', 'returns_value'])
@@ -46,6 +46,7 @@ def __load_msb_builtins_information():
                 obj_info[name] = MsbEvent(name, "event")
                 __msb_capitalizations[name.lower()] = name
         __obj_infos[object_name] = obj_info
+        __msb_capitalizations[object_name.lower()] = object_name
 
 __load_msb_builtins_information()
 
@@ -98,13 +99,7 @@ def get_msb_builtin_info(obj_name, member_name):
 
 def capitalize(msb_name):
     """Returns the properly-capitalized version of the given name for a MSB object, function, field or event."""
-    for o_name, info in __obj_infos.items():
-        if o_name.lower() == msb_name.lower():
-            return o_name
-        for name in info:
-            if name.lower() == msb_name.lower():
-                return name
-    return None
+    return __msb_capitalizations.get(msb_name.lower(), None)
 
 
 # FIXME: replace the current test with an adequately restrictive one
@@ -200,6 +195,16 @@ def numerical_args(method):
     return f
 
 
+def native_args(method):
+    """
+    :param method: A method of a class that accepts its arguments as native values (see values.py), e.g. numbers or
+                   Ropes, rather than as text, because it can handle them more efficiently.
+    :return: The method, marked so that its arguments are not converted to text before it is called.
+    """
+    method.native_args = True
+    return method
+
+
 def bool_setter(method):
     """
     :param method: A method of a class that needs its arguments to be converted from strings into boolean values
@@ -0,0 +1,393 @@
+import copy
+import math
+import operator
+
+import pymsb.language.abstractsyntaxtrees as ast
+import pymsb.language.values as values
+
+
+class Optimizer:
+    """
+    The Optimizer rewrites the list of statement ASTs produced by the Parser before the program is linked or
+    transpiled, without changing what the program does:
+
+     - Literal operands of arithmetic and numeric comparisons are converted to numbers once, here.
+     - Operations and comparisons whose operands are all literals are folded into a single literal.
+     - Identities like x + 0 and x * 1 are simplified, but only where x is known to be a number, since e.g. "abc" + 0
+       is "abc0".
+     - If/ElseIf/Else branches whose conditions are constant are pruned, unless that would remove a label.
+     - Calls to small leaf subroutines (no calls, Gotos or labels) from inside a loop are replaced by a copy of the
+       subroutine's body, if inline_subroutines is True.  The subroutine itself is kept, e.g. for events.
+
+    Statements are optimized in place; the statements that are dropped are simply left out of the returned list.
+
+    :param inline_subroutines: Whether to inline calls to small leaf subroutines inside loops.
+    :param max_inline_statements: The number of statements in the body of the largest subroutine that is inlined.
+    """
+
+    # The operators other than "+", which always force both operands to be numeric.
+    arithmetic_operators = {
+        "-": operator.sub,
+        "*": operator.mul,
+        "/": operator.truediv,
+    }
+
+    numeric_comparators = {
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+
+    # The comparators that don't force their operands to be numeric, by lowercase name.
+    other_comparators = {
+        "=": values.equals,
+        "<>": lambda left, right: not values.equals(left, right),
+        "and": lambda left, right: values.is_true(left) and values.is_true(right),
+        "or": lambda left, right: values.is_true(left) or values.is_true(right),
+    }
+
+    def __init__(self, inline_subroutines=True, max_inline_statements=8):
+        self.inline_subroutines = inline_subroutines
+        self.max_inline_statements = max_inline_statements
+
+    def optimize(self, statements):
+        """
+        Optimizes a list of statement ASTs, as returned by Parser.parse.  The ASTs passed in are left unchanged, e.g. so
+        that those of a ParserSession stay as the session parsed them; the optimized statements are copies, which share
+        whatever parts of the expressions the Optimizer doesn't change.
+
+        :param statements: A list of abstractsyntaxtrees.Statement instances.
+        :return: The optimized list of abstractsyntaxtrees.Statement instances.
+        """
+        statements = self.__copy_statements(statements)
+        for statement in statements:
+            self.__fold_statement(statement)
+        if self.inline_subroutines:
+            statements = self.__inline_subroutines(statements)
+        return self.__prune_branches(statements)
+
+    def dump(self, statements):
+        """
+        Returns Microsoft Small Basic-like source code for a list of statement ASTs, for inspecting what the Optimizer
+        did.  Every operation and comparison is parenthesized.
+        """
+        lines = []
+        indent = 0
+        for statement in statements:
+            if isinstance(statement, (ast.EndIfStatement, ast.EndForStatement, ast.EndWhileStatement,
+                                      ast.EndSubStatement)):
+                indent -= 1
+            elif isinstance(statement, ast.IfStatement) and statement.keyword != "If":
+                indent -= 1
+
+            lines.append("  " * indent + self.__format_statement(statement))
+
+            if isinstance(statement, (ast.IfStatement, ast.ForStatement, ast.WhileStatement, ast.SubStatement)):
+                indent += 1
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __copy_statements(statements):
+        # Copies the statements (but not their expressions), with the copies' jump targets pointing at each other like
+        # the originals' do.  Everything else in the Optimizer only modifies these copies, and replaces any expression
+        # it changes with a new one.
+        copies = {statement: copy.copy(statement) for statement in statements}
+        for statement in copies.values():
+            if statement.jump_target is not None:
+                statement.jump_target = copies.get(statement.jump_target, statement.jump_target)
+        return [copies[statement] for statement in statements]
+
+    # ==========================================================================================
+    # Folding expressions
+
+    def __fold_statement(self, statement):
+        if isinstance(statement, ast.Assignment):
+            statement.var = self.__fold_expression(statement.var)  # only the indices of an array element can change
+            statement.val = self.__fold_expression(statement.val)
+        elif isinstance(statement, ast.MsbObjectFunctionCall):
+            statement.parameter_asts = self.__fold_list(statement.parameter_asts)
+        elif isinstance(statement, (ast.IfStatement, ast.WhileStatement)):
+            if statement.condition_expr is not None:
+                statement.condition_expr = self.__fold_condition(statement.condition_expr)
+        elif isinstance(statement, ast.ForStatement):
+            statement.lower_expr = self.__fold_expression(statement.lower_expr)
+            statement.upper_expr = self.__fold_number(statement.upper_expr)
+
+    def __fold_list(self, val_asts):
+        return [self.__fold_expression(val_ast) for val_ast in val_asts]
+
+    def __fold_expression(self, val_ast):
+        if isinstance(val_ast, ast.UserVariable) and val_ast.array_indices:
+            val_ast = copy.copy(val_ast)
+            val_ast.array_indices = self.__fold_list(val_ast.array_indices)
+        elif isinstance(val_ast, ast.MsbObjectFunctionCall):
+            val_ast = copy.copy(val_ast)
+            val_ast.parameter_asts = self.__fold_list(val_ast.parameter_asts)
+        elif isinstance(val_ast, ast.Operation):
+            return self.__fold_operation(val_ast)
+        return val_ast
+
+    def __fold_number(self, val_ast):
+        # Folds an expression that is only ever used as a number, converting it if it is (or folds into) a literal
+        val_ast = self.__fold_expression(val_ast)
+        if isinstance(val_ast, ast.LiteralValue):
+            return ast.LiteralValue(values.to_number(val_ast.value))
+        return val_ast
+
+    def __fold_addend(self, val_ast):
+        # Folds an operand of "+", converting it if it is (or folds into) a literal, e.g. ("1" + "") + 2
+        val_ast = self.__fold_expression(val_ast)
+        if isinstance(val_ast, ast.LiteralValue):
+            return ast.LiteralValue(values.to_number_or_text(val_ast.value))
+        return val_ast
+
+    def __fold_operation(self, operation):
+        # A chain like a + b - c + ... is nested down the left, one Operation per operator.  Fold it from the innermost
+        # operation outwards in a loop, rather than recursing as deep as the formula is long.
+        operations = [operation]
+        while isinstance(operations[-1].left, ast.Operation):
+            operations.append(operations[-1].left)
+        left = operations[-1].left
+        for i, operation in enumerate(reversed(operations)):
+            # The result of an inner operation has been folded already, but still needs converting if it is a literal
+            if i == 0 or isinstance(left, ast.LiteralValue):
+                left = self.__fold_addend(left) if operation.operator == "+" else self.__fold_number(left)
+            left = self.__fold_step(operation.operator, left, operation.right)
+        return left
+
+    def __fold_step(self, op, left, right):
+        # Folds a single operation, whose left operand has been folded already
+        if op == "+":
+            right = self.__fold_addend(right)
+            if isinstance(left, ast.LiteralValue) and isinstance(right, ast.LiteralValue):
+                return self.__literal_result(values.add, op, left, right)
+            # x + 0 and 0 + x
+            if self.__is_literal(right, 0) and self.__is_number(left):
+                return left
+            if self.__is_literal(left, 0) and self.__is_number(right):
+                return right
+            return ast.Operation(op, left, right)
+
+        right = self.__fold_number(right)
+        if isinstance(left, ast.LiteralValue) and isinstance(right, ast.LiteralValue):
+            return self.__literal_result(self.arithmetic_operators[op], op, left, right)
+        # x - 0, x * 1 and 1 * x; x / 1 is not simplified, since it turns integers into floats
+        if op == "-" and self.__is_literal(right, 0) and self.__is_number(left):
+            return left
+        if op == "*" and self.__is_literal(right, 1) and self.__is_number(left):
+            return left
+        if op == "*" and self.__is_literal(left, 1) and self.__is_number(right):
+            return right
+        return ast.Operation(op, left, right)
+
+    def __fold_condition(self, val_ast):
+        # Folds an expression that may be a comparison, as used in an If or While statement
+        if not isinstance(val_ast, ast.Comparison):
+            return self.__fold_expression(val_ast)
+
+        comp = val_ast.comparator
+        if comp in self.numeric_comparators:
+            left = self.__fold_number(val_ast.left)
+            right = self.__fold_number(val_ast.right)
+            compare = self.numeric_comparators[comp]
+        else:
+            left = self.__fold_condition(val_ast.left)
+            right = self.__fold_condition(val_ast.right)
+            compare = self.other_comparators.get(comp.lower())
+
+        if compare is not None and isinstance(left, ast.LiteralValue) and isinstance(right, ast.LiteralValue):
+            return ast.LiteralValue(compare(left.value, right.value))
+        return ast.Comparison(comp, left, right)
+
+    @staticmethod
+    def __literal_result(apply_operator, op, left, right):
+        # Leaves the operation alone if it would fail or produce something that is not a plain number, so that it
+        # still happens (or fails) when the program runs.
+        try:
+            result = apply_operator(left.value, right.value)
+        except ArithmeticError:
+            return ast.Operation(op, left, right)
+        if isinstance(result, float) and not math.isfinite(result):
+            return ast.Operation(op, left, right)
+        if isinstance(result, values.Rope):
+            result = values.to_text(result)  # literals are always plain text or numbers
+        return ast.LiteralValue(result)
+
+    @staticmethod
+    def __is_literal(val_ast, number):
+        return (isinstance(val_ast, ast.LiteralValue) and type(val_ast.value) is int and  # 0.0 would make a float
+                val_ast.value == number)
+
+    def __is_number(self, val_ast):
+        # Whether the expression always evaluates to a number (as opposed to text or a boolean)
+        while isinstance(val_ast, ast.Operation) and val_ast.operator == "+":
+            if not self.__is_number(val_ast.right):
+                return False
+            val_ast = val_ast.left
+        if isinstance(val_ast, ast.LiteralValue):
+            return type(val_ast.value) in (int, float)
+        return isinstance(val_ast, ast.Operation)  # anything but "+" always results in a number
+
+    # ==========================================================================================
+    # Inlining subroutines
+
+    def __inline_subroutines(self, statements):
+        # Find the bodies of the subroutines that can be inlined
+        bodies = {}
+        body = None
+        for statement in statements:
+            if isinstance(statement, ast.SubStatement):
+                body = bodies[statement] = []
+            elif isinstance(statement, ast.EndSubStatement):
+                body = None
+            elif body is not None:
+                body.append(statement)
+        inlinable = {sub_statement: body for sub_statement, body in bodies.items()
+                     if len(body) <= self.max_inline_statements and not any(
+                         isinstance(s, (ast.SubroutineCall, ast.GotoStatement, ast.LabelDefinition)) for s in body)}
+        if not inlinable:
+            return statements
+
+        result = []
+        loop_depth = 0
+        for statement in statements:
+            if isinstance(statement, (ast.ForStatement, ast.WhileStatement)):
+                loop_depth += 1
+            elif isinstance(statement, (ast.EndForStatement, ast.EndWhileStatement)):
+                loop_depth -= 1
+
+            if loop_depth and isinstance(statement, ast.SubroutineCall) and statement.jump_target in inlinable:
+                # Copying the whole body at once keeps the jump targets within the copy pointing at each other
+                result.extend(copy.deepcopy(inlinable[statement.jump_target]))
+            else:
+                result.append(statement)
+        return result
+
+    # ==========================================================================================
+    # Pruning branches
+
+    def __prune_branches(self, statements):
+        result = []
+        indices = {statement: i for i, statement in enumerate(statements)}
+        i = 0
+        while i < len(statements):
+            statement = statements[i]
+            if not (isinstance(statement, ast.IfStatement) and statement.keyword == "If"):
+                result.append(statement)
+                i += 1
+                continue
+
+            # Follow the chain of If/ElseIf/Else branches to the EndIf that closes them
+            branches = [statement]
+            while not isinstance(branches[-1].jump_target, ast.EndIfStatement):
+                branches.append(branches[-1].jump_target)
+            end_if = branches[-1].jump_target
+            bodies = [self.__prune_branches(statements[indices[branch] + 1:indices[next_statement]])
+                      for branch, next_statement in zip(branches, branches[1:] + [end_if])]
+
+            result.extend(self.__prune_if(branches, bodies, end_if))
+            i = indices[end_if] + 1
+        return result
+
+    def __prune_if(self, branches, bodies, end_if):
+        kept = []
+        for branch, body in zip(branches, bodies):
+            truth = self.__constant_truth(branch.condition_expr)
+            if truth is False:
+                continue
+            kept.append((branch, body))
+            if truth:
+                break  # any later branches can never be taken
+
+        # Goto can jump into any branch, even one that would never be taken otherwise
+        kept_branches = [branch for branch, body in kept]
+        for branch, body in zip(branches, bodies):
+            if branch not in kept_branches and any(isinstance(s, ast.LabelDefinition) for s in body):
+                return self.__join_if(list(zip(branches, bodies)), end_if)
+
+        if not kept:
+            return []
+        if self.__constant_truth(kept[0][0].condition_expr):
+            return kept[0][1]  # this branch is always taken
+
+        if len(kept) > 1 and self.__constant_truth(kept[-1][0].condition_expr):
+            last_branch = kept[-1][0]
+            last_branch.keyword = "Else"
+            last_branch.condition_expr = None
+        kept[0][0].keyword = "If"
+        return self.__join_if(kept, end_if)
+
+    @staticmethod
+    def __join_if(branches, end_if):
+        # Relinks the branches to each other and returns the statements for the whole If block
+        statements = []
+        for i, (branch, body) in enumerate(branches):
+            branch.jump_target = branches[i + 1][0] if i + 1 < len(branches) else end_if
+            statements.append(branch)
+            statements.extend(body)
+        statements.append(end_if)
+        return statements
+
+    @staticmethod
+    def __constant_truth(condition_expr):
+        # Returns True or False if the condition is constant (an Else branch is always true), otherwise None
+        if condition_expr is None:
+            return True
+        if isinstance(condition_expr, ast.LiteralValue):
+            return values.is_true(condition_expr.value)
+        return None
+
+    # ==========================================================================================
+    # Dumping
+
+    def __format_statement(self, statement):
+        if isinstance(statement, ast.Assignment):
+            return "{0} = {1}".format(self.__format_expression(statement.var), self.__format_expression(statement.val))
+        if isinstance(statement, ast.MsbObjectFunctionCall):
+            return self.__format_expression(statement)
+        if isinstance(statement, ast.LabelDefinition):
+            return statement.label_name + ":"
+        if isinstance(statement, ast.GotoStatement):
+            return "Goto " + statement.label_name
+        if isinstance(statement, ast.SubroutineCall):
+            return statement.name + "()"
+        if isinstance(statement, ast.IfStatement):
+            if statement.condition_expr is None:
+                return statement.keyword
+            return "{0} {1} Then".format(statement.keyword, self.__format_expression(statement.condition_expr))
+        if isinstance(statement, ast.WhileStatement):
+            return "While " + self.__format_expression(statement.condition_expr)
+        if isinstance(statement, ast.ForStatement):
+            return "For {0} = {1} To {2}".format(self.__format_expression(statement.var_ast),
+                                                 self.__format_expression(statement.lower_expr),
+                                                 self.__format_expression(statement.upper_expr))
+        if isinstance(statement, ast.SubStatement):
+            return "Sub " + statement.sub_name
+        return statement.keyword  # EndIf, EndFor, EndWhile, EndSub
+
+    def __format_expression(self, val_ast):
+        if isinstance(val_ast, ast.LiteralValue):
+            if type(val_ast.value) in (int, float):
+                return values.to_text(val_ast.value)
+            return '"{0}"'.format(values.to_text(val_ast.value))
+        if isinstance(val_ast, ast.UserVariable):
+            return val_ast.variable_name + "".join("[" + self.__format_expression(index_ast) + "]"
+                                                   for index_ast in val_ast.array_indices)
+        if isinstance(val_ast, ast.MsbObjectField):
+            return "{0}.{1}".format(val_ast.msb_object, val_ast.msb_object_field_name)
+        if isinstance(val_ast, ast.MsbObjectFunctionCall):
+            return "{0}.{1}({2})".format(val_ast.msb_object, val_ast.msb_object_function,
+                                         ", ".join(map(self.__format_expression, val_ast.parameter_asts)))
+        if isinstance(val_ast, ast.Operation):
+            operations = [val_ast]
+            while isinstance(operations[-1].left, ast.Operation):
+                operations.append(operations[-1].left)
+            text = self.__format_expression(operations[-1].left)
+            for operation in reversed(operations):
+                text = "({0} {1} {2})".format(text, operation.operator, self.__format_expression(operation.right))
+            return text
+        if isinstance(val_ast, ast.Comparison):
+            return "({0} {1} {2})".format(self.__format_expression(val_ast.left), val_ast.comparator,
+                                          self.__format_expression(val_ast.right))
+        return repr(val_ast)
@@ -12,11 +12,33 @@ class Parser:
     the Interpreter.
     """
 
+    # Maps each keyword that closes a block (or continues it, like Else) to the keywords of the blocks it may close
+    BLOCK_CLOSERS = {
+        "ElseIf": ("If", "ElseIf", "Else"),
+        "Else": ("If", "ElseIf", "Else"),
+        "EndIf": ("If", "ElseIf", "Else"),
+        "EndFor": ("For",),
+        "EndWhile": ("While",),
+        "EndSub": ("Sub",),
+    }
+    # The keywords that open a block (or continue it)
+    BLOCK_OPENERS = ("If", "ElseIf", "Else", "For", "While", "Sub")
+
+    # The precedence of each binary operator, by lowercase name; operators with the same precedence associate left
+    OPERATOR_PRECEDENCES = {
+        "or": 1,
+        "and": 2,
+        "=": 3, "<>": 3, "<": 3, "<=": 3, ">": 3, ">=": 3,
+        "+": 4, "-": 4,
+        "*": 5, "/": 5,
+    }
+
     def __init__(self):
         self.line_number = -1
         self.token_index = -1
         self.tokens = []
         self.line = ""
+        self.syntax_errors = []
 
     def parse(self, code):
         """
@@ -38,7 +60,7 @@ class Parser:
         lines = code.splitlines()
         for self.line_number, self.line in enumerate(lines):
             try:
-                ast = self.__parse_tokens(self.tokenize(self.line))
+                ast = self.__parse_line(self.tokenize(self.line))
             except errors.PyMsbSyntaxError as e:
                 error_list.append(e)
                 continue
@@ -49,7 +71,7 @@ class Parser:
         if self.open_code_block_asts:
             # TODO: give detailed output of what we're missing
             message = "Missing the closing for " + repr(self.open_code_block_asts[-1])
-            error_list.append(errors.PyMsbExpectedExpressionError(self.line_number, message))
+            error_list.append(errors.PyMsbSyntaxError(self.line_number, 0, message))
 
         # Perform checks and processing for labels
         try:
@@ -57,6 +79,9 @@ class Parser:
         except errors.PyMsbSyntaxError as e:
             error_list.append(e)
 
+        # Kept for callers that need to report what went wrong, e.g. Interpreter.compile
+        self.syntax_errors = error_list
+
         # No issues detected during parsing
         if not error_list:
             return asts
@@ -68,6 +93,44 @@ class Parser:
             print("\t", error, "\n")
         return None
 
+    def __parse_line(self, tokens):
+        # Parses a line, and fits it into the blocks that are open
+        keyword = tokens[0].token_type if tokens else None
+        if keyword in Parser.BLOCK_CLOSERS:
+            open_block_keyword = self.open_code_block_asts[-1].keyword if self.open_code_block_asts else None
+            if open_block_keyword not in Parser.BLOCK_CLOSERS[keyword]:
+                raise errors.PyMsbUnexpectedTokenError(tokens[0])
+        ast = self.__parse_tokens(tokens)
+        if keyword in Parser.BLOCK_CLOSERS:
+            self.link_block(self.open_code_block_asts.pop(), ast)
+        if keyword in Parser.BLOCK_OPENERS:
+            self.open_code_block_asts.append(ast)
+        return ast
+
+    def parse_statement(self, tokens):
+        """
+        Parses a tokenized line on its own, without regard to the blocks that are open around it, so statements that
+        open or close a block are returned without their jump targets (see link_block), and Gotos and subroutine calls
+        are not resolved.  self.line_number should be set to the number of the line.
+
+        :param tokens: A list of MsbToken instances, as returned by tokenize.
+        :return: A single AST representing the line, or None if it is blank or a comment.
+        :raise errors.PyMsbSyntaxError: If the line is not valid on its own.
+        """
+        return self.__parse_tokens(tokens)
+
+    @staticmethod
+    def link_block(opener, closer):
+        """
+        Links the statement that opens a block to the statement that closes (or continues) it, e.g. an If to its ElseIf
+        or EndIf, or a For and its EndFor to each other.
+        """
+        if closer.keyword == "EndSub":
+            return
+        opener.jump_target = closer
+        if closer.keyword in ("EndFor", "EndWhile"):
+            closer.jump_target = opener
+
     def tokenize(self, line, include_comments=False):
         """
         Takes a single line of MSB and generates a list of MsbToken instances.
@@ -77,22 +140,20 @@ class Parser:
         :return: A list of MsbToken instances representing the given line of code.
         """
         self.tokens = []
-        line_tokenizing = line.lstrip()
-        while line_tokenizing:
-            line_index = len(line) - len(line_tokenizing)
-            for token_type, regex in MsbToken.regexes.items():
-                match = re.match(regex, line_tokenizing, re.IGNORECASE)
-                if match:
-                    if token_type != MsbToken.COMMENT or include_comments:
-                        self.tokens.append(MsbToken(token_type,
-                                                    match.group(),
-                                                    self.line_number,
-                                                    line_index))
-                    line_tokenizing = line_tokenizing[match.end():].lstrip()
-                    break
-            else:
-                self.tokens.append(MsbToken.generate_unexpected_token(line_tokenizing, self.line_number, line_index))
+        # Match at increasing positions in the line, rather than slicing off what has been tokenized
+        skip_whitespace = MsbToken.whitespace_regex.match
+        match_token = MsbToken.master_regex.match
+        token_types = MsbToken.token_types
+        line_index = skip_whitespace(line).end()
+        while line_index < len(line):
+            match = match_token(line, line_index)
+            if match is None:
+                self.tokens.append(MsbToken.generate_unexpected_token(line[line_index:], self.line_number, line_index))
                 break
+            token_type = token_types[match.lastgroup]
+            if token_type != MsbToken.COMMENT or include_comments:
+                self.tokens.append(MsbToken(token_type, match.group(), self.line_number, line_index))
+            line_index = skip_whitespace(line, match.end()).end()
         return self.tokens
 
     def __get_token(self, token_index_offset, *expected_types):
@@ -159,14 +220,22 @@ class Parser:
             if self.token_index < len(self.tokens) and self.tokens[self.token_index].token_type in closing_braces:
                 raise errors.PyMsbExpectedExpressionError(self.line_number, self.__get_token(0).line_index)
 
-        # Process into list of alternating operand asts and operator self.tokens, then consider order of precedence
-        expr_elements = []
+        # Read alternating operands and operators, and build the AST with operator precedence parsing as they are read:
+        # before an operator is pushed, the operators on the stack that take precedence over it are applied to the
+        # operands they separate, so every operator is applied exactly once.
+        operands = []
+        operators = []
         while True:
             # loop until we get to a closing brace/bracket/blank space (at this level of nesting)
             # Find operand
             t = self.__get_token(0, MsbToken.LITERAL, MsbToken.L_PARENS, MsbToken.SYMBOL, MsbToken.COMMA,
                                  *closing_braces)
 
+            # An operator with nothing after it, e.g. "x = 1 +", which is common while a line is being typed
+            if operators and (not t or t.token_type in closing_braces):
+                line_index = t.line_index if t else self.tokens[-1].line_index_end
+                raise errors.PyMsbExpectedExpressionError(self.line_number, line_index)
+
             if not t:
                 break
             if t.token_type in closing_braces:
@@ -240,7 +309,7 @@ class Parser:
                         opd = ast.MsbObjectField(t.value, field_token.value)
 
             # noinspection PyUnboundLocalVariable
-            expr_elements.append(opd)
+            operands.append(opd)
 
             # Find operator (maybe comparator) after the operand, or end of the expression
             if allow_comparators:
@@ -255,79 +324,49 @@ class Parser:
 
             if t.token_type in closing_braces:
                 break
-            else:
-                expr_elements.append(t.value)
-
-        # Process into nested expression asts
-        op_precedences = list("*/+-")
-        if allow_comparators:
-            op_precedences += ["<", "<=", "=", ">=", ">", "<>", "and", "or"]
-        for op_finding in op_precedences:
-            while op_finding in expr_elements:
-                ind2 = expr_elements.index(op_finding)
-                left = expr_elements[ind2-1]
-                right = expr_elements[ind2+1]
-                if op_finding.lower() in ("*", "/", "+", "-"):
-                    expr_elements[ind2-1] = ast.Operation(op_finding, left, right)
-                else:  # < <= = >= > <> and or
-                    expr_elements[ind2-1] = ast.Comparison(op_finding, left, right)
-                del expr_elements[ind2]
-                del expr_elements[ind2]
-
-        if expr_elements:
-            return expr_elements[0]
+            precedence = Parser.OPERATOR_PRECEDENCES[t.value.lower()]
+            while operators and Parser.OPERATOR_PRECEDENCES[operators[-1].lower()] >= precedence:
+                self.__apply_operator(operands, operators.pop())
+            operators.append(t.value)
+
+        while operators:
+            self.__apply_operator(operands, operators.pop())
+        if operands:
+            return operands[0]
         return None
 
+    @staticmethod
+    def __apply_operator(operands, operator):
+        # Replaces the last two operands with an AST applying the operator to them
+        right = operands.pop()
+        left = operands.pop()
+        if operator in ("*", "/", "+", "-"):
+            operands.append(ast.Operation(operator, left, right))
+        else:  # < <= = >= > <> and or
+            operands.append(ast.Comparison(operator, left, right))
+
     def __parse_keyword_statement(self):
         """
-        Helper function to parse a statement beginning with If, For, While, etc.
+        Helper function to parse a statement beginning with If, For, While, etc.  The statement is not linked to the
+        blocks around it; see __parse_line and link_block.
 
         :return: An AST representing the current statement being parsed.
         """
-
-        def assert_open_code_block(*open_code_block_keywords):
-            """
-            Raises errors.PyMsbUnexpectedTokenError iff the current open block isn't one of the given types.
-
-            :param open_code_block_keywords: The type(s) of open code blocks that are allowed.
-            :raise errors.PyMsbUnexpectedTokenError: If current open code block is not one of the given types.
-            """
-            if open_block_keyword not in open_code_block_keywords:
-                raise errors.PyMsbUnexpectedTokenError(kw_token)
-                # raise errors.PyMsbExpectedTokenError(self.line_number, 0, *open_code_block_keywords)
-
         kw_token = self.__get_token(0)
-        open_block_keyword = self.open_code_block_asts[-1].keyword if self.open_code_block_asts else None
 
         # ==========================================================================================
         # IFS
         if kw_token.token_type in ("If", "ElseIf", "Else"):
-            # Check previous token type
-            if kw_token.token_type in ("ElseIf", "Else"):
-                assert_open_code_block("If", "ElseIf", "Else")
-
             # Parse conditional expression
             if kw_token.token_type != "Else":
                 self.token_index += 1
                 conditional_expr = self.__parse_expr("Then", allow_comparators=True)
             else:
                 conditional_expr = None
-
-            answer = ast.IfStatement(self.line_number, kw_token.token_type, conditional_expr)
-
-            # Link previous If/ElseIf/Else to this ElseIf/Else
-            if kw_token.token_type in ("ElseIf", "Else"):
-                self.open_code_block_asts.pop().jump_target = answer
-
-            self.open_code_block_asts.append(answer)
-            return answer
+            return ast.IfStatement(self.line_number, kw_token.token_type, conditional_expr)
 
         if kw_token.token_type == "EndIf":
-            assert_open_code_block("If", "ElseIf", "Else")
-            # Link previous If/ElseIf/Else to this ElseIf/Else
-            answer = ast.EndIfStatement(self.line_number)
-            self.open_code_block_asts.pop().jump_target = answer
-            return answer
+            return ast.EndIfStatement(self.line_number)
 
         # ==========================================================================================
         # FOR
@@ -338,51 +377,30 @@ class Parser:
             self.token_index += 3
             lower_expr = self.__parse_expr("To")  # remember to match capitalization in MsbToken.keywords
             upper_expr = self.__parse_expr()
-            answer = ast.ForStatement(self.line_number, var_ast, lower_expr, upper_expr)
-            self.open_code_block_asts.append(answer)
-            return answer
+            return ast.ForStatement(self.line_number, var_ast, lower_expr, upper_expr)
 
         if kw_token.token_type == "EndFor":
-            # Link the for and endfor asts together
-            assert_open_code_block("For")
-            answer = ast.EndForStatement(self.line_number)
-            for_ast = self.open_code_block_asts.pop()
-            for_ast.jump_target = answer
-            answer.jump_target = for_ast
-            return answer
+            return ast.EndForStatement(self.line_number)
 
         # ==========================================================================================
         # WHILE
         if kw_token.token_type == "While":
             self.token_index += 1
             conditional_expr = self.__parse_expr(allow_comparators=True)
-            answer = ast.WhileStatement(self.line_number, conditional_expr)
-            self.open_code_block_asts.append(answer)
-            return answer
+            return ast.WhileStatement(self.line_number, conditional_expr)
 
         if kw_token.token_type == "EndWhile":
-            assert_open_code_block("While")
-            answer = ast.EndWhileStatement(self.line_number)
-            while_ast = self.open_code_block_asts.pop()
-            while_ast.jump_target = answer
-            answer.jump_target = while_ast
-            return answer
+            return ast.EndWhileStatement(self.line_number)
 
         # ==========================================================================================
         # SUB
-        # TODO: make this use something similar to what the ifs are using or at least have the right checks
-        # TODO: check if the above TODO has been fulfilled
         if kw_token.token_type == "Sub":
             sub_name = self.__get_token(1, MsbToken.SYMBOL).value
             self.__get_token(2, None)
-            answer = ast.SubStatement(self.line_number, sub_name)
-            self.open_code_block_asts.append(answer)
-            return answer
+            return ast.SubStatement(self.line_number, sub_name)
 
         if kw_token.token_type == "EndSub":
             self.__get_token(1, None)
-            assert_open_code_block("Sub")
-            self.open_code_block_asts.pop()
             return ast.EndSubStatement(self.line_number)
 
         # ==========================================================================================
@@ -582,6 +600,13 @@ class MsbToken:
     regexes[OPERATOR] = "[-#+*/]"
     regexes[COMMENT] = "'.*"
 
+    # All of the regexes above as one alternation of named groups, which are tried in the same order, so that a line is
+    # tokenized in a single pass.  token_types maps the name of each group to its token type.
+    token_types = {"t{0}".format(i): token_type for i, token_type in enumerate(regexes)}
+    master_regex = re.compile("|".join("(?P<t{0}>{1})".format(i, regex) for i, regex in enumerate(regexes.values())),
+                              re.IGNORECASE)
+    whitespace_regex = re.compile(r"\s*")
+
     UNEXPECTED_TOKEN = "unexpected token"
 
     def __init__(self, token_type, value, line_number, line_index):
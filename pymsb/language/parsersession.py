@@ -0,0 +1,274 @@
+import itertools
+import operator
+
+from pymsb.language import abstractsyntaxtrees as ast
+import pymsb.language.errors as errors
+from pymsb.language.parser import Parser
+
+
+class Diagnostic:
+    """
+    A problem with Microsoft Small Basic code, as reported by a ParserSession.
+
+    :param line_number: The number of the line, counting from 0 like abstractsyntaxtrees.Statement.line_number.
+    :param line_index: The position in the line where the problem is.
+    :param message: A description of the problem, e.g. "Unexpected token EndIf found."
+    :param kind: "syntax" for a line that can't be parsed, "block" for an If, For, While or Sub that isn't opened or
+                 closed properly, or "name" for a label or subroutine that is missing or defined more than once.
+    """
+
+    def __init__(self, line_number, line_index, message, kind):
+        self.line_number = line_number
+        self.line_index = line_index
+        self.message = message
+        self.kind = kind
+
+    def __eq__(self, other):
+        return isinstance(other, Diagnostic) and self.__key() == other.__key()
+
+    def __hash__(self):
+        return hash(self.__key())
+
+    def __key(self):
+        return self.line_number, self.line_index, self.message, self.kind
+
+    def __str__(self):
+        return "{0}, {1}:\t{2}".format(self.line_number, self.line_index, self.message)
+
+    def __repr__(self):
+        return "Diagnostic<{0}, {1}, {2}: {3}>".format(self.kind, self.line_number, self.line_index, self.message)
+
+
+class _Line:
+    # What a ParserSession knows about a line of code
+    __slots__ = ("text", "line_number", "tokens", "statement", "keyword_token", "syntax_error", "block_error", "name",
+                 "defines_name", "name_error")
+
+    def __init__(self, text, line_number):
+        self.text = text
+        self.line_number = line_number
+        self.tokens = []
+        self.statement = None
+        self.keyword_token = None  # the first token, if it opens or closes a block, even if the line has a syntax error
+        self.syntax_error = None
+        self.block_error = None
+        self.name = None  # ("label", name) or ("sub", name), for lines that define or use a label or subroutine
+        self.defines_name = False
+        self.name_error = None
+
+    @property
+    def keyword(self):
+        return self.keyword_token.token_type if self.keyword_token is not None else None
+
+    def has_problems(self):
+        return self.syntax_error is not None or self.block_error is not None or self.name_error is not None
+
+
+class ParserSession:
+    """
+    Parses Microsoft Small Basic code, and keeps the result up to date as the code is edited, e.g. in an editor that
+    shows problems as the user types.  Instead of parsing all of the code again, an edit only tokenizes and parses the
+    lines that it replaces; blocks (If, For, While and Sub) are matched again from the edit onwards only until they line
+    up with how they were matched before it, and Gotos and subroutine calls are only resolved again for the names of the
+    labels and subroutines that the edit adds or removes.
+
+    Problems are reported as Diagnostic instances rather than printed.  Unlike Parser.parse, every problem is reported,
+    and a line with a syntax error that opens or closes a block (e.g. "If x = Then") still counts as opening or closing
+    it, so that one mistake doesn't cause errors all the way down to the end of the code.
+
+    :param code: The initial code.
+    """
+
+    def __init__(self, code=""):
+        self.parser = Parser()
+        self.__lines = []
+        # self.__blocks[i] is the stack of blocks that are open before line i, and self.__blocks[-1] those still open at
+        # the end.  Stacks are linked lists of (_Line, rest) pairs, so the stacks of consecutive lines share whatever
+        # they have in common.
+        self.__blocks = [None]
+        # Map ("label", name) or ("sub", name) to the _Lines that define it, and those that use it
+        self.__definitions = {}
+        self.__uses = {}
+        self.__problems = set()  # the _Lines that have a syntax, block or name error
+        self.edit(0, 0, code.splitlines())
+
+    @property
+    def lines(self):
+        """Returns the lines of code, as a list of strings."""
+        return [line.text for line in self.__lines]
+
+    @property
+    def code(self):
+        """Returns the code, as a single string."""
+        return "\n".join(line.text for line in self.__lines)
+
+    def edit(self, start, end, new_lines):
+        """
+        Replaces the lines from start up to (but not including) end with new_lines.  Pass start == end to insert lines,
+        and no new_lines to delete them.
+
+        :param start: The number of the first line to replace, counting from 0.
+        :param end: The number of the line after the last line to replace.
+        :param new_lines: A list of strings, or a string, which is split into lines.
+        """
+        if isinstance(new_lines, str):
+            new_lines = new_lines.splitlines()
+        if not 0 <= start <= end <= len(self.__lines):
+            raise IndexError("Cannot replace lines {0} to {1} of {2}.".format(start, end, len(self.__lines)))
+
+        removed = self.__lines[start:end]
+        added = [self.__parse_line(text, start + i) for i, text in enumerate(new_lines)]
+        self.__lines[start:end] = added
+        for line in removed:
+            self.__problems.discard(line)
+        if len(added) != len(removed):
+            for line in itertools.islice(self.__lines, start + len(added), None):
+                line.line_number += len(added) - len(removed)
+
+        # Afterwards, self.__blocks[start + len(added)] is still the stack before the first line after the edit, as it
+        # was before the edit, to compare against
+        open_blocks = self.__blocks[start]
+        self.__blocks[start:end] = [None] * len(added)
+        self.__match_blocks(start, start + len(added), open_blocks)
+        self.__resolve_names(removed, added)
+
+    @property
+    def diagnostics(self):
+        """Returns a list of Diagnostic instances for the problems in the code, in the order of the lines."""
+        diagnostics = []
+        for line in sorted(self.__problems, key=operator.attrgetter("line_number")):
+            for error, kind in ((line.syntax_error, "syntax"), (line.block_error, "block"), (line.name_error, "name")):
+                if error is not None:
+                    diagnostics.append(Diagnostic(line.line_number, error.line_index, error.message, kind))
+        if self.__blocks[-1] is not None:
+            opener = self.__blocks[-1][0]
+            message = "Missing the closing for " + repr(opener.statement or opener.keyword)
+            diagnostics.append(Diagnostic(len(self.__lines) - 1, 0, message, "block"))
+        return diagnostics
+
+    def statements(self):
+        """
+        Returns the ASTs of the code, like Parser.parse, or None if there are any diagnostics.  The ASTs belong to the
+        session, which updates them as the code is edited.
+
+        :return: A list of abstractsyntaxtrees.Statement instances, or None.
+        """
+        if self.__problems or self.__blocks[-1] is not None:
+            return None
+        statements = []
+        for line in self.__lines:
+            if line.statement is not None:
+                line.statement.line_number = line.line_number  # lines move when lines are inserted or deleted above
+                statements.append(line.statement)
+        return statements
+
+    def tokens(self, line_number):
+        """Returns the list of MsbToken instances in a line, e.g. for highlighting it."""
+        line = self.__lines[line_number]
+        for token in line.tokens:
+            token.line_number = line.line_number
+        return line.tokens
+
+    def __parse_line(self, text, line_number):
+        line = _Line(text, line_number)
+        self.parser.line_number = line_number
+        self.parser.line = text
+        try:
+            line.tokens = self.parser.tokenize(text)
+            if line.tokens and (line.tokens[0].token_type in Parser.BLOCK_CLOSERS or
+                                line.tokens[0].token_type in Parser.BLOCK_OPENERS):
+                line.keyword_token = line.tokens[0]
+            line.statement = self.parser.parse_statement(line.tokens)
+        except errors.PyMsbSyntaxError as e:
+            line.syntax_error = e
+
+        statement = line.statement
+        if isinstance(statement, (ast.LabelDefinition, ast.GotoStatement)):
+            line.name = ("label", statement.label_name)
+        elif isinstance(statement, ast.SubStatement):
+            line.name = ("sub", statement.sub_name)
+        elif isinstance(statement, ast.SubroutineCall):
+            line.name = ("sub", statement.name)
+        line.defines_name = isinstance(statement, (ast.LabelDefinition, ast.SubStatement))
+        return line
+
+    def __update_problems(self, line):
+        if line.has_problems():
+            self.__problems.add(line)
+        else:
+            self.__problems.discard(line)
+
+    def __match_blocks(self, start, end, open_blocks):
+        # Matches blocks from line start onwards, where lines start to end are new, until the blocks that are open
+        # before a line are the same as before the edit; from there on, nothing changes.
+        for i in range(start, len(self.__lines)):
+            if i >= end and self.__same_blocks(open_blocks, self.__blocks[i]):
+                return
+            self.__blocks[i] = open_blocks
+            open_blocks = self.__match_block(self.__lines[i], open_blocks)
+        self.__blocks[-1] = open_blocks
+
+    def __match_block(self, line, open_blocks):
+        # Like Parser.__parse_line, but on a stack of _Lines
+        keyword = line.keyword
+        line.block_error = None
+        if keyword in Parser.BLOCK_CLOSERS:
+            if open_blocks is None or open_blocks[0].keyword not in Parser.BLOCK_CLOSERS[keyword]:
+                line.block_error = errors.PyMsbUnexpectedTokenError(line.keyword_token)
+            else:
+                opener, open_blocks = open_blocks
+                if opener.statement is not None and line.statement is not None:
+                    Parser.link_block(opener.statement, line.statement)
+        if keyword in Parser.BLOCK_OPENERS and line.block_error is None:
+            open_blocks = (line, open_blocks)
+        self.__update_problems(line)
+        return open_blocks
+
+    @staticmethod
+    def __same_blocks(a, b):
+        while a is not b:
+            if a is None or b is None or a[0] is not b[0]:
+                return False
+            a, b = a[1], b[1]
+        return True
+
+    def __resolve_names(self, removed, added):
+        names = set()
+        for line in removed:
+            if line.name is not None:
+                table = self.__definitions if line.defines_name else self.__uses
+                table[line.name].remove(line)
+                if not table[line.name]:
+                    del table[line.name]
+                names.add(line.name)
+        for line in added:
+            if line.name is not None:
+                table = self.__definitions if line.defines_name else self.__uses
+                table.setdefault(line.name, []).append(line)
+                names.add(line.name)
+        for name in names:
+            self.__resolve_name(name)
+
+    def __resolve_name(self, name):
+        # Like Parser.__scan_for_labels_and_subroutines, for a single label or subroutine
+        kind, text = name
+        definitions = sorted(self.__definitions.get(name, ()), key=operator.attrgetter("line_number"))
+        for i, line in enumerate(definitions):
+            line.name_error = None
+            if i > 0:
+                message = "Another {0} exists with the same name '{1}'.".format(
+                    "Label" if kind == "label" else "Subroutine", text)
+                line.name_error = errors.PyMsbSyntaxError(line.line_number, 0, message)
+            self.__update_problems(line)
+
+        for line in self.__uses.get(name, ()):
+            line.name_error = None
+            if definitions:
+                line.statement.jump_target = definitions[0].statement
+            elif kind == "label":
+                message = "Cannot find label '{0}' used in Goto statement.".format(text)
+                line.name_error = errors.PyMsbSyntaxError(line.line_number, 0, message)
+            else:
+                line.name_error = errors.PyMsbSyntaxError(line.line_number, 0,
+                                                          "Subroutine '{0}' is not defined.".format(text))
+            self.__update_problems(line)
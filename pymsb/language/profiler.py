@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+from pymsb.language.tracing import Tracer
+
+
+class Profiler(Tracer):
+    """
+    Records how many times each statement is executed and how much wall time it takes, as well as how many times each
+    built-in function (e.g. TextWindow.WriteLine) is called and how long those calls take, keyed by the line number of
+    the statement (see abstractsyntaxtrees.Statement.line_number).
+
+    This is a tracing.Tracer; Interpreter(profile=True) installs one as self.profiler.
+
+    :param source: The Microsoft Small Basic code being profiled, for annotate().
+    """
+
+    def __init__(self, source=""):
+        self.source = source
+        self.lines = {}  # maps line numbers to [count, seconds]
+        self.builtins = {}  # maps (line number, "Object.Function") to [count, seconds]
+        self.__lock = threading.Lock()
+        # When the statement running in each InterpreterThread, and the built-in call in each thread, started
+        self.__statement_starts = {}
+        self.__builtin_starts = {}
+
+    def statement_enter(self, thread, line_number):
+        self.__statement_starts[thread] = time.perf_counter()
+
+    def statement_exit(self, thread, line_number):
+        self.__record(self.lines, line_number, time.perf_counter() - self.__statement_starts.pop(thread))
+
+    def builtin_call(self, line_number, name, args):
+        self.__builtin_starts[threading.get_ident()] = time.perf_counter()
+
+    def builtin_return(self, line_number, name, result):
+        elapsed = time.perf_counter() - self.__builtin_starts.pop(threading.get_ident())
+        self.__record(self.builtins, (line_number, name), elapsed)
+
+    def __record(self, table, key, elapsed):
+        with self.__lock:
+            entry = table.get(key)
+            if entry is None:
+                entry = table[key] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def report(self):
+        """
+        Returns the results as a dict that can be serialized as JSON: "lines" lists the statements that were executed
+        and "builtins" the built-in functions that were called, each with its "line_number", "count" and total "time"
+        in seconds.
+        """
+        with self.__lock:
+            lines = [{"line_number": line_number, "count": count, "time": seconds}
+                     for line_number, (count, seconds) in sorted(self.lines.items())]
+            builtins = [{"line_number": line_number, "name": name, "count": count, "time": seconds}
+                        for (line_number, name), (count, seconds) in sorted(self.builtins.items())]
+        return {"total_time": sum(line["time"] for line in lines), "lines": lines, "builtins": builtins}
+
+    def write_json(self, file):
+        """Writes report() to the given file-like object as JSON."""
+        json.dump(self.report(), file, indent=2)
+        file.write("\n")
+
+    def annotate(self):
+        """
+        Returns the source code as a listing in which every line is preceded by the number of times it was executed,
+        the time it took in milliseconds and its share of the total time; the built-in functions it called are listed
+        beneath it.
+        """
+        report = self.report()
+        total_time = report["total_time"] or 1.0
+        lines = {line["line_number"]: line for line in report["lines"]}
+        builtins = {}
+        for builtin in report["builtins"]:
+            builtins.setdefault(builtin["line_number"], []).append(builtin)
+
+        listing = ["{0:>10} {1:>12} {2:>6}  {3:>5}  {4}".format("count", "time (ms)", "%", "line", "source")]
+        for line_number, text in enumerate(self.source.splitlines()):
+            line = lines.get(line_number)
+            if line is None:
+                listing.append("{0:>10} {1:>12} {2:>6}  {3:>5}  {4}".format("", "", "", line_number + 1, text))
+                continue
+            listing.append("{0:>10} {1:>12.3f} {2:>6.1f}  {3:>5}  {4}".format(
+                line["count"], line["time"] * 1000, 100 * line["time"] / total_time, line_number + 1, text))
+            for builtin in builtins.get(line_number, []):
+                listing.append("{0:>10} {1:>12.3f} {2:>6}  {3:>5}    -> {4}".format(
+                    builtin["count"], builtin["time"] * 1000, "", "", builtin["name"]))
+        return "\n".join(listing) + "\n"
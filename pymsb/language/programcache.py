@@ -0,0 +1,111 @@
+import contextlib
+import functools
+import gc
+import hashlib
+import os
+import pickle
+
+# Increased whenever the ASTs or the Optimizer change, so that programs cached by older code are compiled again.
+FORMAT_VERSION = 1
+
+# The directory next to a source file where its compiled program is cached, like Python's __pycache__
+CACHE_DIRECTORY = "__pymsbcache__"
+
+
+@functools.lru_cache(maxsize=None)
+def pymsb_version():
+    """
+    Returns a hash of pymsb's own source files, which identifies the code that compiles programs more reliably than a
+    version number: it is known for a source checkout as well as an installed package, and changes whenever any of
+    the files is edited.  Returns None if the source files can't be read.
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    found = False
+    try:
+        for directory, subdirectories, file_names in os.walk(package_dir):
+            subdirectories.sort()  # so that the files are always hashed in the same order
+            for file_name in sorted(file_names):
+                if file_name.endswith(".py"):
+                    path = os.path.join(directory, file_name)
+                    digest.update(os.path.relpath(path, package_dir).encode("utf-8", "surrogateescape"))
+                    with open(path, "rb") as source_file:
+                        digest.update(source_file.read())
+                    found = True
+    except OSError:
+        return None
+    return digest.hexdigest() if found else None
+
+
+def cache_key(source, settings):
+    """
+    Returns the key that a program compiled from the given source is cached under: a hash of the source, the settings
+    that affect compiling it (e.g. whether it is optimized), FORMAT_VERSION and pymsb_version().  Returns None if the
+    version of pymsb is unknown, in which case the program shouldn't be cached, since a cache written by other code
+    could be loaded.
+    """
+    version = pymsb_version()
+    if version is None:
+        return None
+    key = hashlib.sha256(repr((FORMAT_VERSION, version, settings)).encode())
+    key.update(source.encode("utf-8", "surrogatepass"))
+    return key.hexdigest()
+
+
+def cache_path(key, source_path=None, cache_dir=None):
+    """
+    Returns the path of the file that caches the program with the given key: a file named after the key in cache_dir,
+    if given, or else a file named after the source file in the CACHE_DIRECTORY next to it, or None if neither is
+    given.
+    """
+    if cache_dir is not None:
+        return os.path.join(cache_dir, key + ".pickle")
+    if source_path:
+        directory, file_name = os.path.split(os.path.abspath(source_path))
+        return os.path.join(directory, CACHE_DIRECTORY, file_name + ".pickle")
+    return None
+
+
+def load(path, key):
+    """
+    Returns the compiledprogram.CompiledProgram that save wrote to path, or None if there is no such file or it caches a
+    different key (e.g. because the source has changed since).  Like Python's own bytecode cache, the file is trusted.
+    """
+    try:
+        with open(path, "rb") as cache_file:
+            if pickle.load(cache_file) != key:
+                return None
+            with _gc_paused():
+                return pickle.load(cache_file)
+    except Exception:  # e.g. a truncated file, or one that refers to classes that have changed
+        return None
+
+
+def save(program, path, key):
+    """
+    Writes a compiledprogram.CompiledProgram to path, creating its directory if necessary.  The file is replaced
+    atomically, so that programs running at the same time never read a partially written cache.  If the file can't be
+    written (e.g. because the directory is read-only), the program just isn't cached.
+    """
+    temp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, "wb") as cache_file, _gc_paused():
+            pickle.dump(key, cache_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(program, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except (OSError, RecursionError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # Pickling creates or visits an object for every AST node, which would trigger many pointless garbage collections
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
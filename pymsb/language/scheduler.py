@@ -0,0 +1,139 @@
+import collections
+import queue
+import threading
+import traceback
+
+from pymsb.language.eventdispatcher import EventDispatcher
+
+
+class CooperativeScheduler(EventDispatcher):
+    """
+    Runs the main program and the subroutines assigned to events in a single thread, by interleaving resumable frames
+    (see interpreter.InterpreterThread.run_for) instead of running each one in a thread of its own.  Each frame in turn
+    runs for at most instruction_budget instructions before the next one gets to run.
+
+    Events may still be triggered from other threads (e.g. by the Timer); they are queued, and their handlers start in
+    the scheduler's thread the next time it steps.  Events are coalesced, dropped or queued just like by an
+    EventDispatcher.
+
+    :param create_frame: A callable that takes the name of a subroutine and returns a new frame that will run it.  A
+                         frame has a run_for(budget) method that runs for at most budget instructions and returns
+                         whether it has finished.
+    :param policy: One of EventDispatcher.POLICIES.
+    :param instruction_budget: The maximum number of instructions that a frame runs before it is suspended.
+    :param max_queue_size: The number of pending calls per event that the "queue" policy keeps.
+    :param on_idle: A callable taking no arguments, called whenever the last frame finishes.
+    :param wake: A callable taking no arguments, called from any thread whenever there is new work for the scheduler,
+                 e.g. to have a GUI mainloop call step() soon.
+    """
+
+    def __init__(self, create_frame, policy="coalesce", instruction_budget=1000, max_queue_size=64, on_idle=None,
+                 wake=None):
+        super().__init__(None, policy, max_workers=0, max_queue_size=max_queue_size, on_idle=on_idle)
+        self.create_frame = create_frame
+        self.instruction_budget = instruction_budget
+        self.wake = wake
+
+        self.__ready = queue.SimpleQueue()  # events that became active and have no frame yet
+        self.__wakeup = threading.Event()
+        self.__frames = collections.deque()  # (frame, event name) pairs; the event name is None for the main program
+        self.__stepping = False
+        # Held while stepping, so that holding it guarantees that every frame is suspended between two instructions
+        self.lock = threading.RLock()
+
+    def add_frame(self, frame, event_name=None):
+        """
+        Adds a frame, such as the main program.  If the frame is running the handler of an event (e.g. one restored
+        from a snapshot), the event stays active until the frame has finished.
+        """
+        if event_name is not None:
+            self._activate(event_name)
+        with self.lock:
+            self.__frames.append((frame, event_name))
+        self.__notify()
+
+    @property
+    def frames(self):
+        """Returns a list of the (frame, event name) pairs of the frames that have yet to finish."""
+        with self.lock:
+            return list(self.__frames)
+
+    def step(self):
+        """
+        Starts the handlers of any newly triggered events, then runs every frame once, for at most instruction_budget
+        instructions each.  Must always be called from the same thread.
+
+        :return: True if there are frames left to run, or False if the scheduler is idle until the next event.
+        """
+        if self.__stepping:
+            return bool(self.__frames)  # e.g. a blocking call is letting a GUI mainloop handle events meanwhile
+        with self.lock:
+            return self.__step()
+
+    def __step(self):
+        self.__stepping = True
+        try:
+            while True:
+                try:
+                    event_name = self.__ready.get_nowait()
+                except queue.Empty:
+                    break
+                self.__start_next_call(event_name)
+
+            for _ in range(len(self.__frames)):
+                if self.stopped:
+                    self.__frames.clear()
+                    break
+                # The frame stays in self.__frames while it runs, so that a snapshot taken meanwhile includes it
+                frame, event_name = self.__frames[0]
+                # noinspection PyBroadException
+                try:
+                    finished = frame.run_for(self.instruction_budget)
+                except Exception:
+                    traceback.print_exc()  # like an uncaught exception in a thread, this only stops this frame
+                    finished = True
+                if not finished:
+                    self.__frames.rotate(-1)
+                    continue
+                self.__frames.popleft()
+                if event_name is not None:
+                    self.__start_next_call(event_name)
+
+            if not self.__frames and self.on_idle is not None:
+                self.on_idle()
+            return bool(self.__frames)
+        finally:
+            self.__stepping = False
+
+    def run(self):
+        """Steps until the scheduler is idle and no event handler is pending, or until stop() is called."""
+        while not self.stopped:
+            if self.step():
+                continue
+            if self.is_idle():
+                return
+            self.__wakeup.wait()
+            self.__wakeup.clear()
+
+    def is_idle(self):
+        """Returns whether no frames are running and no event handlers are pending."""
+        return not self.__frames and super().is_idle()
+
+    def stop(self):
+        """Stops dispatching events and running frames."""
+        super().stop()
+        self.__notify()
+
+    def _schedule(self, event_name):
+        self.__ready.put(event_name)
+        self.__notify()
+
+    def __start_next_call(self, event_name):
+        sub_name = self._next_call(event_name)
+        if sub_name is not None:
+            self.__frames.append((self.create_frame(sub_name), event_name))
+
+    def __notify(self):
+        self.__wakeup.set()
+        if self.wake is not None:
+            self.wake()
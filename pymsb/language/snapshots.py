@@ -0,0 +1,26 @@
+import gzip
+import json
+import os
+
+# The format of the snapshots written by save; increased whenever the format changes incompatibly.
+VERSION = 1
+
+
+def save(snapshot, path):
+    """
+    Writes a snapshot, as returned by Interpreter.snapshot, to a compressed file.  The file is replaced atomically, so
+    that an interrupted checkpoint never leaves a corrupt snapshot behind.
+    """
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=1) as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def load(path):
+    """Reads a snapshot written by save, for Interpreter.resume."""
+    with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    if snapshot.get("version") != VERSION:
+        raise ValueError("Unsupported snapshot version {0}; expected {1}.".format(snapshot.get("version"), VERSION))
+    return snapshot
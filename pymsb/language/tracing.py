@@ -0,0 +1,140 @@
+import pymsb.language.instructions as instructions
+
+
+class Tracer:
+    """
+    The base class for objects that observe a running program, such as profiler.Profiler.  Install a tracer with
+    Interpreter.add_tracer before executing a program, and override the hooks it needs; the others cost nothing,
+    since only the code paths that some tracer actually hooks into are instrumented.
+
+    Hooks may be called from several threads at once (the main program and event handlers), and thread is the
+    interpreter.InterpreterThread that is running.  Statements are identified by their line number (see
+    abstractsyntaxtrees.Statement.line_number), built-in members by names like "TextWindow.WriteLine".
+    """
+
+    def statement_enter(self, thread, line_number):
+        """Called before an instruction of the statement at line_number is executed."""
+
+    def statement_exit(self, thread, line_number):
+        """Called after an instruction of the statement at line_number is executed."""
+
+    def builtin_call(self, line_number, name, args):
+        """Called before a built-in function is called, or a built-in property is read (with no args)."""
+
+    def builtin_return(self, line_number, name, result):
+        """Called after a built-in function or property returns result."""
+
+    def subroutine_enter(self, thread, sub_name):
+        """Called when a subroutine is called, or starts running because of an event."""
+
+    def subroutine_exit(self, thread, sub_name):
+        """Called when a subroutine reaches its EndSub."""
+
+    def event_dispatched(self, event_name, sub_name):
+        """Called when an event (e.g. "Timer.Tick") is triggered, before its subroutine is dispatched."""
+
+
+class TraceHooks:
+    """
+    Forwards every hook to each of the given tracers that overrides it, and instruments a loaded program so that the
+    hooks are called.  The Interpreter creates one when a program with tracers installed is loaded.
+    """
+
+    HOOKS = ("statement_enter", "statement_exit", "builtin_call", "builtin_return", "subroutine_enter",
+             "subroutine_exit", "event_dispatched")
+
+    def __init__(self, tracers):
+        self.tracers = list(tracers)
+        for hook in TraceHooks.HOOKS:
+            setattr(self, hook, self.__combine(hook))
+
+    def traces(self, *hooks):
+        """Returns whether any tracer overrides any of the given hooks."""
+        return any(getattr(self, hook) is not None for hook in hooks)
+
+    def __combine(self, hook):
+        # Returns a callable that calls the hook of every tracer overriding it, or None if no tracer does
+        functions = [getattr(tracer, hook) for tracer in self.tracers
+                     if getattr(type(tracer), hook) is not getattr(Tracer, hook)]
+        if not functions:
+            return None
+        if len(functions) == 1:
+            return functions[0]
+
+        def call_all(*args):
+            for function in functions:
+                function(*args)
+        return call_all
+
+    def instrument(self, program_instructions, subroutine_locations):
+        """
+        Replaces the execute method of the (compiled) instructions that have to call hooks.
+
+        :param program_instructions: The list of instructions.Instruction instances returned by Linker.link.
+        :param subroutine_locations: The Linker's map from lowercase subroutine names to the index of their bodies.
+        """
+        # Each subroutine ends at the first ReturnFromSubroutine after the start of its body, since subs can't nest
+        sub_names = {}
+        for sub_name, location in subroutine_locations.items():
+            sub_names[location] = sub_name
+        sub_name = None
+        for index, instruction in enumerate(program_instructions):
+            sub_name = sub_names.get(index, sub_name)
+            execute = instruction.execute
+            if self.subroutine_enter is not None and isinstance(instruction, instructions.CallSubroutine):
+                name = instruction.statement.name.lower()
+                execute = self.__enter_subroutine(execute, name)
+            elif self.subroutine_exit is not None and isinstance(instruction, instructions.ReturnFromSubroutine):
+                execute = self.__exit_subroutine(execute, sub_name)
+            if self.traces("statement_enter", "statement_exit"):
+                execute = self.__trace_statement(execute, instruction.line_number)
+            if execute is not instruction.execute:
+                instruction.execute = execute
+
+    def __enter_subroutine(self, execute, sub_name):
+        subroutine_enter = self.subroutine_enter
+
+        def traced(thread):
+            subroutine_enter(thread, sub_name)
+            return execute(thread)
+        return traced
+
+    def __exit_subroutine(self, execute, sub_name):
+        subroutine_exit = self.subroutine_exit
+
+        def traced(thread):
+            subroutine_exit(thread, sub_name)
+            return execute(thread)
+        return traced
+
+    def __trace_statement(self, execute, line_number):
+        statement_enter = self.statement_enter or (lambda thread, line: None)
+        statement_exit = self.statement_exit or (lambda thread, line: None)
+
+        def traced(thread):
+            statement_enter(thread, line_number)
+            next_index = execute(thread)
+            statement_exit(thread, line_number)
+            return next_index
+        return traced
+
+    def wrap_builtin(self, line_number, name, function):
+        """Returns a callable that calls function with the same arguments, between builtin_call and builtin_return."""
+        builtin_call = self.builtin_call or (lambda line, member, args: None)
+        builtin_return = self.builtin_return or (lambda line, member, result: None)
+
+        def traced(*args):
+            builtin_call(line_number, name, args)
+            result = function(*args)
+            builtin_return(line_number, name, result)
+            return result
+        return traced
+
+    def wrap_dispatch(self, dispatch):
+        """Returns a callable that calls event_dispatched, then dispatch, with the same event and subroutine names."""
+        event_dispatched = self.event_dispatched
+
+        def traced(event_name, sub_name):
+            event_dispatched(event_name, sub_name)
+            dispatch(event_name, sub_name)
+        return traced
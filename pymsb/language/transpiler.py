@@ -0,0 +1,387 @@
+import contextlib
+
+import pymsb.language.abstractsyntaxtrees as ast
+import pymsb.language.errors as errors
+import pymsb.language.values as values
+from pymsb.language.modules import utilities
+
+
+class Transpiler:
+    """
+    The Transpiler translates the list of statement ASTs produced by the Parser into the source code of a single Python
+    module, which the Interpreter runs with compile() and exec() as an alternative to the InterpreterThread.
+
+    For, While, If and subroutines become native Python control flow.  A function (the main program or a subroutine)
+    that contains labels is split into blocks at its labels, and runs as a dispatch loop over those blocks, where each
+    Goto returns the index of the block to run next.  Every loop, including the dispatch loop, checks whether the
+    program has ended (e.g. an event handler called Program.End) before each iteration, like the InterpreterThread does.
+
+    The generated module defines main() and one function per subroutine, and expects the names provided by
+    Transpiler.create_namespace to be defined in its globals.
+    """
+
+    # Each level of an expression becomes up to three levels of parentheses in the generated code, and compile() gives
+    # up at 200, so formulas nested deeper than this (e.g. hundreds of terms added up) are left to the interpreter.
+    max_expression_depth = 50
+
+    def __init__(self):
+        self.environment = None
+        self.lines = []
+        self.subroutine_functions = {}
+        self.__label_blocks = {}
+        self.__label_functions = {}
+        self.__objects_used = set()
+        self.__expression_depth = 0
+
+    def transpile(self, statements, environment):
+        """
+        Consumes a list of statement ASTs, as returned by Parser.parse, and returns the source code of a Python module
+        that executes them.  After transpiling, self.subroutine_functions maps each lowercase subroutine name to the
+        name of the Python function for that subroutine.
+
+        :param statements: A list of abstractsyntaxtrees.Statement instances.
+        :param environment: The interpreter.Environment that resolves variable names to slots.
+        :return: A string of Python source code.
+        :raise errors.PyMsbTranspilerError: If the program cannot be expressed with the Python backend.
+        """
+        self.environment = environment
+        self.lines = []
+        self.subroutine_functions = {}
+        self.__label_blocks = {}
+        self.__label_functions = {}
+        self.__objects_used = set()
+        self.__expression_depth = 0
+
+        main_body, subroutines = self.__build_tree(statements)
+
+        self.__emit_function("main", main_body, 0)
+        for sub_statement, body in subroutines:
+            function_name = "_sub_" + sub_statement.sub_name
+            self.subroutine_functions[sub_statement.sub_name.lower()] = function_name
+            self.__emit_function(function_name, body, 0)
+
+        # Bind every built-in object used by the program once, when the module is executed
+        header = ["_obj_{0} = _objects[{0!r}]".format(name) for name in sorted(self.__objects_used)]
+        return "\n".join(header + self.lines) + "\n"
+
+    @staticmethod
+    def create_namespace(interpreter):
+        """
+        Returns the globals for executing a transpiled module on behalf of the given Interpreter.
+        """
+        array_parser = interpreter.array_parser
+        return {
+            "_objects": interpreter.msb_objects,
+            "_variables": interpreter.environment.variables,
+            "_get_value": array_parser.get_value,
+            "_set_value": array_parser.set_value,
+            "_text": values.to_text,
+            "_number": values.to_number,
+            "_number_or_text": values.to_number_or_text,
+            "_is_true": values.is_true,
+            "_equals": values.equals,
+            "_add": values.add,
+            "_increment": values.increment,
+            "_and": _and,
+            "_or": _or,
+            "_ended": False,  # set by the Interpreter when the program ends
+            "_ProgramEnded": errors.PyMsbProgramEnded,
+        }
+
+    # ==========================================================================================
+    # Building the nested block structure
+
+    def __build_tree(self, statements):
+        # Returns the body of the main program and a list of (SubStatement, body) pairs.  A body is a list whose
+        # elements are simple statements, labels and gotos, or tuples for compound statements:
+        # ("For", ForStatement, body), ("While", WhileStatement, body) and ("If", [(IfStatement, body), ...]).
+        main_body = []
+        subroutines = []
+        bodies = [main_body]  # the innermost body is last
+        open_ifs = []
+        function_name = "main"
+
+        for statement in statements:
+            body = bodies[-1]
+            if isinstance(statement, ast.SubStatement):
+                sub_body = []
+                subroutines.append((statement, sub_body))
+                bodies.append(sub_body)
+                function_name = "_sub_" + statement.sub_name
+            elif isinstance(statement, ast.EndSubStatement):
+                bodies.pop()
+                function_name = "main"
+            elif isinstance(statement, (ast.ForStatement, ast.WhileStatement)):
+                loop_body = []
+                body.append((statement.keyword, statement, loop_body))
+                bodies.append(loop_body)
+            elif isinstance(statement, (ast.EndForStatement, ast.EndWhileStatement)):
+                bodies.pop()
+            elif isinstance(statement, ast.IfStatement):
+                branch_body = []
+                if statement.keyword == "If":
+                    branches = [(statement, branch_body)]
+                    body.append(("If", branches))
+                    open_ifs.append(branches)
+                else:
+                    bodies.pop()
+                    open_ifs[-1].append((statement, branch_body))
+                bodies.append(branch_body)
+            elif isinstance(statement, ast.EndIfStatement):
+                bodies.pop()
+                open_ifs.pop()
+            else:
+                if isinstance(statement, ast.LabelDefinition):
+                    # Labels split the function they appear in into blocks, so they must be at its top level
+                    if len(bodies) != (1 if function_name == "main" else 2):
+                        raise errors.PyMsbTranspilerError(
+                            "Label '{0}' is inside a code block.".format(statement.label_name))
+                    self.__label_functions[statement.label_name] = function_name
+                body.append(statement)
+
+        return main_body, subroutines
+
+    # ==========================================================================================
+    # Emitting Python code
+
+    def __emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def __emit_function(self, function_name, body, indent):
+        labels = [s for s in body if isinstance(s, ast.LabelDefinition)]
+        if not labels:
+            self.__emit(indent, "def {0}():".format(function_name))
+            self.__emit_body(body, indent + 1, function_name)
+            return
+
+        # Split into blocks at each label; each block function returns the index of the next block to run.
+        blocks = [[]]
+        for statement in body:
+            if isinstance(statement, ast.LabelDefinition):
+                self.__label_blocks[statement.label_name] = len(blocks)
+                blocks.append([])
+            else:
+                blocks[-1].append(statement)
+
+        block_names = []
+        for block_index, block in enumerate(blocks):
+            block_name = "{0}_block_{1}".format(function_name, block_index)
+            block_names.append(block_name)
+            self.__emit(indent, "def {0}():".format(block_name))
+            self.__emit_body(block, indent + 1, function_name)
+            if block_index + 1 < len(blocks):
+                self.__emit(indent + 1, "return {0}".format(block_index + 1))
+
+        self.__emit(indent, "def {0}():".format(function_name))
+        self.__emit(indent + 1, "blocks = ({0},)".format(", ".join(block_names)))
+        self.__emit(indent + 1, "block_index = 0")
+        self.__emit(indent + 1, "while block_index is not None:")
+        self.__emit_end_check(indent + 2)
+        self.__emit(indent + 2, "block_index = blocks[block_index]()")
+
+    def __emit_body(self, body, indent, function_name):
+        start = len(self.lines)
+        for element in body:
+            self.__emit_element(element, indent, function_name)
+        if len(self.lines) == start:
+            self.__emit(indent, "pass")
+
+    def __emit_element(self, element, indent, function_name):
+        if isinstance(element, tuple):
+            if element[0] == "For":
+                self.__emit_for(element[1], element[2], indent, function_name)
+            elif element[0] == "While":
+                self.__emit(indent, "while {0}:".format(self.__truth(element[1].condition_expr)))
+                self.__emit_end_check(indent + 1)
+                self.__emit_body(element[2], indent + 1, function_name)
+            else:
+                keyword = "if"
+                for if_statement, branch_body in element[1]:
+                    if if_statement.condition_expr is None:
+                        self.__emit(indent, "else:")
+                    else:
+                        self.__emit(indent, "{0} {1}:".format(keyword, self.__truth(if_statement.condition_expr)))
+                    self.__emit_body(branch_body, indent + 1, function_name)
+                    keyword = "elif"
+            return
+
+        if isinstance(element, ast.Assignment):
+            self.__emit_assignment(element.var, element.val, indent)
+        elif isinstance(element, ast.MsbObjectFunctionCall):
+            self.__emit(indent, self.__expression(element))
+        elif isinstance(element, ast.SubroutineCall):
+            self.__emit(indent, "_sub_{0}()".format(element.name))
+        elif isinstance(element, ast.GotoStatement):
+            if self.__label_functions.get(element.label_name) != function_name:
+                raise errors.PyMsbTranspilerError(
+                    "Goto '{0}' jumps out of the subroutine or main program.".format(element.label_name))
+            self.__emit(indent, "return {0}".format(self.__label_blocks[element.label_name]))
+        else:
+            raise NotImplementedError(repr(element))
+
+    def __emit_for(self, for_statement, body, indent, function_name):
+        # The loop variable is assigned the lower expression once, then the loop runs until the variable is greater
+        # than the upper expression, which is re-evaluated before every iteration unless it is a literal.  A numeric
+        # literal lower bound is stored as a native number, so that _number and _increment don't need to convert the
+        # loop variable from text.
+        var_ast = for_statement.var_ast
+        lower_expr = for_statement.lower_expr
+        if isinstance(lower_expr, ast.LiteralValue):
+            lower_expr = ast.LiteralValue(values.to_native(lower_expr.value))
+        self.__emit_assignment(var_ast, lower_expr, indent)
+        variable = self.__variable(var_ast.variable_name)
+        self.__emit(indent, "while not (_number({0}) > {1}):".format(variable,
+                                                                     self.__number(for_statement.upper_expr)))
+        self.__emit_end_check(indent + 1)
+        self.__emit_body(body, indent + 1, function_name)
+        self.__emit(indent + 1, "{0} = _increment({0})".format(variable))
+
+    def __emit_end_check(self, indent):
+        # Stops the thread running the loop that this starts the body of, once the program has ended
+        self.__emit(indent, "if _ended:")
+        self.__emit(indent + 1, "raise _ProgramEnded()")
+
+    def __emit_assignment(self, destination_ast, value_ast, indent):
+        if isinstance(destination_ast, ast.UserVariable):
+            variable = self.__variable(destination_ast.variable_name)
+
+            # Assigning to variable as an array using one or more indices.  The array is read before evaluating the
+            # indices and the value.
+            if destination_ast.array_indices:
+                self.__emit(indent, "{0} = _set_value(_text({0}), {1}, {2})  # {3}".format(
+                    variable, self.__index_list(destination_ast.array_indices), self.__text(value_ast),
+                    destination_ast.variable_name))
+
+            # Just overwriting variable
+            else:
+                self.__emit(indent, "{0} = {1}  # {2}".format(variable, self.__expression(value_ast),
+                                                              destination_ast.variable_name))
+            return
+
+        obj = self.__object(destination_ast.msb_object)
+        member_name = utilities.capitalize(destination_ast.msb_object_field_name)
+        info = utilities.get_msb_builtin_info(destination_ast.msb_object, member_name)
+        if info is not None and info.type == "event":
+            self.__emit(indent, "{0}.set_event_sub({1!r}, {2!r})".format(obj, member_name, value_ast.variable_name))
+        else:
+            self.__emit(indent, "setattr({0}, {1!r}, {2})".format(obj, member_name, self.__text(value_ast)))
+
+    # ==========================================================================================
+    # Translating expressions into Python expressions, with the semantics of the ExpressionCompiler
+
+    def __truth(self, val_ast):
+        # A Python expression that evaluates to a bool
+        if isinstance(val_ast, ast.Comparison):
+            return self.__comparison(val_ast.comparator, val_ast.left, val_ast.right)
+        return "_is_true({0})".format(self.__expression(val_ast))
+
+    def __condition(self, val_ast):
+        with self.__nesting():
+            # Results in a bool if this is actually a comparison, otherwise evaluates as an expression.
+            if isinstance(val_ast, ast.Comparison):
+                return self.__comparison(val_ast.comparator, val_ast.left, val_ast.right)
+            return self.__expression(val_ast)
+
+    def __comparison(self, comp, left, right):
+        if comp in ("<", "<=", ">", ">="):
+            return "({0} {1} {2})".format(self.__number(left), comp, self.__number(right))
+        left = self.__condition(left)
+        right = self.__condition(right)
+        if comp == "=":
+            return "_equals({0}, {1})".format(left, right)
+        if comp == "<>":
+            return "(not _equals({0}, {1}))".format(left, right)
+        if comp.lower() == "and":
+            return "_and({0}, {1})".format(left, right)
+        if comp.lower() == "or":
+            return "_or({0}, {1})".format(left, right)
+        raise NotImplementedError(comp)
+
+    def __expression(self, val_ast):
+        with self.__nesting():
+            return self.__value(val_ast)
+
+    def __value(self, val_ast):
+        if isinstance(val_ast, ast.LiteralValue):
+            return repr(val_ast.value)
+
+        if isinstance(val_ast, ast.UserVariable):
+            variable = self.__variable(val_ast.variable_name)
+            if val_ast.array_indices:
+                return "_get_value(_text({0}), {1})".format(variable, self.__index_list(val_ast.array_indices))
+            return variable
+
+        if isinstance(val_ast, ast.MsbObjectField):
+            return self.__member(val_ast.msb_object, val_ast.msb_object_field_name)
+
+        if isinstance(val_ast, ast.Operation):
+            if val_ast.operator == "+":
+                return "_add({0}, {1})".format(self.__addend(val_ast.left), self.__addend(val_ast.right))
+            return "({0} {1} {2})".format(self.__number(val_ast.left), val_ast.operator, self.__number(val_ast.right))
+
+        if isinstance(val_ast, ast.MsbObjectFunctionCall):
+            args = ", ".join(self.__text(arg_ast) for arg_ast in val_ast.parameter_asts)
+            return "{0}({1})".format(self.__member(val_ast.msb_object, val_ast.msb_object_function), args)
+
+        raise errors.PyMsbTranspilerError("Cannot use {0} as a value.".format(val_ast))
+
+    @contextlib.contextmanager
+    def __nesting(self):
+        # Keeps count of how deeply the expression being translated is nested
+        if self.__expression_depth >= self.max_expression_depth:
+            raise errors.PyMsbTranspilerError("Expressions nested more than {0} levels deep are not supported.".format(
+                self.max_expression_depth))
+        self.__expression_depth += 1
+        try:
+            yield
+        finally:
+            self.__expression_depth -= 1
+
+    def __text(self, val_ast):
+        if isinstance(val_ast, ast.LiteralValue):
+            return repr(values.to_text(val_ast.value))
+        return "_text({0})".format(self.__expression(val_ast))
+
+    def __number(self, val_ast):
+        # Literals are converted here, once, rather than every time they are evaluated
+        if isinstance(val_ast, ast.LiteralValue):
+            return repr(values.to_number(val_ast.value))
+        if isinstance(val_ast, ast.Operation) and val_ast.operator != "+":
+            return self.__expression(val_ast)  # always results in a number already
+        return "_number({0})".format(self.__expression(val_ast))
+
+    def __addend(self, val_ast):
+        if isinstance(val_ast, ast.LiteralValue):
+            return repr(values.to_number_or_text(val_ast.value))
+        if isinstance(val_ast, ast.Operation) and val_ast.operator != "+":
+            return self.__expression(val_ast)  # always results in a number already
+        return "_number_or_text({0})".format(self.__expression(val_ast))
+
+    def __index_list(self, index_asts):
+        return "[{0}]".format(", ".join(self.__text(i) for i in index_asts))
+
+    def __variable(self, variable_name):
+        return "_variables[{0}]".format(self.environment.slot(variable_name))
+
+    def __member(self, obj_name, member_name):
+        member_name = utilities.capitalize(member_name)
+        if member_name is None:
+            return "getattr({0}, None)".format(self.__object(obj_name))
+        return "{0}.{1}".format(self.__object(obj_name), member_name)
+
+    def __object(self, obj_name):
+        obj_name = utilities.capitalize(obj_name)
+        if obj_name is None:
+            return "_objects[None]"
+        self.__objects_used.add(obj_name)
+        return "_obj_" + obj_name
+
+
+# Helpers used by the generated code, with the same semantics as the ExpressionCompiler.
+
+def _and(left, right):
+    return values.is_true(left) and values.is_true(right)
+
+
+def _or(left, right):
+    return values.is_true(left) or values.is_true(right)
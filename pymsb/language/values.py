@@ -0,0 +1,162 @@
+import re
+
+from pymsb.language.modules import utilities
+
+# Microsoft Small Basic only has one type of value, the string, but converting every intermediate result to a string
+# and parsing it back at the next operation is slow.  Instead, values are kept in the most natural Python type, which
+# serves as the value's tag:
+#
+#  - str: text, as written in a literal, read from a variable that was assigned text, or returned by a built-in.
+#  - int or float: a number produced by arithmetic.
+#  - bool: the result of a comparison.
+#  - Rope: long text built by concatenation, e.g. by s = s + x in a loop.
+#
+# A value is only converted to its Microsoft Small Basic string form when it is observed as text, e.g. when it is passed
+# to a built-in, stored in an array or concatenated with text.  Concatenating onto a Rope doesn't convert it, so that
+# building text one piece at a time takes linear rather than quadratic time.
+
+# Concatenations whose result is shorter than this produce a str; copying short text is cheaper than keeping a Rope.
+ROPE_MIN_LENGTH = 256
+
+# A character that can't be part of any text that float() accepts, or whitespace between two characters that can
+_NOT_A_NUMBER = re.compile(r"[^\d\s+\-._eEinfatyINFATY]|\S\s+\S")
+
+
+class Rope:
+    """
+    Text made of chunks that are only joined when the text is needed, by str().  A Rope never changes, but it may share
+    its list of chunks with other Ropes: appending to the Rope that ends at the end of the list extends the list in
+    place, so that appending is usually O(1).
+
+    :param chunks: The list of str chunks, which may extend beyond this Rope.
+    :param count: The number of chunks at the start of the list that make up this Rope.
+    :param length: The total length of those chunks.
+    :param numeric: False if the text can't be numerical, so that "+" can treat it as text without joining it; True if
+                    it has to be joined to find out.
+    """
+
+    __slots__ = ("chunks", "count", "length", "numeric", "text")
+
+    def __init__(self, chunks, count, length, numeric):
+        self.chunks = chunks
+        self.count = count
+        self.length = length
+        self.numeric = numeric
+        self.text = None  # the joined chunks, once they have been needed
+
+    def append(self, text):
+        """Returns a Rope of this text followed by the given str."""
+        if not text:
+            return self
+        numeric = self.numeric and _may_be_number(self.chunks[self.count - 1], text)
+        chunks, count = self.chunks, self.count
+        if len(chunks) == count:
+            chunks.append(text)
+            # Another thread may have extended the list first, in which case this Rope can't share it after all
+            if chunks[count] is text:
+                return Rope(chunks, count + 1, self.length + len(text), numeric)
+        return Rope([str(self), text], 2, self.length + len(text), numeric)
+
+    def __str__(self):
+        if self.text is None:
+            self.text = "".join(self.chunks[:self.count])
+        return self.text
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "Rope<{0} chunks, {1} characters>".format(self.count, self.length)
+
+
+def _may_be_number(left, right):
+    # Whether left + right could still be numerical, given that left could be
+    if _NOT_A_NUMBER.search(right):
+        return False
+    # e.g. "1 " + "2"
+    return not (left[-1].isspace() or right[0].isspace()) or not (left.strip() and right.strip())
+
+
+def to_text(value):
+    """Returns the Microsoft Small Basic string form of the given value."""
+    if type(value) is str:
+        return value
+    return str(value)  # "True"/"False" for booleans, and the joined chunks of a Rope
+
+
+def to_number(value):
+    """Returns the given value as a number, where anything that is non-numerical is treated like 0."""
+    if type(value) is str:
+        return utilities.numericize(value, True)
+    if type(value) is bool:
+        return 0  # i.e. the number of "True" or "False"
+    if type(value) is Rope:
+        return utilities.numericize(str(value), True) if value.numeric else 0
+    return value
+
+
+def to_number_or_text(value):
+    """Returns the given value as a number if it is numerical, otherwise as text; this is how "+" sees its operands."""
+    if type(value) is str:
+        return utilities.numericize(value, False)
+    if type(value) is bool:
+        return str(value)
+    if type(value) is Rope and value.numeric:
+        return utilities.numericize(str(value), False)
+    return value
+
+
+def to_native(value):
+    """
+    Returns the number whose string form is exactly the given text, e.g. 10 for "10", or the value itself if there is no
+    such number (e.g. for "010", which must still read back as "010").
+    """
+    if type(value) is str:
+        number = utilities.numericize(value, False)
+        if type(number) is not str and str(number) == value:
+            return number
+    return value
+
+
+def is_true(value):
+    """Returns whether the given value is the boolean "True" (case-insensitively, if it is text)."""
+    if type(value) is bool:
+        return value
+    return to_text(value).lower() == "true"
+
+
+def add(left, right):
+    """
+    Adds the operands if they are both numerical, otherwise concatenates their text.  The operands must already have
+    been converted with to_number_or_text.
+    """
+    if type(left) is str or type(right) is str:
+        return concatenate(left, right)  # e.g. s = s + "text", which has to build a Rope once s gets long
+    try:
+        return left + right
+    except TypeError:
+        return concatenate(left, right)
+
+
+def concatenate(left, right):
+    """Returns the text of left followed by the text of right, as a Rope if it is long."""
+    if type(left) is Rope:
+        return left.append(to_text(right))
+    left, right = to_text(left), to_text(right)
+    if len(left) + len(right) < ROPE_MIN_LENGTH or not left:
+        return left + right
+    return Rope([left], 1, len(left), not _NOT_A_NUMBER.search(left)).append(right)
+
+
+def increment(value):
+    """Returns value + 1, with the semantics of "+"; this is how a For loop steps its variable."""
+    if type(value) is int or type(value) is float:
+        return value + 1
+    return add(to_number_or_text(value), 1)
+
+
+def equals(left, right):
+    """Compares the text of two values, so that e.g. the number 5 equals the text "5"."""
+    if type(left) is str and type(right) is str:
+        return left == right
+    return to_text(left) == to_text(right)
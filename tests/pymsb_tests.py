@@ -9,3 +9,883 @@ def teardown():
 
 def test_basic():
     print("Basic test ran.")
+
+
+def test_linker_resolves_jump_targets():
+    from pymsb.language.parser import Parser
+    from pymsb.language.linker import Linker
+    import pymsb.language.instructions as instructions
+
+    code = """
+    Sub Greet
+        TextWindow.WriteLine("hi")
+    EndSub
+    top:
+    While x < 3
+        x = x + 1
+        Greet()
+    EndWhile
+    Goto top
+    """
+    linker = Linker()
+    code_instructions = linker.link(Parser().parse(code))
+
+    assert isinstance(code_instructions[0], instructions.Jump) and code_instructions[0].target == 3
+    assert linker.subroutine_locations["greet"] == 1
+    assert isinstance(code_instructions[3], instructions.JumpIfFalse) and code_instructions[3].target == 7
+    assert code_instructions[5].target == 1  # Greet()
+    assert code_instructions[6].target == 3  # EndWhile
+    assert code_instructions[7].target == 3  # Goto top
+
+
+def test_expression_compiler():
+    from pymsb.language.expressioncompiler import ExpressionCompiler
+    import pymsb.language.abstractsyntaxtrees as ast
+
+    interpreter = pymsb.Interpreter()
+    interpreter.msb_objects = {}
+    compiler = ExpressionCompiler(interpreter)
+    interpreter.environment.bind("x", "5")
+
+    expr = ast.Operation("*", ast.UserVariable("X"), ast.Operation("+", ast.LiteralValue("1"), ast.LiteralValue("2")))
+    assert compiler.compile_expression(expr)() == 15
+    assert compiler.compile_expression(ast.Operation("+", ast.LiteralValue("a"), ast.UserVariable("x")))() == "a5"
+    assert compiler.compile_condition(ast.Comparison("<", ast.UserVariable("x"), ast.LiteralValue("10")))() is True
+
+
+def test_transpiler_uses_dispatch_loop_for_labels():
+    from pymsb.language.parser import Parser
+    from pymsb.language.transpiler import Transpiler
+    from pymsb.language.interpreter import Environment
+
+    code = """
+    i = 0
+    loop:
+    i = i + 1
+    If i < 5 Then
+        Goto loop
+    EndIf
+    """
+    transpiler = Transpiler()
+    source = transpiler.transpile(Parser().parse(code), Environment())
+    assert "def main_block_1():" in source
+    assert "return 1" in source
+    compile(source, "<test>", "exec")
+
+
+def test_values_stay_native_until_observed_as_text():
+    import pymsb.language.values as values
+
+    total = values.add(values.to_number_or_text("1"), values.to_number_or_text("2"))
+    assert total == 3 and isinstance(total, int)
+    assert values.add(values.to_number_or_text("x is "), values.to_number_or_text("5")) == "x is 5"
+    assert values.to_text(1.5 + 1.5) == "3.0"
+    assert values.to_text(2 > 1) == "True"
+    assert values.to_number(True) == 0
+    assert values.equals(6, "6")
+    assert values.is_true("TRUE") and not values.is_true("abc")
+
+
+def test_variables_are_resolved_to_slots():
+    from pymsb.language.parser import Parser
+    from pymsb.language.linker import Linker
+    from pymsb.language.interpreter import Environment
+
+    statements = Parser().parse("""
+    Total = 0
+    For I = 1 To 3
+        total = total + i
+    EndFor
+    """)
+    environment = Environment()
+    environment.allocate(Linker().resolve_variables(statements))
+    assert environment.variable_names == ["total", "i"]
+    assert environment.slot("TOTAL") == 0
+    environment.bind("I", 2)
+    assert environment.variables == ["", 2]
+    assert environment.get_variable("unused") == "" and environment.slot("unused") == 2
+
+
+def test_headless_mode_uses_text_streams():
+    import io
+    import pymsb.language.errors as errors
+
+    output = io.StringIO()
+    interpreter = pymsb.Interpreter(headless=True)
+    interpreter.execute_code("""
+    TextWindow.Write("Name? ")
+    name = TextWindow.Read()
+    TextWindow.WriteLine("Hello " + name)
+    """, input_lines=["World"], output=output)
+    assert output.getvalue() == "Name? World\nHello World\n"
+
+    try:
+        pymsb.Interpreter(headless=True).execute_code("GraphicsWindow.Show()", output=output)
+    except errors.PyMsbHeadlessError as e:
+        assert e.obj_name == "GraphicsWindow"
+    else:
+        assert False, "GraphicsWindow should not be available in headless mode"
+
+
+def test_headless_programs_only_write_their_own_output():
+    import contextlib
+    import io
+
+    code = """
+    a = 1
+    For i = 2 To 1
+    EndFor
+    Timer.Interval = 100
+    TextWindow.WriteLine({0})
+    """.format(" + ".join("a" for _ in range(100)))
+    for backend in ("interpreter", "python"):  # the Python backend can't run formulas this long
+        output = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()) as printed, \
+                contextlib.redirect_stderr(io.StringIO()) as logged:
+            pymsb.Interpreter(backend=backend, headless=True).execute_code(code, output=output)
+        assert output.getvalue() == "100\n"
+        assert printed.getvalue() == ""
+    assert "using the interpreter backend" in logged.getvalue()
+
+
+def test_optimizer_folds_constants_and_prunes_branches():
+    from pymsb.language.parser import Parser
+    from pymsb.language.optimizer import Optimizer
+
+    optimizer = Optimizer()
+    statements = optimizer.optimize(Parser().parse("""
+    x = 2 * 3 + 1
+    y = "x is " + "00" + x
+    z = x + 0
+    If 1 > 2 Then
+        TextWindow.WriteLine("never")
+    ElseIf x > 3 Then
+        TextWindow.WriteLine(x - 0 * 1)
+    ElseIf 1 = 1 Then
+        TextWindow.WriteLine("else")
+    EndIf
+    If "True" Then
+        TextWindow.WriteLine(y)
+    EndIf
+    """))
+    assert optimizer.dump(statements) == """x = 7
+y = ("x is 0" + x)
+z = (x + 0)
+If (x > 3) Then
+  TextWindow.WriteLine((x - 0))
+Else
+  TextWindow.WriteLine("else")
+EndIf
+TextWindow.WriteLine(y)
+"""
+
+
+def test_for_loop_counter_stays_numeric():
+    import io
+
+    output = io.StringIO()
+    interpreter = pymsb.Interpreter(headless=True)
+    interpreter.execute_code("""
+    n = 3
+    For i = 1 To n
+        n = 5
+    EndFor
+    For j = "01" To 2
+        TextWindow.WriteLine(j)
+    EndFor
+    """, output=output)
+    assert interpreter.environment.get_variable("i") == 6  # the upper bound is re-evaluated on every iteration
+    assert output.getvalue() == "01\n2\n"
+
+
+def test_optimizer_inlines_leaf_subroutines_in_loops():
+    from pymsb.language.parser import Parser
+    from pymsb.language.optimizer import Optimizer
+
+    code = """
+    Square()
+    For i = 1 To 3
+        Square()
+        Twice()
+    EndFor
+    Sub Square
+        y = i * i
+    EndSub
+    Sub Twice
+        Square()
+        Square()
+    EndSub
+    """
+    optimizer = Optimizer()
+    assert optimizer.dump(optimizer.optimize(Parser().parse(code))) == """Square()
+For i = "1" To 3
+  y = (i * i)
+  Twice()
+EndFor
+Sub Square
+  y = (i * i)
+EndSub
+Sub Twice
+  Square()
+  Square()
+EndSub
+"""
+
+
+def test_optimizer_leaves_the_parsed_statements_unchanged():
+    from pymsb.language.parser import Parser
+    from pymsb.language.optimizer import Optimizer
+
+    statements = Parser().parse("""
+    a[1 + 1] = Math.Max(2 * 3, a[0 + 1])
+    If 1 > 2 Then
+        TextWindow.WriteLine("never")
+    ElseIf 1 = 1 Then
+        TextWindow.WriteLine("always")
+    Else
+        TextWindow.WriteLine("never")
+    EndIf
+    While a[2] < 3 + 4
+        Increment()
+    EndWhile
+    Sub Increment
+        a[2] = a[2] + 1
+    EndSub
+    """)
+    optimizer = Optimizer()
+    parsed = optimizer.dump(statements)
+    jump_targets = [statement.jump_target for statement in statements]
+    keywords = [getattr(statement, "keyword", None) for statement in statements]
+
+    assert optimizer.dump(optimizer.optimize(statements)) != parsed
+    assert optimizer.dump(statements) == parsed
+    assert [statement.jump_target for statement in statements] == jump_targets
+    assert [getattr(statement, "keyword", None) for statement in statements] == keywords
+
+
+def test_event_dispatcher_policies():
+    import threading
+    import time
+    from pymsb.language.eventdispatcher import EventDispatcher
+
+    def trigger_while_busy(policy, **kwargs):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def run_subroutine(sub_name):
+            calls.append(sub_name)
+            started.set()
+            release.wait()
+
+        dispatcher = EventDispatcher(run_subroutine, policy, **kwargs)
+        dispatcher.dispatch("Timer.Tick", "OnTick")
+        started.wait(5)
+        for _ in range(5):
+            dispatcher.dispatch("Timer.Tick", "OnTick")
+        release.set()
+        while not dispatcher.is_idle():
+            time.sleep(0.01)
+        stats = dispatcher.stats()
+        assert stats["events"]["Timer.Tick"]["dispatched"] == len(calls)
+        return stats["dispatched"], stats["coalesced"], stats["dropped"]
+
+    assert trigger_while_busy("coalesce") == (2, 4, 0)
+    assert trigger_while_busy("drop") == (1, 0, 5)
+    assert trigger_while_busy("queue", max_queue_size=2) == (3, 0, 3)
+
+
+def test_event_workers_exit_when_the_program_ends():
+    import io
+
+    interpreter = pymsb.Interpreter(headless=True)
+    dispatchers = []
+    for _ in range(5):
+        interpreter.execute_code("""
+        Timer.Tick = OnTick
+        Timer.Interval = 10
+        Timer.Resume()
+        While n < 2
+          m = m + 1
+        EndWhile
+        Sub OnTick
+          n = n + 1
+        EndSub
+        """, output=io.StringIO())
+        dispatchers.append(interpreter.event_dispatcher)
+    assert len(set(dispatchers)) == 5
+    assert all(dispatcher.join(0) for dispatcher in dispatchers)
+
+
+def test_wait_returns_when_program_finishes():
+    import io
+    import threading
+
+    interpreter = pymsb.Interpreter(headless=True)
+    runner = threading.Thread(target=interpreter.execute_code, args=("""
+    For i = 1 To 10000
+    EndFor
+    """,), kwargs={"output": io.StringIO()})
+    runner.start()
+    assert interpreter.wait(timeout=5)
+    runner.join(5)
+    assert interpreter.wait(timeout=0)
+
+
+def test_cooperative_scheduler_interleaves_frames():
+    from pymsb.language.scheduler import CooperativeScheduler
+
+    slices = []
+
+    class Frame:
+        def __init__(self, name, length):
+            self.name = name
+            self.remaining = length
+
+        def run_for(self, budget):
+            slices.append(self.name)
+            self.remaining -= 1
+            return self.remaining == 0
+
+    scheduler = CooperativeScheduler(lambda sub_name: Frame(sub_name, 2))
+    scheduler.add_frame(Frame("Main", 3))
+    scheduler.step()
+    scheduler.dispatch("Timer.Tick", "OnTick")
+    scheduler.dispatch("Timer.Tick", "OnTick")
+    scheduler.run()
+    assert slices == ["Main", "Main", "OnTick", "Main", "OnTick"]
+    assert scheduler.is_idle()
+    assert scheduler.stats()["coalesced"] == 1  # the second tick came before the handler had even started
+
+    # A cooperative program runs to completion without any threads of its own
+    import io
+    interpreter = pymsb.Interpreter(headless=True, scheduler="cooperative", instruction_budget=10)
+    interpreter.execute_code("""
+    For i = 1 To 100
+      total = total + i
+    EndFor
+    """, output=io.StringIO())
+    assert interpreter.environment.get_variable("total") == 5050
+
+
+def test_profiler_counts_lines_and_builtins():
+    import io
+
+    interpreter = pymsb.Interpreter(headless=True, profile=True)
+    interpreter.execute_code("""total = 0
+For i = 1 To 10
+  total = total + Text.GetLength(i)
+EndFor
+TextWindow.WriteLine(total)
+""", output=io.StringIO())
+    report = interpreter.profiler.report()
+    counts = {line["line_number"]: line["count"] for line in report["lines"]}
+    assert counts == {0: 1, 1: 1, 2: 10, 3: 10, 4: 1}
+    builtins = [(builtin["line_number"], builtin["name"], builtin["count"]) for builtin in report["builtins"]]
+    assert builtins == [(2, "Text.GetLength", 10), (4, "TextWindow.WriteLine", 1)]
+    assert "total = total + Text.GetLength(i)" in interpreter.profiler.annotate()
+
+    # Without profiling, the instructions are not instrumented at all
+    interpreter = pymsb.Interpreter(headless=True)
+    interpreter.execute_code("x = 1", output=io.StringIO())
+    assert interpreter.profiler is None
+    assert "execute" not in vars(interpreter.instructions[0])
+
+
+def test_tracers_see_statements_builtins_subroutines_and_events():
+    import io
+    from pymsb.language.tracing import Tracer
+
+    class RecordingTracer(Tracer):
+        def __init__(self):
+            self.lines = []
+            self.builtins = []
+            self.subroutines = []
+            self.events = []
+
+        def statement_enter(self, thread, line_number):
+            self.lines.append(line_number)
+
+        def builtin_return(self, line_number, name, result):
+            self.builtins.append((line_number, name, result))
+
+        def subroutine_enter(self, thread, sub_name):
+            self.subroutines.append(("enter", sub_name))
+
+        def subroutine_exit(self, thread, sub_name):
+            self.subroutines.append(("exit", sub_name))
+
+        def event_dispatched(self, event_name, sub_name):
+            self.events.append((event_name, sub_name))
+
+    tracer = RecordingTracer()
+    interpreter = pymsb.Interpreter(headless=True, optimize=False)
+    interpreter.add_tracer(tracer)
+    interpreter.execute_code("""x = Text.GetLength("abc")
+Greet()
+Timer.Tick = OnTick
+Timer.Interval = 1
+Timer.Resume()
+While ticks < 1
+EndWhile
+Timer.Pause()
+Sub Greet
+  TextWindow.WriteLine("Hello")
+EndSub
+Sub OnTick
+  ticks = ticks + 1
+EndSub
+""", output=io.StringIO())
+    assert tracer.lines[:4] == [0, 1, 9, 10]
+    assert tracer.builtins[:2] == [(0, "Text.GetLength", "3"), (9, "TextWindow.WriteLine", None)]
+    assert tracer.subroutines[:4] == [("enter", "greet"), ("exit", "greet"), ("enter", "ontick"), ("exit", "ontick")]
+    assert tracer.events[0] == ("Timer.Tick", "OnTick")
+
+    # Once removed, the tracer doesn't slow down the next program at all
+    interpreter.remove_tracer(tracer)
+    interpreter.execute_code("x = 1", output=io.StringIO())
+    assert "execute" not in vars(interpreter.instructions[0])
+
+
+def test_batch_runs_programs_in_parallel_with_timeouts():
+    import json
+    import os
+    import tempfile
+    from pymsb import batch
+
+    with tempfile.TemporaryDirectory() as directory:
+        programs = {
+            "greet.sb": 'TextWindow.WriteLine("Hello, " + TextWindow.Read() + Program.GetArgument(1))',
+            "forever.sb": "While 1 = 1\nEndWhile",
+        }
+        for file_name, code in programs.items():
+            with open(os.path.join(directory, file_name), "w") as code_file:
+                code_file.write(code)
+        manifest_path = os.path.join(directory, "manifest.jsonl")
+        with open(manifest_path, "w") as manifest:
+            manifest.write(json.dumps({"path": "greet.sb", "args": ["!"], "input": ["World"]}) + "\n")
+            manifest.write(json.dumps({"path": "forever.sb"}) + "\n")
+
+        results = batch.run_batch(batch.load_jobs(manifest_path), processes=2, timeout=1)
+        assert [result["status"] for result in results] == ["ok", "timeout"]
+        assert results[0]["output"] == "World\nHello, World!\n"
+        assert [job.path for job in batch.load_jobs(directory)] == [os.path.join(directory, "forever.sb"),
+                                                                    os.path.join(directory, "greet.sb")]
+
+
+def test_compiled_program_runs_many_times_with_fresh_state():
+    import io
+
+    interpreter = pymsb.Interpreter(headless=True)
+    program = interpreter.compile("""
+    Stack.PushValue("names", TextWindow.Read())
+    count = count + 1
+    TextWindow.WriteLine(Program.GetArgument(1) + Stack.GetCount("names") + count + TextWindow.Title)
+    TextWindow.Title = "changed"
+    """)
+    assert isinstance(program, pymsb.CompiledProgram)
+
+    outputs = []
+    for arg in ("a", "b"):
+        output = io.StringIO()
+        interpreter.run(program, [arg], input_lines=["name"], output=output)
+        outputs.append(output.getvalue())
+    assert outputs == ["name\na11Microsoft Small Basic Text Window\n", "name\nb11Microsoft Small Basic Text Window\n"]
+    # The second run reused the compiled instructions and the built-in objects
+    instructions = interpreter.instructions
+    interpreter.run(program, ["c"], input_lines=["name"], output=io.StringIO())
+    assert interpreter.instructions is instructions
+
+
+def test_snapshot_resumes_in_another_interpreter():
+    import io
+    import os
+    import tempfile
+    from pymsb.language.tracing import Tracer
+
+    code = """For i = 1 To 5
+  Stack.PushValue("s", i)
+  If i = 3 Then
+    Checkpoint()
+  EndIf
+EndFor
+TextWindow.WriteLine("i=" + i + ", count=" + Stack.GetCount("s") + ", top=" + Stack.PopValue("s"))
+Sub Checkpoint
+  TextWindow.WriteLine("checkpoint")
+EndSub
+"""
+
+    class SnapshotTracer(Tracer):
+        def __init__(self, interpreter, path):
+            self.interpreter = interpreter
+            self.path = path
+
+        def subroutine_enter(self, thread, sub_name):
+            self.interpreter.save_snapshot(self.path)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snapshot.gz")
+        interpreter = pymsb.Interpreter(headless=True, scheduler="cooperative", optimize=False)
+        interpreter.add_tracer(SnapshotTracer(interpreter, path))
+        output = io.StringIO()
+        interpreter.execute_code(code, output=output)
+        assert output.getvalue() == "checkpoint\ni=6, count=5, top=5\n"
+
+        # The snapshot was taken just before the call to Checkpoint, with three values on the stack
+        resumed = pymsb.Interpreter(headless=True, scheduler="cooperative", optimize=False)
+        output = io.StringIO()
+        resumed.resume(path, output=output)
+        assert output.getvalue() == "checkpoint\ni=6, count=5, top=5\n"
+        assert resumed.environment.get_variable("i") == 6
+
+
+def test_resource_limits_stop_runaway_programs():
+    import io
+
+    def limit_hit(code, **limits):
+        interpreter = pymsb.Interpreter(headless=True, **limits)
+        try:
+            interpreter.execute_code(code, input_lines=[], output=io.StringIO())
+        except pymsb.errors.PyMsbResourceLimitError as e:
+            return e.limit
+        return None
+
+    assert limit_hit("While 1 = 1\nEndWhile", max_instructions=10000) == "instructions"
+    assert limit_hit("While 1 = 1\nEndWhile", max_seconds=0.2) == "seconds"
+    assert limit_hit('For i = 1 To 100000\n  Stack.PushValue("s", "0123456789")\nEndFor', max_memory=10000) == "memory"
+    assert limit_hit("For i = 1 To 100\nEndFor", max_instructions=10000, max_seconds=5, max_memory=1000) is None
+
+
+def test_memory_is_measured_less_often_as_the_data_grows():
+    import io
+    from pymsb.language.limits import ResourceLimits
+
+    measure_memory = ResourceLimits._ResourceLimits__measure_memory
+    measured = []
+
+    def count_measured(limits):
+        usage, count = measure_memory(limits)
+        measured.append(count)
+        return usage, count
+
+    ResourceLimits._ResourceLimits__measure_memory = count_measured
+    try:
+        interpreter = pymsb.Interpreter(headless=True, max_memory=10 ** 9)
+        interpreter.execute_code('For i = 1 To 100000\n  Stack.PushValue("s", i)\nEndFor', output=io.StringIO())
+    finally:
+        ResourceLimits._ResourceLimits__measure_memory = measure_memory
+    # Every value is measured a few times at most, rather than once every check_interval instructions
+    assert sum(measured) < 5 * interpreter.limits.instructions
+
+
+def test_builtin_members_are_resolved_case_insensitively_at_compile_time():
+    import io
+    from pymsb.language.modules import utilities
+
+    assert utilities.capitalize("TEXTWINDOW") == "TextWindow" and utilities.capitalize("getlength") == "GetLength"
+    assert utilities.capitalize("nosuchname") is None
+    assert utilities.get_msb_builtin_info("timer", "tick").type == "event"
+
+    output = io.StringIO()
+    pymsb.Interpreter(headless=True).execute_code("""
+    textwindow.writeline(TEXT.GETLENGTH("abc"))
+    stack.pushvalue("s", 1)
+    TextWindow.WriteLine(Stack.GetCount("s"))
+    File.AppendContents("/no/such/directory/file.txt", "text")
+    If file.lasterror <> "" Then
+      TextWindow.WriteLine("failed")
+    EndIf
+    """, output=output)
+    assert output.getvalue() == "3\n1\nfailed\n"
+
+
+def test_long_concatenations_are_built_as_ropes():
+    import io
+    import pymsb.language.values as values
+
+    text = values.concatenate("x" * values.ROPE_MIN_LENGTH, "y")
+    longer, other = values.concatenate(text, 1), values.concatenate(text, "2")
+    assert type(longer) is values.Rope and values.to_text(longer).endswith("xy1") and len(longer) == len(text) + 1
+    assert values.to_text(other).endswith("xy2") and values.to_text(text).endswith("xy")
+    assert values.to_number(values.concatenate(" " * values.ROPE_MIN_LENGTH, "-5")) == -5
+    assert not values.concatenate("1 " * values.ROPE_MIN_LENGTH, "2").numeric
+
+    output = io.StringIO()
+    pymsb.Interpreter(headless=True).execute_code("""
+    For i = 1 To 1000
+      s = s + "line " + i + " "
+      t = Text.Append(t, i)
+    EndFor
+    TextWindow.WriteLine(Text.GetLength(s))
+    TextWindow.WriteLine(Text.GetSubText(s, 1, 14))
+    TextWindow.WriteLine(Text.GetLength(t))
+    """, output=output)
+    assert output.getvalue() == "8893\nline 1 line 2 \n2893\n"
+
+
+def test_appending_only_text_builds_a_rope():
+    import io
+    import pymsb.language.values as values
+
+    assert type(values.add("x" * values.ROPE_MIN_LENGTH, "y")) is values.Rope
+    assert values.add("1", "2") == "12" and values.add("a", 1) == "a1"
+
+    output = io.StringIO()
+    interpreter = pymsb.Interpreter(headless=True)
+    interpreter.execute_code("""
+    For i = 1 To 5000
+      s = s + "text"
+    EndFor
+    TextWindow.WriteLine(Text.GetLength(s))
+    """, output=output)
+    assert output.getvalue() == "20000\n"
+    assert type(interpreter.environment.variables[interpreter.environment.slot("s")]) is values.Rope
+
+
+def test_basic_blocks_run_goto_loops_in_one_dispatch_per_iteration():
+    import io
+    import pymsb.language.instructions as instructions
+
+    output = io.StringIO()
+    interpreter = pymsb.Interpreter(headless=True)
+    interpreter.execute_code("""
+    i = 0
+    loop:
+    i = i + 1
+    s = s + i
+    If i < 10 Then
+      Goto loop
+    EndIf
+    TextWindow.WriteLine(s)
+    """, output=output)
+    assert output.getvalue() == "55\n"
+
+    loop = interpreter.blocks[1]
+    assert isinstance(loop, instructions.BasicBlock) and loop.size == 3
+    assert interpreter.blocks[2] is interpreter.instructions[2]  # can still be resumed in the middle of a block
+    # While the condition holds, the block continues at its own start rather than at the Goto
+    interpreter.environment.bind("i", 0)
+    assert loop.execute(None) == 1
+    interpreter.environment.bind("i", 9)
+    assert loop.execute(None) == 5
+
+
+def test_tokenizer_matches_tokens_in_priority_order():
+    from pymsb.language.parser import Parser, MsbToken
+
+    tokens = Parser().tokenize('  elseif  x<>-3.5 and Else1 = "a b\' c   \' note', include_comments=True)
+    assert [(token.token_type, token.value, token.line_index) for token in tokens] == [
+        ("ElseIf", "elseif", 2), (MsbToken.SYMBOL, "x", 10), (MsbToken.COMPARATOR, "<>", 11),
+        (MsbToken.LITERAL, "-3.5", 13), (MsbToken.AND_OR, "and", 18), (MsbToken.SYMBOL, "Else1", 22),
+        (MsbToken.EQUALS, "=", 28), (MsbToken.LITERAL, '"a b\' c   \' note', 30)]
+    assert [token.token_type for token in Parser().tokenize("x = 1 ' note")] == [
+        MsbToken.SYMBOL, MsbToken.EQUALS, MsbToken.LITERAL]
+    unexpected = Parser().tokenize("x = 1 @ 2")[-1]
+    assert unexpected.token_type == MsbToken.UNEXPECTED_TOKEN
+    assert (unexpected.value, unexpected.line_index) == ("@ 2", 6)
+
+
+def test_compiled_programs_are_cached_on_disk():
+    import io
+    import os
+    import tempfile
+    import pymsb.language.programcache as programcache
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "double.sb")
+        with open(source_path, "w") as source_file:
+            source_file.write("x = 21\nTextWindow.WriteLine(x * 2)\n")
+        with open(source_path) as source_file:
+            code = source_file.read()
+        pymsb.Interpreter(headless=True, cache=True).execute_code(code, program_path=source_path, output=io.StringIO())
+        cache_path = os.path.join(directory, programcache.CACHE_DIRECTORY, "double.sb.pickle")
+        assert os.path.isfile(cache_path)
+
+        interpreter = pymsb.Interpreter(headless=True, cache=True)
+        parser, interpreter.parser = interpreter.parser, None  # loading a cached program doesn't parse it
+        program = interpreter.compile(code, source_path)
+        interpreter.parser = parser
+        assert program.variable_names == ("x",) and program.source.startswith("x = 21")
+        output = io.StringIO()
+        interpreter.run(program, output=output)
+        assert output.getvalue() == "42\n"
+
+        # Changed code, or other settings, don't use what was cached for the old code
+        assert programcache.load(cache_path, programcache.cache_key("x = 1", (True, True))) is None
+        assert interpreter.compile("x = 1\n", source_path).variable_names == ("x",)
+        pymsb.Interpreter(headless=True, optimize=False, cache_dir=directory).compile(code)
+        assert os.path.isfile(os.path.join(directory, programcache.cache_key(code, (False, True)) + ".pickle"))
+
+    # Programs aren't cached at all if it can't be told which version of pymsb cached them
+    assert programcache.pymsb_version() is not None  # even when running from a source checkout, like the tests
+    pymsb_version, programcache.pymsb_version = programcache.pymsb_version, lambda: None
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            pymsb.Interpreter(headless=True, cache_dir=directory).compile(code)
+            assert os.listdir(directory) == []
+    finally:
+        programcache.pymsb_version = pymsb_version
+
+
+def test_parser_session_reparses_edits_incrementally():
+    from pymsb.language.parsersession import ParserSession, Diagnostic
+
+    session = ParserSession("""Sub Greet
+  If name = "" Then
+    Goto done
+  EndIf
+  TextWindow.WriteLine("Hi " + name)
+  done:
+EndSub
+Greet()""")
+    assert session.diagnostics == []
+    statements = session.statements()
+    if_statement, end_if = statements[1], statements[3]
+    assert if_statement.jump_target is end_if and statements[2].jump_target is statements[5]
+
+    # Only the edited line is parsed again; the other statements, and the links to them, stay the same
+    session.edit(2, 3, ["    Goto finished"])
+    assert session.diagnostics == [Diagnostic(2, 0, "Cannot find label 'finished' used in Goto statement.", "name")]
+    assert session.statements() is None
+    session.edit(5, 6, ["  finished:"])
+    assert session.diagnostics == []
+    assert session.statements()[2].jump_target is session.statements()[5]
+
+    # Structure errors are repaired when the code is fixed, and later lines are renumbered
+    session.edit(3, 4, [])
+    assert session.diagnostics == [
+        Diagnostic(5, 0, "Unexpected token EndSub found.", "block"),
+        Diagnostic(6, 0, "Missing the closing for IfStatement[If](UserVariable<name> = Literal<>)", "block")]
+    session.edit(3, 3, ["  EndIf", "  x = 1 +"])
+    assert [(d.line_number, d.kind) for d in session.diagnostics] == [(4, "syntax")]
+    session.edit(4, 5, [])
+    statements = session.statements()
+    assert session.lines[3] == "  EndIf" and [s.line_number for s in statements] == [0, 1, 2, 3, 4, 5, 6, 7]
+    assert statements[1].jump_target is statements[3] and statements[1] is if_statement
+    assert statements[7].jump_target is statements[0]
+
+
+def test_expressions_are_parsed_with_precedence_and_left_associativity():
+    from pymsb.language.parser import Parser
+
+    def parse_expression(expression):
+        return repr(Parser().parse("If " + expression + " Then\nEndIf")[0].condition_expr)
+
+    assert parse_expression("10 - 2 + 3") == "((Literal<10>-Literal<2>)+Literal<3>)"
+    assert parse_expression("8 / 2 * 2") == "((Literal<8>/Literal<2>)*Literal<2>)"
+    assert parse_expression("1 + 2 * 3 - 4") == "((Literal<1>+(Literal<2>*Literal<3>))-Literal<4>)"
+    assert parse_expression("a = 1 Or b < 2 And c") == \
+        "((UserVariable<a> = Literal<1>) Or ((UserVariable<b> < Literal<2>) And UserVariable<c>))"
+
+    # Long machine-generated formulas are parsed in a single pass
+    formula = Parser().parse("x = " + " - ".join(str(i) for i in range(1000)))[0].val
+    for i in reversed(range(1, 1000)):
+        assert formula.operator == "-" and formula.right.value == str(i)
+        formula = formula.left
+    assert formula.value == "0"
+
+
+def test_long_formulas_run_without_deep_recursion():
+    import io
+
+    code = """
+    a = 1
+    x = {0}
+    TextWindow.WriteLine(x)
+    TextWindow.WriteLine("1" + "" - 2 * a + 3 + "" + 1)
+    """.format(" + ".join("a" for _ in range(400)) + " - 2 * a + 5 * a")
+    for backend, optimize in (("interpreter", True), ("interpreter", False), ("python", True)):
+        output = io.StringIO()
+        pymsb.Interpreter(backend=backend, headless=True, optimize=optimize).execute_code(code, output=output)
+        assert output.getvalue() == "403\n3\n", (backend, optimize, output.getvalue())
+
+
+def test_compiling_code_with_a_syntax_error_raises_it():
+    import contextlib
+    import io
+
+    interpreter = pymsb.Interpreter(headless=True)
+    with contextlib.redirect_stdout(io.StringIO()) as printed:
+        try:
+            interpreter.compile("x = 1\nIf x Then\nEndWhile\nEndIf\n")
+        except pymsb.errors.PyMsbSyntaxError as e:
+            assert (e.line_number, e.message) == (2, "Unexpected token EndWhile found.")
+        else:
+            assert False, "expected a syntax error"
+    assert "EndWhile" in printed.getvalue()
+
+
+def test_removed_tracers_are_not_called_when_a_program_runs_again():
+    import io
+    from pymsb.language.tracing import Tracer
+
+    class LineCounter(Tracer):
+        def __init__(self):
+            self.lines = []
+
+        def statement_enter(self, thread, line_number):
+            self.lines.append(line_number)
+
+    interpreter = pymsb.Interpreter(headless=True)
+    program = interpreter.compile("x = 1\nTextWindow.WriteLine(x)\n")
+    tracer = LineCounter()
+    interpreter.add_tracer(tracer)
+    interpreter.run(program, output=io.StringIO())
+    assert tracer.lines
+    interpreter.remove_tracer(tracer)
+    tracer.lines = []
+    output = io.StringIO()
+    interpreter.run(program, output=output)
+    interpreter.run(program, output=output)
+    assert tracer.lines == [] and output.getvalue() == "1\n1\n"
+
+
+def test_program_end_stops_every_thread():
+    import io
+    import time
+
+    for backend, scheduler in (("interpreter", "threads"), ("interpreter", "cooperative"), ("python", "threads")):
+        interpreter = pymsb.Interpreter(backend=backend, headless=True, scheduler=scheduler)
+        output = io.StringIO()
+        interpreter.execute_code("TextWindow.WriteLine(1)\nProgram.End()\nTextWindow.WriteLine(2)\n", output=output)
+        assert output.getvalue() == "1\n"
+
+        # An event handler ends the program while the main program is still running
+        interpreter.execute_code("""
+        Timer.Tick = Stop
+        Timer.Interval = 10
+        Timer.Resume()
+        While "True"
+          n = n + 1
+        EndWhile
+        Sub Stop
+          Program.End()
+        EndSub
+        """, output=io.StringIO())
+        slot = interpreter.environment.slot("n")
+        count = interpreter.environment.variables[slot]
+        time.sleep(0.05)
+        assert interpreter.environment.variables[slot] == count
+
+
+def test_timer_stops_when_the_program_ends():
+    import io
+    import threading
+    import time
+
+    for scheduler in ("threads", "cooperative"):
+        timers = {thread for thread in threading.enumerate() if isinstance(thread, threading.Timer)}
+        pymsb.Interpreter(headless=True, scheduler=scheduler).execute_code("""
+        Timer.Tick = OnTick
+        Timer.Interval = 10
+        Timer.Resume()
+        While n < 2
+          m = m + 1
+        EndWhile
+        Sub OnTick
+          n = n + 1
+        EndSub
+        """, output=io.StringIO())
+        time.sleep(0.05)
+        assert not [thread for thread in threading.enumerate()
+                    if isinstance(thread, threading.Timer) and thread not in timers]